@@ -22,15 +22,15 @@ if __name__ == '__main__':
     masks = xarray.open_dataset(config.regions.mask_file)
     pp = config.filesystem.analysis_history.parents[0]
     logger.info('Opening {d} {v} from {pp}', d=args.domain, v=args.var, pp=pp)
-    ds = open_var(pp, args.domain, args.var)
+    pp_roots = [pp]
     # If later years of the analysis were run as separate
     # experiments, open them too.
     if hasattr(config.filesystem, 'analysis_extensions') and \
           config.filesystem.analysis_extensions is not None:
         for ext_path in config.filesystem.analysis_extensions:
             logger.info(f'Extending with {ext_path}')
-            ext_ds = open_var(ext_path.parents[0], args.domain, args.var)
-            ds = xarray.concat((ds, ext_ds), dim='time')
+            pp_roots.append(ext_path.parents[0])
+    ds = open_var(pp_roots, args.domain, args.var)
     # Quick check for subregion files, which have coordinates
     # that need to be renamed.
     if 'yh_sub01' in ds and 'xh_sub01' in ds:
@@ -1,5 +1,4 @@
 from concurrent import futures
-from functools import partial
 from pathlib import Path
 
 import pandas as pd
@@ -42,33 +41,44 @@ def thread_worker(month_file, region_slice):
     return out_file
 
 
+def find_files(year, interim_path, long_name):
+    found_files = []
+    for mon in range(1, 13):
+        uda_file = interim_path / long_name / f'ERA5_{long_name}_{mon:02d}{year}.nc'
+        if uda_file.is_file():
+            found_files.append(uda_file)
+        elif mon == 1:
+            raise Exception('Did not find any files for this year')
+        else:
+            logger.info(f'Found files for month 1 to {mon - 1}')
+            break
+    return found_files
+
+
 def main(year, interim_path, output_dir, lon_lat_box):
-    for long_name, file_var in variables.items():
+    # These should be formatted ok if they are floats
+    # (nco requires decimal point)
+    region_slice = f'-d longitude,{lon_lat_box[0]},{lon_lat_box[1]} \
+        -d latitude,{lon_lat_box[2]},{lon_lat_box[3]}'
+    long_names = list(variables)
+    logger.info('hsmget')
+    staging = hsmget.submit(find_files(year, interim_path, long_names[0]))
+    for i, file_var in enumerate(variables.values()):
         logger.info(file_var)
-        found_files = []
-        for mon in range(1, 13):
-            uda_file = interim_path / long_name / f'ERA5_{long_name}_{mon:02d}{year}.nc'
-            if uda_file.is_file():
-                found_files.append(uda_file)
-            elif mon == 1:
-                raise Exception('Did not find any files for this year')
-            else:
-                logger.info(f'Found files for month 1 to {mon - 1}')
-                break
-
-        logger.info('hsmget')
-        tmp_files = hsmget(found_files)
+        current = staging
+        # Start copying the next variable while this one is processed
+        if i + 1 < len(long_names):
+            staging = hsmget.submit(
+                find_files(year, interim_path, long_names[i + 1])
+            )
         logger.info('add record dim')
-        # These should be formatted ok if they are floats
-        # (nco requires decimal point)
-        region_slice = f'-d longitude,{lon_lat_box[0]},{lon_lat_box[1]} \
-            -d latitude,{lon_lat_box[2]},{lon_lat_box[3]}'
+        # Process each month as soon as it has been copied
         with futures.ThreadPoolExecutor(max_workers=4) as executor:
-            processed_files = sorted(
-                executor.map(
-                    partial(thread_worker, region_slice=region_slice), tmp_files
-                )
-            )
+            processing = [
+                executor.submit(thread_worker, f.result(), region_slice)
+                for f in futures.as_completed(current)
+            ]
+            processed_files = sorted(f.result() for f in processing)
 
         # Join together and format metadata using xarray.
         # Using xarray partly because ncrcat is strangely slow on these files.
@@ -1,11 +1,21 @@
 import warnings
+from dataclasses import dataclass
+from datetime import timedelta
 from os import path
+from pathlib import Path
 
+import netCDF4
 import numpy as np
 import xarray
 from loguru import logger
 
-from workflow_tools.grid import reuse_regrid
+from workflow_tools.grid import WeightCache, default_weight_cache
+from workflow_tools.io import (
+    NETCDF4_PYTHON_LOCK,
+    open_netcdf4,
+    write_netcdf3,
+    write_records,
+)
 
 # ignore pandas FutureWarnings raised multiple times by xarray
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -19,23 +29,138 @@ def check_angle_range(angle):
             Expected from [-2pi, 2pi]. Are the units correct?')
 
 
-def rotate_uv(u, v, angle):
+def rotate_uv(u, v, angle=None, cos=None, sin=None):
     """Rotate velocities from earth-relative to model-relative.
 
     Args:
         u: west-east component of velocity.
         v: south-north component of velocity.
         angle: angle of rotation from true north to model north.
+            Not needed if cos and sin are given.
+        cos (optional): cos of angle, if already known.
+        sin (optional): sin of angle, if already known.
 
     Returns:
         Model-relative west-east and south-north components of velocity.
     """
-    urot = np.cos(angle) * u - np.sin(angle) * v
-    vrot = np.sin(angle) * u + np.cos(angle) * v
+    if cos is None:
+        cos = np.cos(angle)
+    if sin is None:
+        sin = np.sin(angle)
+    urot = cos * u - sin * v
+    vrot = sin * u + cos * v
     return urot, vrot
 
 
-def fill_missing(arr, xdim='locations', zdim='z', fill='b'):
+def _shift_days(ds, days):
+    return ds.assign_coords(time=ds['time'] + np.timedelta64(days, 'D'))
+
+
+def _is_end_of_year(ds):
+    """Is the (single) time in ds on December 31?"""
+    time = ds['time'][0]
+    return int(time.dt.month) == 12 and int(time.dt.day) == 31
+
+
+def _time_step(existing, new, units, calendar):
+    """Spacing of the records in a yearly file, in the units of its time."""
+    if len(existing) > 1:
+        return existing[-1] - existing[-2]
+    if len(new) > 1:
+        return new[1] - new[0]
+    last = netCDF4.num2date(existing[-1], units, calendar)
+    return netCDF4.date2num(last + timedelta(days=1), units, calendar) - existing[-1]
+
+
+def _last_day(yearly_file):
+    """Last record before the padding in a yearly file, or None if no file."""
+    if not yearly_file.exists():
+        return None
+    with xarray.open_dataset(yearly_file) as ds:
+        return ds.isel(time=[ds.sizes['time'] - 2]).load()
+
+
+class FillPlan:
+    """Where each point of a boundary array gets its value from when
+    fill_missing fills it, worked out once for a pattern of missing points.
+    On a segment the pattern is set by the source land mask, so one plan
+    fills every time and variable with one take.
+
+    Args:
+        missing: boolean array of missing points, with dimensions (z, locations),
+            or (locations) if there is no vertical fill.
+        fill (str, optional): b for bfill or f for ffill along locations.
+        vertical (bool, optional): whether to ffill along z and then fill
+            the rest with 0, as fill_missing does when zdim is given.
+    """
+
+    def __init__(self, missing, fill='b', vertical=True):
+        self.missing = missing
+        self.vertical = vertical
+        missing2d = np.atleast_2d(missing)
+        nz, nx = missing2d.shape
+        x = np.arange(nx)
+        if fill == 'f':
+            source_x = np.maximum.accumulate(
+                np.where(missing2d, -1, x), axis=1
+            )
+        elif fill == 'b':
+            source_x = np.minimum.accumulate(
+                np.where(missing2d, nx, x)[:, ::-1], axis=1
+            )[:, ::-1]
+        else:
+            raise ValueError(f'Unknown fill {fill}')
+        found = (source_x >= 0) & (source_x < nx)
+        # Flat index of the point each point takes its value from, or -1
+        index = np.where(found, np.arange(nz)[:, None] * nx + source_x, -1)
+        if vertical:
+            source_z = np.maximum.accumulate(
+                np.where(found, np.arange(nz)[:, None], -1), axis=0
+            )
+            index = np.where(
+                source_z >= 0, index[np.maximum(source_z, 0), x], -1
+            )
+        self.index = index.ravel()
+
+    def apply(self, values):
+        """Fill an array whose last dimensions are those of missing."""
+        lead = values.shape[:values.ndim - self.missing.ndim]
+        flat = values.reshape(*lead, -1)
+        filled = np.take(flat, np.maximum(self.index, 0), axis=-1)
+        filled[..., self.index < 0] = 0 if self.vertical else np.nan
+        return filled.reshape(values.shape)
+
+
+def _fill_with_plans(ds, xdim, zdim, fill, plans):
+    """fill_missing using a FillPlan from plans (made and added if needed)
+    for each variable, or None if any variable can't be filled that way
+    (dask, not floating point, or with the missing points varying in time).
+    """
+    core = [xdim] if zdim is None else [zdim, xdim]
+    filled = {}
+    for name, da in ds.data_vars.items():
+        if (
+            not set(core) <= set(da.dims)
+            or da.chunks is not None
+            or not np.issubdtype(da.dtype, np.floating)
+        ):
+            return None
+        ordered = da.transpose(..., *core)
+        values = ordered.values
+        missing = np.isnan(values)
+        first = missing.reshape(-1, *missing.shape[missing.ndim - len(core):])[0]
+        if not np.array_equal(missing, np.broadcast_to(first, missing.shape)):
+            logger.debug(f'Missing points of {name} vary, filling without a plan')
+            return None
+        key = (fill, zdim is not None, first.shape, np.packbits(first).tobytes())
+        plan = plans.get(key)
+        if plan is None:
+            plan = plans[key] = FillPlan(first, fill=fill, vertical=zdim is not None)
+        filled[name] = ordered.copy(data=plan.apply(values)).transpose(*da.dims)
+    return ds.assign(filled)
+
+
+def fill_missing(arr, xdim='locations', zdim='z', fill='b', plans=None):
     """Fill missing data along the boundaries.
     Extrapolates horizontally first, then vertically.
 
@@ -45,10 +170,16 @@ def fill_missing(arr, xdim='locations', zdim='z', fill='b'):
         zdim: vertical dimension of the dataset.
         fill (str, optional): Method to use for filling data horizontally
             (b for bfill or f for ffill).
+        plans (dict, optional): FillPlans by pattern of missing points,
+            to reuse and add to when filling a Dataset.
 
     Returns:
         Filled DataArray or Dataset.
     """
+    if plans is not None and isinstance(arr, xarray.Dataset):
+        filled = _fill_with_plans(arr, xdim, zdim, fill, plans)
+        if filled is not None:
+            return filled
     if fill == 'f':
         filled = arr.ffill(dim=xdim, limit=None)
     elif fill == 'b':
@@ -211,6 +342,8 @@ def z_to_dz(ds, max_depth=6500.):
 
     Returns:
         xarray.DataArray: 3D <time, z, locations> array of thicknesses.
+            This is a read-only view that repeats the 1D profile, which
+            workflow_tools.io.write_netcdf3 writes without copying it.
     """
     zi = 0.5 * (np.roll(ds['z'], shift=-1) + ds['z'])
     zi[-1] = max_depth
@@ -218,7 +351,7 @@ def z_to_dz(ds, max_depth=6500.):
     dz[0] = zi[0]
     nt = len(ds['time'])
     nx = len(ds['locations'])
-    dz = np.tile(dz.data[np.newaxis, :, np.newaxis], (nt, 1, nx))
+    dz = np.broadcast_to(dz.data[np.newaxis, :, np.newaxis], (nt, len(dz), nx))
     da_dz = xarray.DataArray(
         dz,
         coords=[
@@ -232,6 +365,78 @@ def z_to_dz(ds, max_depth=6500.):
     return da_dz
 
 
+@dataclass(frozen=True)
+class SegmentGeometry:
+    """Coordinates of the points along a segment, taken once from the edge
+    of the supergrid. The arrays are read only.
+
+    Attributes:
+        dim (str): dimension of the supergrid along the segment (nxp or nyp).
+        lon (numpy.ndarray): longitude of the points.
+        lat (numpy.ndarray): latitude of the points.
+        angle (numpy.ndarray): angle of rotation from true north to model north,
+            in radians.
+        cos (numpy.ndarray): cos of angle, for rotate_uv.
+        sin (numpy.ndarray): sin of angle, for rotate_uv.
+    """
+
+    dim: str
+    lon: np.ndarray
+    lat: np.ndarray
+    angle: np.ndarray
+    cos: np.ndarray
+    sin: np.ndarray
+
+    @classmethod
+    def from_hgrid(cls, hgrid, border, in_degrees=True):
+        """Take the geometry from the edge of hgrid along a border.
+
+        Args:
+            hgrid (xarray.Dataset): dataset from opening ocean_hgrid.nc.
+                Contains 'x', 'y', and 'angle_dx'. Only the edge is read.
+            border (str): north, south, east, or west.
+            in_degrees (bool, optional): is angle_dx in degrees (True)
+                or radians (False)?
+
+        Returns:
+            SegmentGeometry: geometry of the segment.
+        """
+        edges = {
+            'south': ('nxp', {'nyp': 0}),
+            'north': ('nxp', {'nyp': -1}),
+            'west': ('nyp', {'nxp': 0}),
+            'east': ('nyp', {'nxp': -1}),
+        }
+        if border not in edges:
+            raise ValueError(f'Unknown border {border}')
+        dim, edge = edges[border]
+        lon = np.array(hgrid['x'].isel(edge).values)
+        lat = np.array(hgrid['y'].isel(edge).values)
+        angle = np.array(hgrid['angle_dx'].isel(edge).values)
+        if in_degrees:
+            angle = np.radians(angle)
+        check_angle_range(angle)
+        arrays = [lon, lat, angle, np.cos(angle), np.sin(angle)]
+        for a in arrays:
+            a.flags.writeable = False
+        return cls(dim, *arrays)
+
+    def to_dataset(self):
+        """lon, lat and angle as an xarray.Dataset along dim."""
+        return xarray.Dataset({
+            'lon': ((self.dim, ), self.lon),
+            'lat': ((self.dim, ), self.lat),
+            'angle': ((self.dim, ), self.angle),
+        })
+
+    def rotation(self, dim='locations'):
+        """cos and sin of angle as DataArrays along dim, for rotate_uv."""
+        return (
+            xarray.DataArray(self.cos, dims=(dim, )),
+            xarray.DataArray(self.sin, dims=(dim, )),
+        )
+
+
 class Segment:
     """One segment of a MOM6 open boundary.
 
@@ -243,15 +448,16 @@ class Segment:
         num (int): segment identification number following MOM6 order (1-4).
         border (str): which border of the model grid the segment represents
             (north, south, east, or west).
-        hgrid: (xarray.Dataset) dataset from opening ocean_hgrid.nc.
-            Contains 'x', 'y', and 'angle_dx'.
-        in_degrees: (bool): is angle_dx in hgrid in units of degrees (True)
-            or radians (False)?
+        geometry (SegmentGeometry): lon, lat and angle along the segment,
+            taken from the edge of hgrid (see SegmentGeometry.from_hgrid).
         segstr (str): string identifying the segment, used in variable and file names.
-        output_dir (str): location to write data for the segment, and location to store
-            xesmf weight files.
-        regrid_dir (str): location to save xesmf Regridders. Defaults to output_dir.
-        coords (xarray.Dataset): segment coordinates derived from hgrid
+        output_dir (str): location to write data for the segment.
+        regrid_dir (str): location of the cache of xesmf weights. Defaults to
+            the shared cache in workflow_tools.grid.WEIGHT_CACHE_DIR.
+        weights (WeightCache): cache of xesmf weights in regrid_dir.
+        fill_plans (dict): FillPlans for the patterns of missing points
+            seen on the segment, reused by fill_missing.
+        coords (xarray.Dataset): segment coordinates from geometry
             (lon, lat, angle relative to true north).
         nx (int): Number of data points in the x direction.
         ny (int): Number of data points in the y direction.
@@ -261,50 +467,23 @@ class Segment:
                  regrid_dir=None):
         self.num = num
         self.border = border
-        self.hgrid = hgrid.copy(deep=True)
-        if in_degrees:
-            self.hgrid['angle_dx'] = np.radians(self.hgrid['angle_dx'])
-        check_angle_range(self.hgrid['angle_dx'])
+        self.geometry = SegmentGeometry.from_hgrid(hgrid, border, in_degrees)
+        self.coords = self.geometry.to_dataset()
         self.segstr = f'segment_{self.num:03d}'
         self.output_dir = output_dir
 
+        self.regrid_dir = regrid_dir
         if regrid_dir is None:
-            self.regrid_dir = self.output_dir
+            self.weights = default_weight_cache()
         else:
-            self.regrid_dir = regrid_dir
-
-    @property
-    def coords(self):
-        if self.border == 'south':
-            return xarray.Dataset({
-                'lon': self.hgrid['x'].isel(nyp=0),
-                'lat': self.hgrid['y'].isel(nyp=0),
-                'angle': self.hgrid['angle_dx'].isel(nyp=0)
-            })
-        elif self.border == 'north':
-            return xarray.Dataset({
-                'lon': self.hgrid['x'].isel(nyp=-1),
-                'lat': self.hgrid['y'].isel(nyp=-1),
-                'angle': self.hgrid['angle_dx'].isel(nyp=-1)
-            })
-        elif self.border == 'west':
-            return xarray.Dataset({
-                'lon': self.hgrid['x'].isel(nxp=0),
-                'lat': self.hgrid['y'].isel(nxp=0),
-                'angle': self.hgrid['angle_dx'].isel(nxp=0)
-            })
-        elif self.border == 'east':
-            return xarray.Dataset({
-                'lon': self.hgrid['x'].isel(nxp=-1),
-                'lat': self.hgrid['y'].isel(nxp=-1),
-                'angle': self.hgrid['angle_dx'].isel(nxp=-1)
-            })
+            self.weights = WeightCache(Path(regrid_dir))
+        self.fill_plans = {}
 
     @property
     def nx(self):
         """Number of data points in the x-direction"""
         if self.border in ['south', 'north']:
-            return len(self.coords['lon'])
+            return len(self.geometry.lon)
         elif self.border in ['west', 'east']:
             return 1
 
@@ -314,9 +493,36 @@ class Segment:
         if self.border in ['south', 'north']:
             return 1
         elif self.border in ['west', 'east']:
-            return len(self.coords['lat'])
+            return len(self.geometry.lat)
+
+    def source_window(self, lon, lat, halo=8):
+        """Find the part of a regular source grid needed to regrid to the segment.
+
+        Args:
+            lon (xarray.DataArray): increasing 1D longitude of the source grid.
+            lat (xarray.DataArray): increasing 1D latitude of the source grid.
+            halo (int): number of extra source points to include on each side,
+                so that nearest-neighbor regridding and filling of missing
+                values near the segment still see the surrounding ocean.
+
+        Returns:
+            dict: slices for the lon and lat dimensions, to use with isel.
+        """
+        geometry = self.geometry
 
-    def to_netcdf(self, ds, varnames, suffix=None, additional_encoding=None):
+        def window(src, seg):
+            values = np.asarray(src)
+            start = np.searchsorted(values, float(seg.min()), side='right') - 1 - halo
+            stop = np.searchsorted(values, float(seg.max()), side='left') + 1 + halo
+            return slice(max(int(start), 0), min(int(stop), len(values)))
+
+        return {
+            lon.dims[0]: window(lon, geometry.lon),
+            lat.dims[0]: window(lat, geometry.lat),
+        }
+
+    def to_netcdf(self, ds, varnames, suffix=None, additional_encoding=None,
+                  yearly=False):
         """Write data for the segment to file.
 
         Args:
@@ -324,6 +530,9 @@ class Segment:
             varnames (str): Name to give the file (e.g. 'temp', 'salt').
             suffix (str, optional): Optional suffix to append to the filename
                 (before .nc). Defaults to None.
+            yearly (bool, optional): Instead of writing a new file, write the data
+                into the yearly files for the segment (see Segment.write_yearly).
+                suffix is ignored. Defaults to False.
         """
         for v in ds:
             ds[v].encoding['_FillValue']= 1.0e20
@@ -351,13 +560,116 @@ class Segment:
         if additional_encoding is not None:
             encoding.update(additional_encoding)
 
-        ds.to_netcdf(
-            path.join(self.output_dir, fname),
-            format='NETCDF3_64BIT',
-            engine='netcdf4',
-            encoding=encoding,
-            unlimited_dims='time'
-        )
+        if yearly:
+            # Set the calendar here since the yearly files are not
+            # post-processed like the monthly files are
+            if 'time' in encoding:
+                encoding['time'] = {'calendar': 'gregorian', **encoding['time']}
+            else:
+                ds['time'].encoding.setdefault('calendar', 'gregorian')
+            for year in np.unique(ds['time'].dt.year):
+                self.write_yearly(ds.sel(time=str(year)), varnames, encoding)
+            return
+
+        # Written a block of time at a time, following the dask chunks of ds
+        write_netcdf3(ds, path.join(self.output_dir, fname), encoding=encoding)
+
+    def yearly_file(self, varnames, year):
+        """Path to the yearly file for the segment (e.g. temp_001_2020.nc)."""
+        return Path(self.output_dir) / f'{varnames}_{self.num:03d}_{year}.nc'
+
+    def last_yearly_time(self, varnames, year):
+        """Time of the last record (before the padding) in a yearly file.
+
+        Returns:
+            pandas.Timestamp, or None if the file does not exist.
+        """
+        fname = self.yearly_file(varnames, year)
+        if not fname.exists():
+            return None
+        with xarray.open_dataset(fname) as ds:
+            return ds.indexes['time'][-2]
+
+    def write_yearly(self, ds, varnames, encoding=None):
+        """Write data for one year into the yearly file for the segment.
+
+        A yearly file has one padding record at each end around the records for
+        the year, so that the model can interpolate to the start and end of the
+        year. The time values in the file serve as the index of its records:
+        records in ds that are already in the file replace them, and new records
+        are appended, so an update only needs to write the newest data.
+        The padding records are then refreshed from the neighboring years, or
+        from the first and last days shifted by one day where those are missing.
+
+        Args:
+            ds (xarray.Dataset): Segment dataset with times in a single year.
+            varnames (str): Name to give the file (e.g. 'temp', 'salt').
+            encoding (dict, optional): Encoding used if the file is created.
+        """
+        year = int(ds['time'].dt.year[0])
+        fname = self.yearly_file(varnames, year)
+        if not fname.exists():
+            # Padding records are placeholders until they are updated below
+            write_netcdf3(
+                [ds.isel(time=[0]), ds, ds.isel(time=[-1])], fname, encoding=encoding
+            )
+        else:
+            with open_netcdf4(fname, 'a') as nc:
+                with NETCDF4_PYTHON_LOCK:
+                    nrec = len(nc.dimensions['time'])
+                    time = nc['time']
+                    existing = np.asarray(time[1:nrec - 1])
+                    units = time.units
+                    calendar = getattr(time, 'calendar', 'standard')
+                new = netCDF4.date2num(
+                    ds.indexes['time'].to_pydatetime(), units, calendar
+                )
+                # Records are whole hours or days apart, so times within half a
+                # unit (rather than a relative tolerance) are the same record.
+                # Appended records must follow on from the last one, so that a
+                # skipped month cannot leave a gap in the file.
+                step = _time_step(existing, new, units, calendar)
+                match = np.flatnonzero(np.isclose(existing, new[0], rtol=0, atol=0.5))
+                if len(match) > 0:
+                    start = match[0] + 1
+                elif np.isclose(new[0], existing[-1] + step, rtol=0, atol=0.5):
+                    # Append, in place of the last padding record
+                    start = nrec - 1
+                else:
+                    raise ValueError(
+                        f'Cannot write records starting at {ds["time"].values[0]} '
+                        f'into {fname}, which is neither a time in the file nor '
+                        'the time after its last record'
+                    )
+                stop = start + ds.sizes['time']
+                write_records(nc, ds, start=start)
+                if stop >= nrec - 1:
+                    write_records(nc, ds.isel(time=[-1]), start=stop)
+        for y in [year - 1, year, year + 1]:
+            if self.yearly_file(varnames, y).exists():
+                self._update_padding(varnames, y)
+
+    def _update_padding(self, varnames, year):
+        """Set the padding records at each end of a yearly file."""
+        fname = self.yearly_file(varnames, year)
+        with xarray.open_dataset(fname) as ds:
+            nrec = ds.sizes['time']
+            first = ds.isel(time=[1]).load()
+            last = ds.isel(time=[nrec - 2]).load()
+        prev = _last_day(self.yearly_file(varnames, year - 1))
+        if prev is not None and _is_end_of_year(prev):
+            start_pad = prev
+        else:
+            start_pad = _shift_days(first, -1)
+        next_file = self.yearly_file(varnames, year + 1)
+        if _is_end_of_year(last) and next_file.exists():
+            with xarray.open_dataset(next_file) as next_ds:
+                end_pad = next_ds.isel(time=[1]).load()
+        else:
+            end_pad = _shift_days(last, 1)
+        with open_netcdf4(fname, 'a') as nc:
+            write_records(nc, start_pad, start=0)
+            write_records(nc, end_pad, start=nrec - 1)
 
     def expand_dims(self, ds):
         """Add a length-1 dimension to the variables in a boundary dataset or array.
@@ -439,17 +751,17 @@ class Segment:
         """Add segment lat and lon coordinates to a dataset."""
         if self.border in ['south', 'north']:
             ds[f'lon_{self.segstr}'] = (
-                (f'nx_{self.segstr}', ), self.coords['lon'].data
+                (f'nx_{self.segstr}', ), self.geometry.lon
             )
             ds[f'lat_{self.segstr}'] = (
-                (f'nx_{self.segstr}', ), self.coords['lat'].data
+                (f'nx_{self.segstr}', ), self.geometry.lat
             )
         elif self.border in ['west', 'east']:
             ds[f'lon_{self.segstr}'] = (
-                (f'ny_{self.segstr}', ), self.coords['lon'].data
+                (f'ny_{self.segstr}', ), self.geometry.lon
             )
             ds[f'lat_{self.segstr}'] = (
-                (f'ny_{self.segstr}', ), self.coords['lat'].data
+                (f'ny_{self.segstr}', ), self.geometry.lat
             )
         return ds
 
@@ -487,34 +799,39 @@ class Segment:
             vsource = vsource.to_dataset()
 
         # Horizontally interpolate velocity to MOM boundary.
-        uregrid = reuse_regrid(
+        uregrid = self.weights.sparse(
             usource,
             self.coords,
             method=method,
             locstream_out=True,
             periodic=periodic,
-            filename=path.join(self.regrid_dir, f'regrid_{self.segstr}_u.nc'),
-            reuse_weights=True
         )
-        vregrid = reuse_regrid(
+        vregrid = self.weights.sparse(
             vsource,
             self.coords,
             method=method,
             locstream_out=True,
             periodic=periodic,
-            filename=path.join(self.regrid_dir, f'regrid_{self.segstr}_v.nc'),
-            reuse_weights=True
         )
 
-        if uvar is None:
-            udest = uregrid(usource)
-        else:
-            udest = uregrid(usource[uvar])
+        # Keep the coordinates, which may be variables
+        if uvar is not None:
+            usource = usource.drop_vars(
+                [v for v in usource.data_vars if v not in {uvar, 'lon', 'lat'}]
+            )
+        if vvar is not None:
+            vsource = vsource.drop_vars(
+                [v for v in vsource.data_vars if v not in {vvar, 'lon', 'lat'}]
+            )
 
-        if vvar is None:
-            vdest = vregrid(vsource)
+        if uregrid is vregrid and not set(usource.data_vars) & set(vsource.data_vars):
+            # Same source grid: regrid both components in one pass
+            uvdest = uregrid(xarray.merge([usource, vsource], compat='override'))
+            udest = uvdest[list(usource.data_vars)]
+            vdest = uvdest[list(vsource.data_vars)]
         else:
-            vdest = vregrid(vsource[vvar])
+            udest = uregrid(usource)
+            vdest = vregrid(vsource)
 
         # if lat and lon are variables in u/vsource, u/vdest will be dataset
         if isinstance(udest, xarray.Dataset):
@@ -528,18 +845,31 @@ class Segment:
 
         # Rotate velocities to be model-relative.
         if rotate:
-            if self.border in ['south', 'north']:
-                angle = self.coords['angle'].rename({'nxp': 'locations'})
-            elif self.border in ['west', 'east']:
-                angle = self.coords['angle'].rename({'nyp': 'locations'})
-            udest, vdest = rotate_uv(udest, vdest, angle)
+            cos, sin = self.geometry.rotation()
+            udest, vdest = rotate_uv(udest, vdest, cos=cos, sin=sin)
 
         ds_uv = xarray.Dataset({
             f'u_{self.segstr}': udest,
             f'v_{self.segstr}': vdest
         })
 
-        ds_uv = fill_missing(ds_uv, fill=fill)
+        return self.finish_velocity(ds_uv, write=write, fill=fill, **kwargs)
+
+    def finish_velocity(self, ds_uv, write=True, fill='b', **kwargs):
+        """Fill regridded (and rotated) velocity on the segment, add thickness
+        and coordinates, and (optionally) write to file.
+
+        Args:
+            ds_uv (xarray.Dataset): u_{segstr} and v_{segstr} along 'locations'.
+            write (bool, optional): Write the results to file. Defaults to True.
+            fill (str, optional): Method to use for filling data horizontally
+                (b for bfill or f for ffill).
+            **kwargs: additional keyword arguments passed to Segment.to_netcdf().
+
+        Returns:
+            xarray.Dataset: Dataset of boundary data for the segment.
+        """
+        ds_uv = fill_missing(ds_uv, fill=fill, plans=self.fill_plans)
 
         # If time is singular, it can be lost from the dimensions, so add it back.
         if 'time' not in ds_uv.dims:
@@ -558,8 +888,8 @@ class Segment:
 
         ds_uv = self.expand_dims(ds_uv)
 
-        ds_uv['lon'] = (('locations', ), self.coords['lon'].data)
-        ds_uv['lat'] = (('locations', ), self.coords['lat'].data)
+        ds_uv['lon'] = (('locations', ), self.geometry.lon)
+        ds_uv['lat'] = (('locations', ), self.geometry.lat)
 
         ds_uv = self.rename_dims(ds_uv)
 
@@ -572,7 +902,7 @@ class Segment:
             self, tsource,
             method='nearest_s2d', periodic=False, write=True,
             fill='b', xdim='lon', ydim='lat',
-            regrid_suffix='t', source_var=None, **kwargs):
+            source_var=None, **kwargs):
         """Regrid a tracer onto segment and (optionally) write to file.
 
         Args:
@@ -587,9 +917,6 @@ class Segment:
                 (b for bfill or f for ffill).
             xdim (str, optional): Name of the horizontal x dimension, defaults to 'lon'.
             ydim (str, optional): Name of the horizontal y dimension, defaults to 'lat'.
-            regrid_suffix (str, optional): Suffix to add to xesmf weight file name.
-                Useful when regridding multiple tracers from different datasets.
-                Defaults to 't'.
             source_var (str, optional): If tsource is a dataset, this is
                 the variable to regrid.
             **kwargs: additional keyword arguments passed to Segment.to_netcdf().
@@ -609,15 +936,12 @@ class Segment:
             tsource.name = name
             tsource = tsource.to_dataset()
 
-        regrid = reuse_regrid(
+        regrid = self.weights.sparse(
             tsource,
             self.coords,
             method=method,
             locstream_out=True,
             periodic=periodic,
-            filename=path.join(self.regrid_dir,
-                               f'regrid_{self.segstr}_{regrid_suffix}.nc'),
-            reuse_weights=True
         )
         tdest = regrid(tsource)
 
@@ -630,8 +954,25 @@ class Segment:
         xname = list(tdest.dims)[-1]
         tdest = tdest.rename({xname: 'locations'})
 
-        if 'z' in tsource.coords:
-            tdest = fill_missing(tdest, fill=fill)
+        return self.finish_tracer(tdest, name, write=write, fill=fill, **kwargs)
+
+    def finish_tracer(self, tdest, name, write=True, fill='b', **kwargs):
+        """Fill a regridded tracer on the segment, add thickness (if it has
+        depth) and coordinates, and (optionally) write to file.
+
+        Args:
+            tdest (xarray.Dataset): Tracer name along 'locations'.
+            name (str): Name of the tracer.
+            write (bool, optional): Write the results to file. Defaults to True.
+            fill (str, optional): Method to use for filling data horizontally
+                (b for bfill or f for ffill).
+            **kwargs: additional keyword arguments passed to Segment.to_netcdf().
+
+        Returns:
+            xarray.Dataset: Dataset of boundary data for the segment.
+        """
+        if 'z' in tdest.coords:
+            tdest = fill_missing(tdest, fill=fill, plans=self.fill_plans)
             # Need to transpose so that time is first,
             # so that it can be the unlimited dimension
             tdest = tdest.transpose('time', 'z', 'locations')
@@ -639,15 +980,17 @@ class Segment:
             tdest[f'dz_{name}_{self.segstr}'] = dz
             tdest['z'] = np.arange(len(tdest['z']))
         else:
-            tdest = fill_missing(tdest, zdim=None, fill=fill)
+            tdest = fill_missing(
+                tdest, zdim=None, fill=fill, plans=self.fill_plans
+            )
             # Need to transpose so that time is first,
             # so that it can be the unlimited dimension
             tdest = tdest.transpose('time', 'locations')
 
         tdest = self.expand_dims(tdest)
 
-        tdest['lon'] = (('locations', ), self.coords['lon'].data)
-        tdest['lat'] = (('locations', ), self.coords['lat'].data)
+        tdest['lon'] = (('locations', ), self.geometry.lon)
+        tdest['lat'] = (('locations', ), self.geometry.lat)
 
         tdest = self.rename_dims(tdest)
         tdest = tdest.rename({name: f'{name}_{self.segstr}'})
@@ -686,14 +1029,12 @@ class Segment:
             xarray.Dataset: Dataset of regridded boundary data.
         """
         # Horizontally interpolate elevation components
-        regrid = reuse_regrid(
+        regrid = self.weights.sparse(
             resource,
             self.coords,
             method=method,
             locstream_out=True,
             periodic=periodic,
-            filename=path.join(self.regrid_dir, f'regrid_{self.segstr}_tidal_elev.nc'),
-            reuse_weights=True
         )
         redest = regrid(resource)
         imdest = regrid(imsource)
@@ -727,8 +1068,8 @@ class Segment:
 
         ds_ap = self.expand_dims(ds_ap)
 
-        ds_ap['lon'] = (('locations', ), self.coords['lon'].data)
-        ds_ap['lat'] = (('locations', ), self.coords['lat'].data)
+        ds_ap['lon'] = (('locations', ), self.geometry.lon)
+        ds_ap['lat'] = (('locations', ), self.geometry.lat)
 
         ds_ap = self.rename_dims(ds_ap)
 
@@ -776,25 +1117,20 @@ class Segment:
         vimname = find_datavar(vimsource)
 
         logger.info('Setting up regridders')
-        regrid_u = reuse_regrid(
+        regrid_u = self.weights.sparse(
             uresource,
             self.coords,
             method=method,
             locstream_out=True,
             periodic=periodic,
-            filename=path.join(self.regrid_dir, f'regrid_{self.segstr}_tidal_u.nc'),
-            reuse_weights=True
         )
 
-        regrid_v = reuse_regrid(
+        regrid_v = self.weights.sparse(
             vresource,
             self.coords,
             method=method,
             locstream_out=True,
             periodic=periodic,
-            filename=path.join(
-                self.regrid_dir, f'regrid_{self.segstr}_tidal_v.nc'),
-            reuse_weights=True
         )
 
         logger.info('Regridding')
@@ -829,16 +1165,11 @@ class Segment:
         # and convert ellipse back to amplitude and phase.
         # There is probably a complicated trig identity for this? But
         # this works too.
-        if self.border in ['south', 'north']:
-            angle = self.coords['angle'].rename({'nxp': 'locations'})
-        elif self.border in ['west', 'east']:
-            angle = self.coords['angle'].rename({'nyp': 'locations'})
         SEMA, ECC, INC, PHA = ap2ep(ucplex, vcplex)  # noqa: N806
 
         # Rotate to the model grid by adjusting the inclination.
         # Requries that angle is in radians.
-        # INC is np array but angle is xarray
-        INC -= angle.data[np.newaxis, :]  # noqa: N806
+        INC -= self.geometry.angle[np.newaxis, :]  # noqa: N806
         ua, va, up, vp = ep2ap(SEMA, ECC, INC, PHA)
 
         ds_ap = xarray.Dataset({
@@ -859,8 +1190,8 @@ class Segment:
         ds_ap = fill_missing(ds_ap, zdim=None)
 
         ds_ap = self.expand_dims(ds_ap)
-        ds_ap['lon'] = (('locations', ), self.coords['lon'].data)
-        ds_ap['lat'] = (('locations', ), self.coords['lat'].data)
+        ds_ap['lon'] = (('locations', ), self.geometry.lon)
+        ds_ap['lat'] = (('locations', ), self.geometry.lat)
 
         ds_ap = self.rename_dims(ds_ap)
 
@@ -869,3 +1200,158 @@ class Segment:
             self.to_netcdf(ds_ap, 'tu', **kwargs)
 
         return ds_ap
+
+
+class BoundarySet:
+    """All of the segments of an open boundary, regridded together.
+
+    The points of the segments are joined into one locstream, so that data on a
+    source grid shared by the segments is regridded in one pass, and velocities
+    are rotated in one pass. The result is then split up for each segment to
+    fill and write. Data that is already split up by segment (such as strips of
+    the source grid near each segment) is regridded with each segment's weights
+    before being joined.
+
+    Attributes:
+        segments (list[Segment]): the segments, in the order they are joined.
+        weights (WeightCache): cache of xesmf weights of the first segment.
+        coords (xarray.Dataset): lon, lat and angle of all of the segments
+            along 'locations'.
+        cos, sin (xarray.DataArray): cos and sin of the angle of all of the
+            segments along 'locations'.
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.weights = segments[0].weights
+        parts = [
+            seg.coords.rename({seg.coords['lon'].dims[0]: 'locations'})
+            for seg in segments
+        ]
+        self.coords = xarray.concat(parts, dim='locations')
+        rotations = [seg.geometry.rotation() for seg in segments]
+        self.cos = xarray.concat([cos for cos, _ in rotations], dim='locations')
+        self.sin = xarray.concat([sin for _, sin in rotations], dim='locations')
+        ends = np.cumsum([p.sizes['locations'] for p in parts])
+        self._slices = [
+            slice(int(end - p.sizes['locations']), int(end))
+            for p, end in zip(parts, ends, strict=True)
+        ]
+
+    def _regrid(self, source, method, periodic):
+        """Regrid a source shared by the segments, or a list of sources
+        (one for each segment), to the joined segments."""
+        if isinstance(source, list):
+            parts = []
+            for seg, src in zip(self.segments, source, strict=True):
+                regrid = seg.weights.sparse(
+                    src,
+                    seg.coords,
+                    method=method,
+                    locstream_out=True,
+                    periodic=periodic,
+                )
+                parts.append(regrid(src))
+            return xarray.concat(parts, dim='locations')
+        regrid = self.weights.sparse(
+            source,
+            self.coords,
+            method=method,
+            locstream_out=True,
+            periodic=periodic,
+        )
+        return regrid(source)
+
+    def regrid_velocity(
+            self, usource, vsource, *,
+            method='nearest_s2d', periodic=False, write=True,
+            fill='b', rotate=True, **kwargs):
+        """Interpolate velocity onto every segment and (optionally) write to file.
+
+        Args:
+            usource (xarray.DataArray or list): Earth-relative u velocity on
+                source grid, or a list with one for each segment.
+            vsource (xarray.DataArray or list): Earth-relative v velocity on
+                source grid, or a list with one for each segment.
+            method (str, optional): Method recognized by xesmf to use to regrid.
+                Defaults to 'nearest_s2d'.
+            periodic (bool, optional): Whether the source grid is periodic
+                (passed to xesmf). Defaults to False.
+            write (bool, optional): After regridding, write the results to file.
+                Defaults to True.
+            fill (str, optional): Method to use for filling data horizontally
+                (b for bfill or f for ffill).
+            rotate(bool, optional): Rotate to the model grid, assuming input is
+                on earth grid.
+            **kwargs: additional keyword arguments passed to Segment.to_netcdf().
+
+        Returns:
+            list[xarray.Dataset]: Dataset of boundary data for each segment.
+        """
+        def merge(u, v):
+            return xarray.merge(
+                [u.to_dataset(name='u'), v.to_dataset(name='v')], compat='override'
+            )
+
+        if isinstance(usource, list):
+            source = [merge(u, v) for u, v in zip(usource, vsource, strict=True)]
+        else:
+            source = merge(usource, vsource)
+        uvdest = self._regrid(source, method, periodic)
+        udest, vdest = uvdest['u'], uvdest['v']
+
+        # Rotate velocities to be model-relative.
+        if rotate:
+            udest, vdest = rotate_uv(udest, vdest, cos=self.cos, sin=self.sin)
+
+        return [
+            seg.finish_velocity(
+                xarray.Dataset({
+                    f'u_{seg.segstr}': udest.isel(locations=part),
+                    f'v_{seg.segstr}': vdest.isel(locations=part)
+                }),
+                write=write,
+                fill=fill,
+                **kwargs
+            )
+            for seg, part in zip(self.segments, self._slices, strict=True)
+        ]
+
+    def regrid_tracer(
+            self, tsource, *,
+            method='nearest_s2d', periodic=False, write=True,
+            fill='b', **kwargs):
+        """Regrid a tracer onto every segment and (optionally) write to file.
+
+        Args:
+            tsource (xarray.DataArray or list): Tracer data on source grid,
+                or a list with one for each segment.
+            method (str, optional): Method recognized by xesmf to use to regrid.
+                Defaults to 'nearest_s2d'.
+            periodic (bool, optional): Whether the source grid is periodic
+                (passed to xesmf). Defaults to False.
+            write (bool, optional): After regridding, write the results to file.
+                Defaults to True.
+            fill (str, optional): Method to use for filling data horizontally
+                (b for bfill or f for ffill).
+            **kwargs: additional keyword arguments passed to Segment.to_netcdf().
+
+        Returns:
+            list[xarray.Dataset]: Dataset of boundary data for each segment.
+        """
+        if isinstance(tsource, list):
+            name = tsource[0].name
+            source = [t.to_dataset(name=name) for t in tsource]
+        else:
+            name = tsource.name
+            source = tsource.to_dataset(name=name)
+        tdest = self._regrid(source, method, periodic).drop_vars(
+            ['lon', 'lat'], errors='ignore'
+        )
+
+        return [
+            seg.finish_tracer(
+                tdest.isel(locations=part), name, write=write, fill=fill, **kwargs
+            )
+            for seg, part in zip(self.segments, self._slices, strict=True)
+        ]
@@ -2,7 +2,7 @@ from pathlib import Path
 
 from loguru import logger
 
-from workflow_tools.utils import run_cmd
+from workflow_tools.netcdf3 import RecordRange, concat_records
 
 
 def main(year: int, input_dir: Path, output_dir: Path, n_segments: int) -> None:
@@ -11,22 +11,6 @@ def main(year: int, input_dir: Path, output_dir: Path, n_segments: int) -> None:
         for seg in range(1, n_segments + 1):
             logger.trace('Segment {seg:03d}', seg=seg)
             available_months = []
-            # Search for December of the previous year to use
-            # to pad the beginning of the yearly file.
-            # If not found, roll the time of the first day back by one.
-            prev_month = input_dir / f'{var}_{seg:03d}_{year - 1}-12.nc'
-            if prev_month.exists():
-                tail_file = prev_month.with_suffix('.tail.nc')
-                run_cmd(f'ncks {prev_month} -d time,-1,-1 -O {tail_file}')
-            else:
-                logger.info('Padding with first time')
-                first_file = input_dir / f'{var}_{seg:03d}_{year}-01.nc'
-                tail_file = first_file.with_suffix('.tail.nc')
-                # Pick out the first time from the first month.
-                run_cmd(f'ncks {first_file} -d time,0,0 -O {tail_file}')
-                # Pad by subtracting one day from the time.
-                run_cmd(f'ncap2 -s "time-=24" {tail_file} -O {tail_file}')
-            available_months.append(tail_file)
             # Search for the months of this year, stopping
             # if one month is not found.
             for mon in range(1, 13):
@@ -35,34 +19,37 @@ def main(year: int, input_dir: Path, output_dir: Path, n_segments: int) -> None:
                     available_months.append(expected_file)
                 else:
                     break
-            if len(available_months) < 2:  # end of prev year plus this year
+            if len(available_months) == 0:
                 raise Exception('Did not find data')
-            # Search for January of the next year to use
+            records = [RecordRange(f) for f in available_months]
+            # Use the last day of December of the previous year
+            # to pad the beginning of the yearly file.
+            # If not found, roll the time of the first day back by one.
+            prev_month = input_dir / f'{var}_{seg:03d}_{year - 1}-12.nc'
+            if prev_month.exists():
+                records.insert(0, RecordRange(prev_month, start=-1, count=1))
+            else:
+                logger.info('Padding with first time')
+                records.insert(
+                    0, RecordRange(available_months[0], count=1, shift_days=-1)
+                )
+            # Use the first day of January of the next year
             # to pad the end of the yearly file.
             # If not found, roll the time of the last day forward by one.
             next_month = input_dir / f'{var}_{seg:03d}_{year + 1}-01.nc'
-            if len(available_months) == 13 and next_month.exists():
-                head_file = next_month.with_suffix('.head.nc')
-                run_cmd(f'ncks {next_month} -d time,0,0 -O {head_file}')
+            if len(available_months) == 12 and next_month.exists():
+                records.append(RecordRange(next_month, count=1))
             else:
                 logger.info('Padding with last time')
-                last_file = available_months[-1]
-                head_file = last_file.with_suffix('.head.nc')
-                # Pick out the first time from the first month.
-                run_cmd(f'ncks {last_file} -d time,-1,-1 -O {head_file}')
-                # Pad by subtracting one day from the time.
-                run_cmd(f'ncap2 -s "time+=24" {head_file} -O {head_file}')
-            available_months.append(head_file)
+                records.append(
+                    RecordRange(available_months[-1], start=-1, shift_days=1)
+                )
             output_file = output_dir / f'{var}_{seg:03d}_{year}.nc'
-            cmd = f'ncrcat {" ".join(map(str, available_months))} -O {output_file}'
-            run_cmd(cmd)
-            # TODO: proleptic_gregorian attribute carries over because of setting
-            # the time units when extracting.
-            # Fix it here for now.
-            # Also, time is an int but this could be ok since it's not int64.
-            run_cmd(f'ncatted -a calendar,time,o,c,gregorian -O {output_file}')
-            tail_file.unlink()
-            head_file.unlink()
+            # The records are copied without decoding them. The time of the
+            # padding records is shifted, and the calendar is set to gregorian
+            # (proleptic_gregorian carries over from setting the time units
+            # when the monthly files were written).
+            concat_records(records, output_file, calendar='gregorian')
 
 
 if __name__ == '__main__':
@@ -1,108 +1,26 @@
 from calendar import monthrange
+from collections.abc import Callable, Iterator
 from concurrent import futures
+from contextlib import contextmanager
 from functools import partial
 from pathlib import Path
+from threading import Condition, Lock
 
+import numpy as np
 import xarray
-from boundary import Segment
+from boundary import BoundarySet, Segment
 from loguru import logger
 
-from workflow_tools.grid import round_coords
-from workflow_tools.io import HSMGet
+from workflow_tools.glorys import GlorysCatalog
+from workflow_tools.grid import fill_nearest, fill_nearest_window, round_coords
+from workflow_tools.io import HSMGet, atomic_path
+from workflow_tools.pipeline import Stage, run_pipeline
 from workflow_tools.utils import run_cmd
 
 hsmget = HSMGet(archive=Path('/archive/uda'))
 TMP = hsmget.tmp
 
 
-def find_best_files(
-    year: int,
-    mon: int,
-    var: str,
-    reanalysis_path: Path,
-    analysis_path: Path
-) -> list[Path]:
-    if var == 'uv':
-        # For velocity, find the individual components separately.
-        # Since u and v are in the same file for the analysis,
-        # analysis files will be duplicated; remove them.
-        files = find_best_files(year, mon, 'uo', reanalysis_path, analysis_path)
-        files += find_best_files(year, mon, 'vo', reanalysis_path, analysis_path)
-        files = sorted(set(files))
-    else:
-        # Use reanalysis files when they are available,
-        # and find and use the analysis files when not.
-        files = []
-        for day in range(1, monthrange(year, mon)[1] + 1):
-            # Search for reanalysis file for the day.
-            # If there are multiple files with different R* for the day,
-            # choose the last one by sorted order.
-            reanalysis_file = sorted(
-                (reanalysis_path / var / str(year)).glob(
-                    f'*_{year}{mon:02d}{day:02d}_R????????.nc'
-                )
-            )
-            if len(reanalysis_file) > 0:
-                files.append(reanalysis_file[-1])
-            else:
-                # The variable naming for the analysis is complicated.
-                # Assuming that the 202406 in
-                # cmems_mod_glo_phy_anfc_0.083deg_P1D-m_202406 will never change.
-                # The ???? before _R* could be hcst or nwct or fcst.
-                # Currently there is no checking if both are matched;
-                # the last one by sorted order will be returned.
-                if var == 'zos':
-                    # Path like:
-                    # /archive/uda/CEFI/GLOBAL_ANALYSISFORECAST_PHY_001_024/
-                    # cmems_mod_glo_phy_anfc_0.083deg_P1D-m_202406/2024/09/
-                    # glo12_rg_1d-m_20240920-20240920_2D_hcst_R20241002.nc
-                    analysis_file = sorted(
-                        (
-                            analysis_path
-                            / 'cmems_mod_glo_phy_anfc_0.083deg_P1D-m_202406'
-                            / str(year)
-                            / f'{mon:02d}'
-                        ).glob(
-                            f'glo12_rg_1d-m_{year}{mon:02d}{day:02d}-{year}{mon:02d}{day:02d}_2D_????_R*.nc'
-                        )
-                    )
-                elif var in ['thetao', 'so']:
-                    analysis_file = sorted(
-                        (
-                            analysis_path
-                            / f'cmems_mod_glo_phy-{var}_anfc_0.083deg_P1D-m_202406'
-                            / str(year)
-                            / f'{mon:02d}'
-                        ).glob(
-                            f'glo12_rg_1d-m_{year}{mon:02d}{day:02d}-{year}{mon:02d}{day:02d}_3D-{var}_????_R*.nc'
-                        )
-                    )
-                elif var in ['uo', 'vo']:
-                    # Path like:
-                    # /archive/uda/CEFI/GLOBAL_ANALYSISFORECAST_PHY_001_024/
-                    # cmems_mod_glo_phy-cur_anfc_0.083deg_P1D-m_202406/2024/09/
-                    # glo12_rg_1d-m_20240920-20240920_3D-uovo_hcst_R20241002.nc
-                    analysis_file = sorted(
-                        (
-                            analysis_path
-                            / 'cmems_mod_glo_phy-cur_anfc_0.083deg_P1D-m_202406'
-                            / str(year)
-                            / f'{mon:02d}'
-                        ).glob(
-                            f'glo12_rg_1d-m_{year}{mon:02d}{day:02d}-{year}{mon:02d}{day:02d}_3D-uovo_????_R*.nc'
-                        )
-                    )
-                else:
-                    raise Exception('Unknown variable')
-                if len(analysis_file) > 0:
-                    files.append(analysis_file[-1])
-                else:
-                    logger.error(
-                        f'Did not a find a file for {year}-{mon:02d}-{day:02d} {var}'
-                    )
-    return files
-
-
 def thread_worker(
     in_file: Path,
     out_dir: Path,
@@ -128,112 +46,420 @@ def thread_worker(
     return out_file
 
 
+def _box_window(
+    lon: xarray.DataArray,
+    lat: xarray.DataArray,
+    lon_lat_box: tuple[float, float, float, float]
+) -> dict[str, slice]:
+    """
+    Slices for the points inside lon_lat_box (like cdo sellonlatbox).
+    """
+    lonmin, lonmax, latmin, latmax = lon_lat_box
+
+    def window(src, lo, hi):
+        values = np.asarray(src)
+        return slice(
+            int(np.searchsorted(values, lo, side='left')),
+            int(np.searchsorted(values, hi, side='right')),
+        )
+
+    return {
+        lon.dims[0]: window(lon, lonmin, lonmax),
+        lat.dims[0]: window(lat, latmin, latmax),
+    }
+
+
+def _union(windows: list[dict[str, slice]]) -> dict[str, slice]:
+    return {
+        dim: slice(
+            min(w[dim].start for w in windows), max(w[dim].stop for w in windows)
+        )
+        for dim in windows[0]
+    }
+
+
+def _relative(window: dict[str, slice], outer: dict[str, slice]) -> dict[str, slice]:
+    return {
+        dim: slice(s.start - outer[dim].start, s.stop - outer[dim].start)
+        for dim, s in window.items()
+    }
+
+
+class MonthlyMean:
+    """
+    Mean over time of daily data added one file at a time, ignoring missing
+    values (like cdo timavg). The mean is stamped with the middle time.
+    """
+
+    def __init__(self):
+        self.total = None
+        self.count = None
+        self.times = []
+        self._lock = Lock()
+
+    def add(self, ds: xarray.Dataset) -> None:
+        total = ds.astype('float64').sum('time', keep_attrs=True)
+        count = ds.count('time')
+        with self._lock:
+            self.times.extend(ds['time'].values)
+            if self.total is None:
+                self.total, self.count = total, count
+            else:
+                self.total = self.total + total
+                self.count = self.count + count
+
+    def result(self) -> xarray.Dataset:
+        mean = (self.total / self.count).where(self.count > 0)
+        for v in mean.data_vars:
+            mean[v] = mean[v].astype('float32')
+            mean[v].attrs = self.total[v].attrs
+        times = sorted(self.times)
+        return mean.expand_dims(time=[times[len(times) // 2]])
+
+
+def read_month(
+    staged: list[futures.Future[Path]],
+    variables: list[str],
+    segments: list[Segment],
+    halo: int,
+    threads: int,
+    *,
+    mean: MonthlyMean | None = None,
+    lon_lat_box: tuple[float, float, float, float] | None = None
+) -> list[xarray.Dataset]:
+    """
+    Read only the part of each file near each segment (the same levels as the
+    cdo subsetting), with missing values filled with the nearest valid value.
+    Each file is read as soon as hsmget has copied it.
+    If mean is given, the part of each file inside lon_lat_box is read too,
+    in the same read as the segments, and added to the mean,
+    so that the data for the sponge is not decoded a second time.
+    Returns one dataset per segment.
+    """
+    def read(f: Path) -> list[xarray.Dataset]:
+        with xarray.open_dataset(f) as src:
+            ds = round_coords(src[[v for v in variables if v in src]], to=12)
+            if 'depth' in ds.dims:
+                ds = ds.isel(depth=slice(0, 49))
+            lon, lat = ds['longitude'], ds['latitude']
+            windows = [seg.source_window(lon, lat, halo=halo) for seg in segments]
+            if lon_lat_box is None:
+                box = {dim: slice(0, size) for dim, size in ds.sizes.items()
+                       if dim in {'longitude', 'latitude'}}
+            else:
+                box = _box_window(lon, lat, lon_lat_box)
+            outer = _union([*windows, box])
+            data = ds.isel(outer)
+            if mean is not None:
+                data = data.load()
+                mean.add(data.isel(_relative(box, outer)))
+            # Only levels with no valid points near a strip are read from the
+            # whole box, which is where cdo setmisstonn filled from
+            return [
+                xarray.Dataset({
+                    v: fill_nearest_window(
+                        data[v], _relative(w, outer), 'longitude', 'latitude'
+                    )
+                    for v in data.data_vars
+                })
+                for w in windows
+            ]
+
+    with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        reading = [
+            executor.submit(read, f.result()) for f in futures.as_completed(staged)
+        ]
+        per_file = [f.result() for f in reading]
+
+    datasets = []
+    for i, _ in enumerate(segments):
+        parts = [strips[i] for strips in per_file]
+        ds = xarray.merge([
+            xarray.concat([p[v] for p in parts if v in p], dim='time').sortby('time')
+            for v in variables
+        ])
+        ds = ds.rename({'latitude': 'lat', 'longitude': 'lon'})
+        if 'depth' in ds.coords:
+            ds = ds.rename({'depth': 'z'})
+        datasets.append(ds)
+    return datasets
+
+
+def write_sponge_mean(mean: MonthlyMean, fout: Path) -> None:
+    """
+    Write the monthly mean for write_nudging_data.py, with missing values
+    filled with the nearest valid value. Filling after averaging gives the
+    same result as filling each day, because the land mask does not change.
+    """
+    ds = mean.result()
+    for v in ds.data_vars:
+        ds[v] = fill_nearest(ds[v], 'longitude', 'latitude')
+    with atomic_path(fout) as tmp:
+        ds.to_netcdf(tmp)
+
+
+def first_month_to_update(year: int, var: str, segments: list[Segment]) -> int:
+    """
+    Earliest month, across variables and segments, that has not been
+    written to the yearly files or may have been written only in part.
+    """
+    variables = ['so', 'thetao', 'uv', 'zos'] if var == 'all' else [var]
+    months = []
+    for v in variables:
+        for seg in segments:
+            last = seg.last_yearly_time(v, year)
+            if last is None:
+                return 1
+            months.append(last.month)
+    return min(months)
+
+
+def write_month(
+    year: int,
+    m: int,
+    v: str,
+    staged: list[futures.Future[Path]],
+    *,
+    boundary: BoundarySet,
+    lon_lat_box: tuple[float, float, float, float],
+    threads: int,
+    halo: int,
+    full_box: bool,
+    sponge_dir: Path | None,
+    yearly: bool,
+    wait: Callable[[], None] | None = None,
+) -> None:
+    """
+    Regrid and write the boundary data for one variable and month
+    (and the sponge mean for so and thetao) from the staged files.
+    wait, if given, is called before writing to the segment files.
+    """
+    logger.info(f'{year}-{m:02d} {v}')
+    # Monthly means of temperature and salinity for the sponge
+    sponge_file = None
+    if sponge_dir is not None and v in ['so', 'thetao']:
+        sponge_file = sponge_dir / f'glorys_{v}_{year}-{m:02d}.nc'
+    processed_files = []
+    if full_box:
+        # Subset each day with cdo as soon as hsmget has copied it
+        with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            processing = [
+                executor.submit(
+                    thread_worker,
+                    f.result(),
+                    out_dir=TMP,
+                    lon_lat_box=lon_lat_box,
+                )
+                for f in futures.as_completed(staged)
+            ]
+            processed_files = sorted(f.result() for f in processing)
+        if sponge_file is not None:
+            file_strs = " ".join(x.as_posix() for x in processed_files)
+            run_cmd(
+                f'cdo timavg -cat {file_strs} {sponge_file.as_posix()}',
+                escape=True
+            )
+        ds = xarray.open_mfdataset(
+            processed_files, preprocess=partial(round_coords, to=12)
+        ).rename({'latitude': 'lat', 'longitude': 'lon'})
+        if 'depth' in ds.coords:
+            ds = ds.rename({'depth': 'z'})
+
+        # The box is shared by the segments
+        def source(name: str) -> xarray.DataArray | list[xarray.DataArray]:
+            return ds[name]
+    else:
+        mean = None if sponge_file is None else MonthlyMean()
+        datasets = read_month(
+            staged,
+            ['uo', 'vo'] if v == 'uv' else [v],
+            boundary.segments,
+            halo,
+            threads,
+            mean=mean,
+            lon_lat_box=lon_lat_box,
+        )
+        if mean is not None:
+            write_sponge_mean(mean, sponge_file)
+
+        # One strip for each segment
+        def source(name: str) -> xarray.DataArray | list[xarray.DataArray]:
+            return [ds[name] for ds in datasets]
+    if wait is not None:
+        wait()
+    encoding = {'time': {'units': 'hours since 1990-01-01 00:00:00'}}
+    if v == 'uv':
+        boundary.regrid_velocity(
+            source('uo'),
+            source('vo'),
+            suffix=f'{year}-{m:02d}',
+            additional_encoding=encoding,
+            yearly=yearly,
+        )
+    else:
+        boundary.regrid_tracer(
+            source(v),
+            suffix=f'{year}-{m:02d}',
+            additional_encoding=encoding,
+            yearly=yearly,
+        )
+    for f in processed_files:
+        f.unlink()
+
+
+class MonthOrder:
+    """
+    Lets units of work write in month order for each variable, since the
+    yearly files are appended to. A unit that comes after a failed one
+    for the same variable fails too, rather than leaving a gap in the file.
+    """
+
+    def __init__(self, first_month: int):
+        self.first_month = first_month
+        self._next: dict[str, int] = {}
+        self._failed: set[str] = set()
+        self._cond = Condition()
+
+    def _finish(self, var: str, mon: int, ok: bool) -> None:
+        with self._cond:
+            if not ok:
+                self._failed.add(var)
+            self._next[var] = mon + 1
+            self._cond.notify_all()
+
+    def fail(self, var: str, mon: int) -> None:
+        """
+        Mark a unit as failed before it got to turn.
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._next.get(var, self.first_month) >= mon
+            )
+        self._finish(var, mon, ok=False)
+
+    @contextmanager
+    def turn(self, var: str, mon: int) -> Iterator[Callable[[], None]]:
+        """
+        Context for one unit, yielding a function that blocks until the
+        previous month of var has been written. Leaving the context
+        lets the next month go ahead.
+        """
+        def wait() -> None:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._next.get(var, self.first_month) >= mon
+                )
+                if var in self._failed:
+                    raise RuntimeError(
+                        f'Not writing {var} for month {mon} '
+                        'because an earlier month failed'
+                    )
+
+        ok = False
+        try:
+            yield wait
+            ok = True
+        finally:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._next.get(var, self.first_month) >= mon
+                )
+            self._finish(var, mon, ok)
+
+
 def main(
     year: int,
     mon: int,
     var: str,
     threads: int,
-    analysis_path: Path,
-    reanalysis_path: Path,
+    catalog: GlorysCatalog,
     lon_lat_box: tuple[float, float, float, float],
     segments: list[Segment],
+    *,
+    sponge_dir: Path | None = None,
     update: bool = False,
     dry: bool = False,
+    yearly: bool = False,
+    full_box: bool = False,
+    halo: int = 8,
+    workers: int = 2,
 ):
+    """
+    Write the boundary data for each (month, variable) unit of work.
+    Up to workers units are processed at once, and the files for the next
+    unit are copied from archive while the current ones are processed.
+    """
     if mon == 'all' or update:
         last_month = 12 if mon == 'all' else int(mon)
-        for m in range(1, last_month + 1):
-            logger.trace(m)
-            main(
-                year,
-                m,
-                var,
-                threads,
-                analysis_path,
-                reanalysis_path,
-                lon_lat_box,
-                segments,
-                dry=dry,
-            )
+        # The yearly files only need the months from the last one written
+        first_month = 1
+        if update and yearly:
+            first_month = min(first_month_to_update(year, var, segments), last_month)
+        months = list(range(first_month, last_month + 1))
     else:
-        mon = int(mon)
-        if var == 'all':
-            for v in ['so', 'thetao', 'uv', 'zos']:
-                main(
-                    year,
-                    mon,
-                    v,
-                    threads,
-                    analysis_path,
-                    reanalysis_path,
-                    lon_lat_box,
-                    segments,
-                    dry=dry,
-                )
+        months = [int(mon)]
+    variables = ['so', 'thetao', 'uv', 'zos'] if var == 'all' else [var]
+    units = [(m, v) for m in months for v in variables]
+
+    if dry:
+        for m, v in units:
+            files = catalog.files(year, m, v)
+            logger.info(f'{year}-{m:02d} {v}: found {len(files)} files')
+            for f in files:
+                logger.info(f.as_posix())
+        return
+
+    order = MonthOrder(months[0]) if yearly else None
+    boundary = BoundarySet(segments)
+
+    def stage(unit: tuple[int, str]) -> tuple[int, str, list[futures.Future[Path]]]:
+        m, v = unit
+        try:
+            files = catalog.files(year, m, v)
+            # Make sure that data was found for every day of the month.
+            n_expected = monthrange(year, m)[1]
+            if len(files) != n_expected:
+                logger.warning(f'Number of files found ({len(files)}) is not '
+                               f'the same as expected ({n_expected})')
+            return m, v, hsmget.submit(files)
+        except Exception:
+            if order is not None:
+                order.fail(v, m)
+            raise
+
+    def process(unit: tuple[int, str, list[futures.Future[Path]]]) -> None:
+        m, v, staged = unit
+        write = partial(
+            write_month,
+            year,
+            m,
+            v,
+            staged,
+            boundary=boundary,
+            lon_lat_box=lon_lat_box,
+            threads=threads,
+            halo=halo,
+            full_box=full_box,
+            sponge_dir=sponge_dir,
+            yearly=yearly,
+        )
+        if order is None:
+            write()
         else:
-            logger.info(var)
-            files = find_best_files(
-                year,
-                mon,
-                var,
-                analysis_path=analysis_path,
-                reanalysis_path=reanalysis_path,
-            )
-            if dry:
-                logger.info(f'Found {len(files)} files')
-                for f in files:
-                    logger.info(f.as_posix())
-            else:
-                # Make sure that data was found for every day of the month.
-                n_expected = monthrange(year, mon)[1]
-                if len(files) != n_expected:
-                    logger.warning(f'Number of files found ({len(files)}) is not '
-                                   'the same as expected ({n_expected})')
-                copied_files = hsmget(files)
-
-                with futures.ThreadPoolExecutor(max_workers=threads) as executor:
-                    processed_files = sorted(
-                        executor.map(
-                            partial(
-                                thread_worker, out_dir=TMP, lon_lat_box=lon_lat_box
-                            ),
-                            copied_files,
-                        )
-                    )
+            with order.turn(v, m) as wait:
+                write(wait=wait)
+
+    # The staging queue holds the units whose files are being copied
+    # while the workers process the ones before them
+    run_pipeline(
+        units,
+        [
+            Stage('stage', stage),
+            Stage('process', process, workers=workers, queue_depth=1),
+        ],
+    )
+    logger.info(f'Regridding weights: {boundary.weights.stats}')
 
-                # Save data for use with sponge. TODO: config output path
-                if var in ['so', 'thetao']:
-                    file_strs = " ".join(x.as_posix() for x in processed_files)
-                    run_cmd(
-                        f'cdo timavg -cat {file_strs} '
-                        f'/work/acr/mom6/nwa12/analysis_input_data/sponge/monthly_filled/glorys_{var}_{year}-{mon:02d}.nc',
-                        escape=True
-                    )
-                ds = xarray.open_mfdataset(
-                    processed_files, preprocess=partial(round_coords, to=12)
-                ).rename({'latitude': 'lat', 'longitude': 'lon'})
-                if 'depth' in ds.coords:
-                    ds = ds.rename({'depth': 'z'})
-                for seg in segments:
-                    if var == 'uv':
-                        seg.regrid_velocity(
-                            ds['uo'],
-                            ds['vo'],
-                            suffix=f'{year}-{mon:02d}',
-                            additional_encoding={
-                                'time': {'units': 'hours since 1990-01-01 00:00:00'}
-                            },
-                        )
-                    else:
-                        seg.regrid_tracer(
-                            ds[var],
-                            suffix=f'{year}-{mon:02d}',
-                            additional_encoding={
-                                'time': {'units': 'hours since 1990-01-01 00:00:00'}
-                            },
-                        )
-                for f in processed_files:
-                    f.unlink()
 
 if __name__ == '__main__':
     import argparse
@@ -258,24 +484,64 @@ if __name__ == '__main__':
         action='store_true',
         help='Dry run: print out the files that would be worked on.',
     )
+    parser.add_argument(
+        '-Y',
+        '--yearly',
+        action='store_true',
+        help='Write into the yearly files directly instead of monthly files '
+        '(no need to run concat_boundary_reanalysis.py afterwards). '
+        'With --update, only the months from the last one written on are rerun.',
+    )
+    parser.add_argument(
+        '--full-box',
+        action='store_true',
+        help='Subset the whole domain with cdo and regrid from it, '
+        'instead of reading only the data near each segment.',
+    )
+    parser.add_argument(
+        '--halo',
+        type=int,
+        default=8,
+        help='Number of extra source points to read around each segment.',
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=2,
+        help='Number of (month, variable) units to process at once. '
+        'Each unit reads with --threads threads.',
+    )
     args = parser.parse_args()
     config = load_config(args.config)
     dom = config.domain
     hgrid = xarray.open_dataset(dom.hgrid_file)
     output_dir = config.filesystem.nowcast_input_data/ 'boundary' / 'monthly'
+    if args.yearly:
+        output_dir = output_dir.parents[0]
     segments = [
         Segment(num, edge, hgrid, output_dir=output_dir)
         for num, edge in dom.boundaries.items()
     ]
+    # Monthly means for write_nudging_data.py
+    sponge_dir = config.filesystem.nowcast_input_data / 'sponge' / 'monthly_filled'
+    sponge_dir.mkdir(parents=True, exist_ok=True)
     main(
         args.year,
         args.month,
         args.var,
         args.threads,
         segments=segments,
+        sponge_dir=sponge_dir,
         lon_lat_box=(dom.west_lon, dom.east_lon, dom.south_lat, dom.north_lat),
-        reanalysis_path=config.filesystem.interim_data.GLORYS_reanalysis,
-        analysis_path=config.filesystem.interim_data.GLORYS_analysis,
+        catalog=GlorysCatalog(
+            reanalysis_path=config.filesystem.interim_data.GLORYS_reanalysis,
+            analysis_path=config.filesystem.interim_data.GLORYS_analysis,
+        ),
         update=args.update,
         dry=args.dry,
+        yearly=args.yearly,
+        full_box=args.full_box,
+        halo=args.halo,
+        workers=args.workers,
     )
@@ -1,4 +1,3 @@
-import os
 from functools import partial
 from pathlib import Path
 
@@ -8,7 +7,7 @@ import xarray
 from loguru import logger
 from numpy.lib.stride_tricks import sliding_window_view
 
-from workflow_tools.grid import center_to_outer, reuse_regrid, round_coords
+from workflow_tools.grid import center_to_outer, default_weight_cache, round_coords
 from workflow_tools.utils import XarrayData, flatten
 
 
@@ -100,7 +99,7 @@ def regrid_runoff(  # noqa: PLR0915
     glofas_kg = glofas * 1000.0 / glofas_area
 
     # Conservatively interpolate runoff onto MOM grid
-    glofas_to_mom_con = reuse_regrid(
+    glofas_to_mom_con = default_weight_cache().sparse(
         {
             'lon': glofas.lon,
             'lat': glofas.lat,
@@ -110,8 +109,6 @@ def regrid_runoff(  # noqa: PLR0915
         {'lat': lat, 'lon': lon, 'lat_b': latb, 'lon_b': lonb},
         method='conservative',
         periodic=True,
-        reuse_weights=True,
-        filename=os.path.join(os.environ['TMPDIR'], 'glofas_to_mom.nc'),
     )
     # Interpolate only from GloFAS points that are river end points.
     glofas_regridded = glofas_to_mom_con(glofas_kg.where(glofas_mask > 0).fillna(0.0))
@@ -162,13 +159,11 @@ def regrid_runoff(  # noqa: PLR0915
 
     # Use xesmf to find the index of the nearest coastal cell
     # for every grid cell in the MOM domain
-    coast_to_mom = reuse_regrid(
+    coast_to_mom = default_weight_cache().sparse(
         {'lat': coast_lat, 'lon': coast_lon},
         {'lat': lat, 'lon': lon},
         method='nearest_s2d',
         locstream_in=True,
-        reuse_weights=True,
-        filename=os.path.join(os.environ['TMPDIR'], 'coast_to_mom.nc'),
     )
     coast_id = mom_id[flat_mask]
     nearest_coast = coast_to_mom(coast_id)
@@ -2,9 +2,8 @@ from pathlib import Path
 
 import pandas as pd
 import xarray
-from xesmf import Regridder
 
-from workflow_tools.grid import round_coords
+from workflow_tools.grid import default_weight_cache, round_coords
 
 VARIABLES = ['thetao', 'so']
 
@@ -51,14 +50,14 @@ def main(
         ]
     ).load()
     print('Interpolating')
-    glorys_to_t = Regridder(
+    # thetao and so are regridded together, with weights from the cache
+    glorys_to_t = default_weight_cache().sparse(
         glorys,
         target_grid,
         method='nearest_s2d',
-        reuse_weights=False,  #! Not reusing
         periodic=False,
     )
-    interped = glorys_to_t(glorys).drop_vars(['lon', 'lat'], errors='ignore').compute()
+    interped = glorys_to_t(glorys).drop_vars(['lon', 'lat'], errors='ignore')
     bounded = add_bounds(interped)
     bounded['xh'] = (('xh',), target_grid.xh.data)
     bounded['yh'] = (('yh',), target_grid.yh.data)
@@ -1,7 +1,11 @@
 import argparse
+import datetime as dt
+from getpass import getuser
+from pathlib import Path
 
 from workflow_tools.config import load_config
 from workflow_tools.forecast import ForecastRun
+from workflow_tools.inventory import ArchiveInventory
 
 
 def colorprint(msg, color):
@@ -16,6 +20,19 @@ def colorprint(msg, color):
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-c', '--config', type=str, required=True)
+parser.add_argument(
+    '--manifest-dir',
+    type=Path,
+    default=Path('/ptmp') / getuser() / 'inventory',
+    help='Where to save and look for inventory manifests of the history files',
+)
+parser.add_argument(
+    '--max-age',
+    type=float,
+    default=0,
+    help='Reuse the latest manifest if it is less than this many hours old '
+    'instead of listing the archive again',
+)
 args = parser.parse_args()
 config = load_config(args.config)
 
@@ -24,18 +41,34 @@ last_year = config.retrospective_forecasts.last_year
 nens = config.retrospective_forecasts.ensemble_size
 template = config.filesystem.forecast_history
 
-for ystart in range(first_year, last_year + 1):
-    for mstart in config.retrospective_forecasts.months:
-        for ens in range(1, nens + 1):
-            run = ForecastRun(
-                ystart=ystart, mstart=mstart, ens=ens, template=template
-            )
-            tar = run.archive_dir / run.tar_file
-            if tar.is_file():
-                colorprint(f'{run.tar_file} e{ens:02d}: found', 'ok')
-            elif tar.with_suffix(tar.suffix + '.gcp').is_file():
-                colorprint(
-                    f'{run.tar_file} e{ens:02d}: partial transfer', 'warning'
-                )
-            else:
-                colorprint(f'{run.tar_file} e{ens:02d}: not found', 'fail')
+runs = [
+    ForecastRun(ystart=ystart, mstart=mstart, ens=ens, template=template)
+    for ystart in range(first_year, last_year + 1)
+    for mstart in config.retrospective_forecasts.months
+    for ens in range(1, nens + 1)
+]
+
+inventory = ArchiveInventory.latest(
+    args.manifest_dir, max_age=dt.timedelta(hours=args.max_age)
+)
+if inventory is None or not all(inventory.covers(r.archive_dir) for r in runs):
+    inventory = ArchiveInventory.scan(r.archive_dir for r in runs)
+    inventory.save(args.manifest_dir)
+print(f'Inventory of history files from {inventory.created:%Y-%m-%d %H:%M}')
+
+counts = {'found': 0, 'partial transfer': 0, 'not found': 0}
+for run in runs:
+    tar = run.archive_dir / run.tar_file
+    size = inventory.size(tar)
+    if size is not None:
+        colorprint(
+            f'{run.tar_file} e{run.ens:02d}: found ({size / 1024**3:.1f} GB)', 'ok'
+        )
+        counts['found'] += 1
+    elif inventory.is_partial(tar):
+        colorprint(f'{run.tar_file} e{run.ens:02d}: partial transfer', 'warning')
+        counts['partial transfer'] += 1
+    else:
+        colorprint(f'{run.tar_file} e{run.ens:02d}: not found', 'fail')
+        counts['not found'] += 1
+print(', '.join(f'{v} {k}' for k, v in counts.items()))
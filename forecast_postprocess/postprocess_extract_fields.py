@@ -4,8 +4,9 @@ sbatch --export=ALL --wrap="python postprocess_extract_fields.py
     -c config_nwa12_physics.yaml -d ocean_daily -y 2019 -m 3
 """
 import datetime as dt
-import subprocess
 from argparse import ArgumentParser, Namespace
+from dataclasses import dataclass
+from functools import partial
 from getpass import getuser
 from os import environ
 from pathlib import Path
@@ -16,6 +17,9 @@ from loguru import logger
 
 from workflow_tools.config import load_config
 from workflow_tools.forecast import ForecastRun
+from workflow_tools.inventory import ArchiveInventory
+from workflow_tools.io import DMGet, atomic_path, open_tar_member
+from workflow_tools.pipeline import DiskBudget, Stage, run_pipeline
 
 
 def process_file(
@@ -23,13 +27,26 @@ def process_file(
     variables: list[str] | None = None,
     infile: Path | str | None = None,
     outfile: Path | str | None = None,
+    from_archive: bool = False,
 ) -> None:
-    if infile is None:
-        infile = forecast.vftmp_dir / forecast.file_name
+    """
+    Add coordinates to the history file for one run and write a compressed copy.
+    If from_archive is True, the history file is read directly out of the
+    tar file on archive instead of from infile.
+    """
     if outfile is None:
         outfile = forecast.outdir / forecast.out_name
+    if from_archive:
+        infile = f'{forecast.archive_dir / forecast.tar_file}:{forecast.file_name}'
+        opened = open_tar_member(
+            forecast.tar_index, forecast.file_name, decode_timedelta=False
+        )
+    else:
+        if infile is None:
+            infile = forecast.vftmp_dir / forecast.file_name
+        opened = xarray.open_dataset(infile, decode_timedelta=False)
     logger.info(f'process_file({infile})')
-    with xarray.open_dataset(infile, decode_timedelta=False) as ds:
+    with opened as ds:
         logger.trace('Opened {f}', f=infile)
         if variables is None:
             variables = list(ds.data_vars)
@@ -54,7 +71,10 @@ def process_file(
         # Compress output to significantly reduce space
         encoding = {var: {'zlib': True, 'complevel': 3} for var in variables}
         logger.trace('Starting writing to {f}', f=outfile)
-        dsv.to_netcdf(outfile, unlimited_dims='init', encoding=encoding)
+        # Write to a temporary file first so that concurrent or crashed
+        # workers never leave a partial file under the final name.
+        with atomic_path(Path(outfile)) as tmp_outfile:
+            dsv.to_netcdf(tmp_outfile, unlimited_dims='init', encoding=encoding)
         logger.trace('Finished writing to {f}', f=outfile)
 
 def process_run(
@@ -62,32 +82,174 @@ def process_run(
     variables: list[str],
     rerun: bool = False,
     clean: bool = False,
+    cache: bool = False,
 ) -> None:
+    """
+    Process one run, using previously cached copies of the history file
+    where they exist. Otherwise the file is read straight out of the tar
+    file on archive, unless cache is True, in which case it is first
+    extracted to /ptmp and copied to vftmp (and kept there for reuse).
+    """
     # Check if a processed file exists
     if not (forecast.outdir / forecast.out_name).is_file() or rerun:
         vftmp_file = forecast.vftmp_dir / forecast.file_name
+        ptmp_file = forecast.ptmp_dir / forecast.file_name
         # Check if an extracted data file exists
-        if vftmp_file.is_file():
+        if forecast.vftmp_cache.lookup(vftmp_file):
             logger.trace('File {f} already exists on vftmp', f=vftmp_file)
             process_file(forecast, variables=variables)
         # Check if a cached tar file exists
-        elif (forecast.ptmp_dir / forecast.file_name).is_file():
+        elif forecast.ptmp_cache.lookup(ptmp_file):
             logger.trace('File is not on vftmp but is on ptmp')
-            forecast.copy_from_ptmp()
-            process_file(forecast, variables=variables)
+            if cache:
+                forecast.copy_from_ptmp()
+                process_file(forecast, variables=variables)
+            else:
+                process_file(forecast, variables=variables, infile=ptmp_file)
         elif forecast.exists:
             logger.trace('File is on archive but not on vftmp or ptmp')
-            forecast.copy_from_archive()
-            forecast.copy_from_ptmp()
-            process_file(forecast, variables=variables)
+            if cache:
+                forecast.copy_from_archive()
+                forecast.copy_from_ptmp()
+                process_file(forecast, variables=variables)
+            else:
+                process_file(forecast, variables=variables, from_archive=True)
         else:
             logger.info(
                 f'{forecast.archive_dir / forecast.tar_file} not found; skipping.'
             )
             return
-        if clean:
+        if clean and vftmp_file.is_file():
             logger.info('Cleaning file')
-            vftmp_file.unlink()
+            forecast.vftmp_cache.remove(vftmp_file)
+
+
+def gb_to_bytes(gb: float | None) -> int | None:
+    return None if gb is None else int(gb * 1024**3)
+
+
+def needs_processing(forecast: ForecastRun, rerun: bool = False) -> bool:
+    return rerun or not (forecast.outdir / forecast.out_name).is_file()
+
+
+@dataclass
+class TarGroup:
+    """
+    Runs for every domain that is extracted from the same history tar file,
+    the number of bytes staged to vftmp for them, and whether their files
+    are pinned in the /ptmp and vftmp caches.
+    """
+
+    runs: list[ForecastRun]
+    staged_bytes: int = 0
+    pinned: bool = False
+
+    @property
+    def tar_path(self) -> Path:
+        return self.runs[0].archive_dir / self.runs[0].tar_file
+
+    def __str__(self) -> str:
+        return self.tar_path.as_posix()
+
+
+def recall(batch: list[TarGroup], dmget: DMGet) -> list[TarGroup]:
+    """
+    dmget the tar files for a batch of groups.
+    Returns the groups whose tar files could be recalled.
+    """
+    to_dmget = [g for g in batch if any(r.needs_dmget for r in g.runs)]
+    if len(to_dmget) == 0:
+        logger.info('No files to dmget')
+        return batch
+    logger.info(f'dmgetting {len(to_dmget)} files')
+    report = dmget([g.tar_path for g in to_dmget])
+    # Remove groups with files that could not be recalled (e.g., on a bad tape)
+    # so that they are not extracted or worked on later.
+    for path in report.failed:
+        logger.error(f'Could not dmget {path}. Removing from list of files to extract.')
+    return [g for g in batch if g.tar_path not in report.failed]
+
+
+def pin_group(group: TarGroup) -> None:
+    """
+    Keep the cache quotas from evicting the group's files
+    before they have been copied and processed.
+    """
+    first = group.runs[0]
+    first.ptmp_cache.pin([r.ptmp_dir / r.file_name for r in group.runs])
+    first.vftmp_cache.pin([r.vftmp_dir / r.file_name for r in group.runs])
+    group.pinned = True
+
+
+def release_group(group: TarGroup, budget: DiskBudget) -> None:
+    """
+    Give back the vftmp budget and the cache pins held by the group.
+    """
+    budget.release(group.staged_bytes)
+    if group.pinned:
+        first = group.runs[0]
+        first.ptmp_cache.unpin([r.ptmp_dir / r.file_name for r in group.runs])
+        first.vftmp_cache.unpin([r.vftmp_dir / r.file_name for r in group.runs])
+        group.pinned = False
+
+
+def extract_group(group: TarGroup, budget: DiskBudget) -> TarGroup:
+    """
+    Extract every file the group still needs from archive to /ptmp,
+    after reserving room on vftmp for them.
+    """
+    first = group.runs[0]
+    if not first.exists:
+        return group
+    to_copy = [r for r in group.runs if not (r.vftmp_dir / r.file_name).is_file()]
+    index = first.tar_index
+    group.staged_bytes = sum(index.member(r.file_name).size for r in to_copy)
+    budget.acquire(group.staged_bytes)
+    try:
+        pin_group(group)
+        to_extract = [
+            r.domain for r in to_copy if not (r.ptmp_dir / r.file_name).is_file()
+        ]
+        if len(to_extract) > 0:
+            logger.trace('Extracting {n} domains from archive', n=len(to_extract))
+            first.copy_from_archive(domains=to_extract)
+    except Exception:
+        release_group(group, budget)
+        raise
+    return group
+
+
+def copy_group(group: TarGroup, budget: DiskBudget) -> TarGroup:
+    """
+    Copy the files for the group from /ptmp to vftmp.
+    """
+    try:
+        for run in group.runs:
+            if (
+                not (run.vftmp_dir / run.file_name).is_file()
+                and (run.ptmp_dir / run.file_name).is_file()
+            ):
+                run.copy_from_ptmp()
+    except Exception:
+        release_group(group, budget)
+        raise
+    return group
+
+
+def process_group(
+    group: TarGroup,
+    *,
+    variables: dict[str, list[str]],
+    rerun: bool = False,
+    clean: bool = False,
+    cache: bool = False,
+) -> TarGroup:
+    """
+    Process the runs in a group. This may run in a worker process.
+    """
+    for run in group.runs:
+        process_run(run, variables[run.domain], rerun=rerun, clean=clean, cache=cache)
+    return group
 
 
 def main(args: Namespace) -> None:
@@ -117,87 +279,110 @@ def main(args: Namespace) -> None:
             else config.retrospective_forecasts.months
         )
         nens = config.retrospective_forecasts.ensemble_size
-    outdir = (
-        config.filesystem.forecast_output_data / 'extracted' / args.domain
-    )
-    outdir.mkdir(exist_ok=True, parents=True)
-    variables = config.variables[args.domain]
+    domains = list(config.variables) if args.all_domains else [args.domain]
+    outdirs = {
+        domain: config.filesystem.forecast_output_data / 'extracted' / domain
+        for domain in domains
+    }
+    for outdir in outdirs.values():
+        outdir.mkdir(exist_ok=True, parents=True)
     if args.tmp:
         vftmp = Path(environ['TMPDIR'])
     else:
         vftmp = Path('/vftmp') / getuser()
-    all_runs = [
-        ForecastRun(
-            ystart=ystart,
-            mstart=mstart,
-            ens=ens,
-            name=config.name,
-            template=config.filesystem.forecast_history,
-            domain=args.domain,
-            outdir=outdir,
-            vftmp=vftmp,
-        )
-        for ystart in range(first_year, last_year + 1)
-        for mstart in months
-        for ens in range(1, nens + 1)
-    ]
-    # Prefer to dmget all files that need it in one command, if possible.
-    runs_to_dmget = []
-    for run in all_runs:
-        if not (run.outdir / run.out_name).is_file() or args.rerun:
-            if run.needs_dmget:
-                runs_to_dmget.append(run)  # (run.archive_dir / run.tar_file))
-
-    # Try running one dmget command for all files.
-    if len(runs_to_dmget) > 0:
-        logger.info(f'dmgetting {len(runs_to_dmget)} files')
-        file_names = [str(run.archive_dir / run.tar_file) for run in runs_to_dmget]
-        dmget = subprocess.run(
-            [f'dmget {" ".join(file_names)}'],
-            shell=True,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        # If a tape is bad, the single dmget will fail.
-        # Try running dmget separately for each individual file.
-        # If the dmget fails, remove the run from the all_runs list
-        # so that it is not extracted or worked on later.
-        if dmget.returncode > 0:
-            if 'unable to recall the requested file' in dmget.stderr:
-                logger.warning('dmget failed. Running dmget separately for each file.')
-                for run in runs_to_dmget:
-                    try:
-                        subprocess.run(
-                            [f'dmget {run.archive_dir / run.tar_file}'],
-                            shell=True,
-                            check=True
-                        )
-                    except subprocess.CalledProcessError:
-                        logger.error(
-                            f'Could not dmget {run.archive_dir / run.tar_file}. \
-                                Removing from list of files to extract.'
-                        )
-                        all_runs.remove(run)
-            else:
-                # dmget failed, but not with the usual error
-                # associated with a bad file/tape.
-                raise subprocess.CalledProcessError(
-                    dmget.returncode,
-                    str(dmget.args),
-                    output=dmget.stdout,
-                    stderr=dmget.stderr,
+    # One group of runs (one per domain) for each history tar file,
+    # keeping only the runs that still need to be processed.
+    groups = []
+    for ystart in range(first_year, last_year + 1):
+        for mstart in months:
+            for ens in range(1, nens + 1):
+                runs = [
+                    ForecastRun(
+                        ystart=ystart,
+                        mstart=mstart,
+                        ens=ens,
+                        name=config.name,
+                        template=config.filesystem.forecast_history,
+                        domain=domain,
+                        outdir=outdirs[domain],
+                        vftmp=vftmp,
+                        vftmp_quota=gb_to_bytes(args.vftmp_quota),
+                        ptmp_quota=gb_to_bytes(args.ptmp_quota),
+                    )
+                    for domain in domains
+                ]
+                groups.append(
+                    TarGroup([r for r in runs if needs_processing(r, args.rerun)])
                 )
-    else:
-        logger.info('No files to dmget')
+    groups = [g for g in groups if len(g.runs) > 0]
+    if len(groups) == 0:
+        logger.info('Nothing to extract')
+        return
+    # List the history directories once instead of checking every tar file
+    inventory = ArchiveInventory.scan(g.runs[0].archive_dir for g in groups)
+    for group in groups:
+        for run in group.runs:
+            run.inventory = inventory
 
-    for run in all_runs:
-        process_run(run, variables, rerun=args.rerun, clean=args.tmp)
+    # Recall the tar files in batches (each with one dmget command), and
+    # overlap recalling, staging, and processing. Each stage waits when the
+    # queue for the next one is full, or when the vftmp budget is used up.
+    budget = DiskBudget(gb_to_bytes(args.vftmp_limit))
+    batches = [
+        groups[i : i + args.recall_batch]
+        for i in range(0, len(groups), args.recall_batch)
+    ]
+    stages = [
+        Stage('recall', partial(recall, dmget=DMGet()), queue_depth=1, expand=True)
+    ]
+    if args.cache:
+        stages += [
+            Stage(
+                'extract',
+                partial(extract_group, budget=budget),
+                workers=args.io_workers,
+                queue_depth=args.queue_depth,
+            ),
+            Stage(
+                'copy',
+                partial(copy_group, budget=budget),
+                workers=args.io_workers,
+                queue_depth=args.queue_depth,
+            ),
+        ]
+    stages.append(
+        Stage(
+            'process',
+            partial(
+                process_group,
+                variables=config.variables,
+                rerun=args.rerun,
+                clean=args.tmp,
+                cache=args.cache,
+            ),
+            workers=args.workers,
+            queue_depth=max(args.queue_depth, args.workers),
+            processes=args.workers > 1,
+            on_done=partial(release_group, budget=budget),
+        )
+    )
+    run_pipeline(batches, stages)
+    if args.cache:
+        first = groups[0].runs[0]
+        for cache in (first.ptmp_cache, first.vftmp_cache):
+            logger.info(f'{cache.root}: {cache.stats}')
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-c', '--config', type=str, required=True)
     parser.add_argument('-d', '--domain', type=str, default='ocean_month')
+    parser.add_argument(
+        '-a',
+        '--all-domains',
+        action='store_true',
+        help='Extract every domain listed under variables in the config, '
+        'reading each history tar file only once. Overrides --domain.',
+    )
     parser.add_argument(
         '-y',
         '--year',
@@ -217,6 +402,54 @@ if __name__ == '__main__':
         action='store_true',
         help='Flag if this is a new near-real-time forecast instead of a retrospective.'
     )
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        help='Extract the history files to /ptmp and copy them to vftmp before '
+        'processing, keeping the copies for reuse, instead of reading them '
+        'directly from the tar files on archive.',
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of processes used to process and compress runs in parallel',
+    )
+    parser.add_argument(
+        '--recall-batch',
+        type=int,
+        default=40,
+        help='Number of tar files to recall with each dmget command',
+    )
+    parser.add_argument(
+        '--io-workers',
+        type=int,
+        default=2,
+        help='Number of concurrent extractions and copies when using --cache',
+    )
+    parser.add_argument(
+        '--queue-depth',
+        type=int,
+        default=2,
+        help='Number of tar files allowed to wait between pipeline stages',
+    )
+    parser.add_argument(
+        '--vftmp-limit',
+        type=float,
+        help='Maximum GB of history files staged on vftmp but not yet processed',
+    )
+    parser.add_argument(
+        '--vftmp-quota',
+        type=float,
+        help='Maximum GB of history files to keep cached on vftmp; '
+        'the least recently used files are removed to stay under it',
+    )
+    parser.add_argument(
+        '--ptmp-quota',
+        type=float,
+        help='Maximum GB of history files to keep cached on /ptmp',
+    )
     parser.add_argument(
         '--tmp',
         action='store_true',
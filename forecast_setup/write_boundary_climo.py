@@ -1,6 +1,7 @@
 import xarray
 from loguru import logger
 
+from workflow_tools.io import write_netcdf3
 from workflow_tools.utils import modulo, smooth_climatology
 
 
@@ -42,7 +43,8 @@ def write_boundary(ystart, yend, pathin, pathout, n_segments):
                 res = smoothed.to_dataset()
             else:
                 # z coordinates don't really vary in time.
-                # Use the first coord and expand over time.
+                # Use the first coord and expand over time
+                # (as a view, which write_netcdf3 writes without copying).
                 # do it for both u and v if it is a velocity file.
                 if var == 'uv':
                     z = (
@@ -54,6 +56,7 @@ def write_boundary(ystart, yend, pathin, pathout, n_segments):
                         ]
                         .isel(time=0)
                         .drop('time')
+                        .load()
                         .expand_dims(time=365)
                     )
                     encoding = {
@@ -72,6 +75,7 @@ def write_boundary(ystart, yend, pathin, pathout, n_segments):
                         boundary[f'dz_{var}_segment_{segment:03d}']
                         .isel(time=0)
                         .drop('time')
+                        .load()
                         .expand_dims(time=365)
                     )
 
@@ -84,13 +88,7 @@ def write_boundary(ystart, yend, pathin, pathout, n_segments):
                     res[fullcoord] = boundary[fullcoord]
 
             res = modulo(res)
-            res.to_netcdf(
-                pathout / f'{var}_c_{segment:01d}.nc',
-                format='NETCDF3_64BIT',
-                engine='netcdf4',
-                encoding=encoding,
-                unlimited_dims='time',
-            )
+            write_netcdf3(res, pathout / f'{var}_c_{segment:01d}.nc', encoding=encoding)
 
 
 if __name__ == '__main__':
@@ -1,13 +1,14 @@
 import datetime as dt
 import os
-import tarfile
 from pathlib import Path
 
 import numpy as np
 import xarray
 from loguru import logger
 
+from workflow_tools.cache import ScratchCache
 from workflow_tools.config import Config, load_config
+from workflow_tools.tarindex import TarIndex
 from workflow_tools.utils import run_cmd
 
 # Path to store temporary output to:
@@ -101,19 +102,18 @@ def ics_from_snapshot(component, history, ystart, mstart, force_extract=False):
     snapshot_file = history / f'{yfile}0101.nc.tar'
 
     # extract the snapshot from the tar file to tmp
-    if force_extract or not (TMP / f'./{yfile}0101.{component}_snap.nc').exists():
+    cache = ScratchCache(TMP)
+    snap = TMP / f'{yfile}0101.{component}_snap.nc'
+    if force_extract or not cache.lookup(snap):
         # dmget the tar file
         run_cmd(f'dmget {snapshot_file.as_posix()}')
         logger.info('extracting')
-        tar = tarfile.open(snapshot_file, mode='r:')
-        member = tar.getmember(f'./{yfile}0101.{component}_snap.nc')
-        tar.extractall(path=TMP, members=[member])
+        TarIndex(snapshot_file).extract(f'./{snap.name}', TMP)
+        cache.add(snap)
 
     # open and modify the tmp snapshot file
     logger.info('modifying')
-    ds = xarray.open_dataset(
-        TMP / f'./{yfile}0101.{component}_snap.nc', decode_cf=False
-    )
+    ds = xarray.open_dataset(snap, decode_cf=False)
     ds['time'].attrs['calendar'] = 'gregorian'
     ds = xarray.decode_cf(ds)
     ds = ds.drop_vars(DROP_VARS, errors='ignore')
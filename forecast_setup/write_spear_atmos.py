@@ -6,14 +6,16 @@ import numpy as np
 import xarray
 from loguru import logger
 
-from workflow_tools.io import HSMGet, write_ds
-from workflow_tools.spear import SPEAR_ROOT, get_spear_paths
+from workflow_tools.io import DMGet, HSMGet, write_ds
+from workflow_tools.spear import SPEAR_ROOT, SpearCatalog, get_spear_paths
 from workflow_tools.utils import pad_ds
 
 hsmget = HSMGet(archive=SPEAR_ROOT)
 
 
-def get_files_to_extract(ystart: int, mstart: int, ens: int) -> list[Path]:
+def get_files_to_extract(
+    ystart: int, mstart: int, ens: int, catalog: SpearCatalog | None = None
+) -> list[Path]:
     files = get_spear_paths(
         ['slp', 't_ref', 'q_ref', 'lwdn_sfc', 'swdn_sfc', 'precip'],
         ystart,
@@ -21,9 +23,16 @@ def get_files_to_extract(ystart: int, mstart: int, ens: int) -> list[Path]:
         'atmos_daily',
         'daily',
         ens=ens,
+        catalog=catalog,
     )
     files += get_spear_paths(
-        ['u_ref', 'v_ref'], ystart, mstart, 'atmos_4xdaily', '6hr', ens=ens
+        ['u_ref', 'v_ref'],
+        ystart,
+        mstart,
+        'atmos_4xdaily',
+        '6hr',
+        ens=ens,
+        catalog=catalog,
     )
     return files
 
@@ -92,11 +101,15 @@ def write_atmos_all_members(
     # Read mask for flooding
     static = xarray.open_dataset('/work/acr/spear/atmos.static.nc')
     is_ocean = np.invert(static.land_mask.astype('bool'))
+    # Look up the files for all members in one listing of the archive
+    catalog = SpearCatalog()
     members = {}
     for ens in range(1, nens + 1):
         out_dir = work_dir / f'{ystart}-{mstart:02d}-e{ens:02d}'
         if rerun or not out_dir.is_dir():
-            members.update({ens: get_files_to_extract(ystart, mstart, ens)})
+            members.update(
+                {ens: get_files_to_extract(ystart, mstart, ens, catalog=catalog)}
+            )
 
     if len(members) == 0:
         return None
@@ -104,8 +117,15 @@ def write_atmos_all_members(
     # dmget everything at once instead of separately by member
     # to reduce the change of dmget failing
     logger.info(f' dmget {len(members)} members')
-    all_file_strs = ' '.join(x.as_posix() for x in sum(members.values(), []))  # noqa: RUF017
-    subprocess.run(['dmget ' + all_file_strs], shell=True, check=True)
+    report = DMGet()([f for files in members.values() for f in files])
+    # Skip members with files that could not be recalled (e.g., on a bad tape)
+    for member, files in list(members.items()):
+        bad = [f for f in files if f in report.failed]
+        if len(bad) > 0:
+            logger.error(f'Could not dmget {bad}. Skipping member {member}.')
+            del members[member]
+    if len(members) == 0:
+        return None
     tmpdir = (
         Path(os.environ['TMPDIR']) / 'atmos_raw' / f'{ystart}-{mstart:02d}-e{ens:02d}'
     )
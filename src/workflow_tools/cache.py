@@ -0,0 +1,217 @@
+# Quota-limited, least-recently-used cache of files on scratch space
+import fcntl
+import json
+import os
+import socket
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from os import replace
+from pathlib import Path
+from typing import Any
+
+from loguru import logger
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    evicted_bytes: int = 0
+
+
+def _owner() -> str:
+    """
+    Host and process id that a pin belongs to.
+    """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@dataclass
+class ScratchCache:
+    """
+    Tracks files stored under root (e.g. /vftmp/$USER or /ptmp/$USER) in a
+    small json index with the size and last access time of each file.
+    When quota (in bytes) is set, the least recently used files are deleted
+    whenever a new file would put the cache over the quota.
+    The index is locked while it is updated, so several processes can
+    share the same cache. Hit and miss counts are kept in the index too.
+    Files that are pinned (e.g. while they wait to be processed) are never
+    evicted, even if that leaves the cache over the quota. Pins record
+    the host and process that made them, so that pins left behind by
+    processes that died are reclaimed.
+    """
+
+    root: Path
+    quota: int | None = None
+    # Seconds after which pins held by processes on other hosts are dropped
+    pin_timeout: float = 7 * 24 * 3600
+
+    @property
+    def index_file(self) -> Path:
+        return self.root / '.cache_index.json'
+
+    @contextmanager
+    def _index(self, write: bool = True) -> Iterator[dict[str, Any]]:
+        """
+        Lock, read, and (on leaving the context) save the index
+        if it was changed. If write is False, the index is only read,
+        under a shared lock.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / '.cache_index.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            index = {'entries': {}, 'stats': asdict(CacheStats())}
+            if self.index_file.is_file():
+                try:
+                    with open(self.index_file) as f:
+                        index = json.load(f)
+                except json.JSONDecodeError:
+                    logger.warning('Resetting unreadable index {f}', f=self.index_file)
+            index.setdefault('pins', {})
+            saved = json.dumps(index)
+            yield index
+            if write and json.dumps(index) != saved:
+                tmp_file = self.index_file.with_suffix('.tmp')
+                with open(tmp_file, 'w') as f:
+                    json.dump(index, f)
+                replace(tmp_file, self.index_file)
+
+    def _key(self, path: Path) -> str:
+        return path.relative_to(self.root).as_posix()
+
+    def lookup(self, path: Path) -> bool:
+        """
+        Check if path is in the cache, counting a hit or a miss.
+        A hit marks the file as recently used.
+        Files that were put under root by other means are adopted on a hit.
+        """
+        return self.lookup_many([path])[0]
+
+    def lookup_many(self, paths: list[Path]) -> list[bool]:
+        """
+        Same as lookup for each of paths, with one update of the index
+        for all of them.
+        """
+        # Files are checked before taking the lock, to hold it for less time
+        sizes = [path.stat().st_size if path.is_file() else None for path in paths]
+        now = time.time()
+        with self._index() as index:
+            for path, size in zip(paths, sizes, strict=True):
+                key = self._key(path)
+                if size is None:
+                    index['entries'].pop(key, None)
+                    index['stats']['misses'] += 1
+                else:
+                    index['entries'][key] = {'size': size, 'atime': now}
+                    index['stats']['hits'] += 1
+        return [size is not None for size in sizes]
+
+    def add(self, path: Path) -> None:
+        """
+        Record a file that was just written to the cache,
+        and evict other files as needed to stay under the quota.
+        """
+        key = self._key(path)
+        with self._index() as index:
+            index['entries'][key] = {'size': path.stat().st_size, 'atime': time.time()}
+            self._evict(index, keep=key)
+
+    def remove(self, path: Path) -> None:
+        """
+        Delete a file from the cache.
+        """
+        with self._index() as index:
+            index['entries'].pop(self._key(path), None)
+            path.unlink(missing_ok=True)
+
+    def pin(self, paths: list[Path]) -> None:
+        """
+        Keep paths from being evicted (whether or not they are in the cache yet)
+        until this process unpins them. Pins are counted, so a path pinned
+        twice has to be unpinned twice.
+        """
+        owner = _owner()
+        with self._index() as index:
+            for path in paths:
+                pins = index['pins'].setdefault(self._key(path), {})
+                count = pins.get(owner, [0])[0]
+                pins[owner] = [count + 1, time.time()]
+
+    def unpin(self, paths: list[Path]) -> None:
+        """
+        Let paths be evicted again.
+        """
+        owner = _owner()
+        with self._index() as index:
+            for path in paths:
+                key = self._key(path)
+                pins = index['pins'].get(key, {})
+                count = pins.pop(owner, [0])[0] - 1
+                if count > 0:
+                    pins[owner] = [count, time.time()]
+                if len(pins) == 0:
+                    index['pins'].pop(key, None)
+
+    def _reclaim_pins(self, index: dict[str, Any]) -> None:
+        """
+        Drop the pins of processes that have exited without unpinning
+        (such as workers that were killed). Processes on other hosts
+        cannot be checked, so their pins are dropped after pin_timeout.
+        """
+        host = socket.gethostname()
+        oldest = time.time() - self.pin_timeout
+        for key in list(index['pins']):
+            pins = index['pins'][key]
+            for owner, (_, pinned) in list(pins.items()):
+                owner_host, pid = owner.rsplit(':', 1)
+                if (owner_host == host and not _is_running(int(pid))) or (
+                    owner_host != host and pinned < oldest
+                ):
+                    logger.debug('Reclaiming stale pin of {f}', f=self.root / key)
+                    del pins[owner]
+            if len(pins) == 0:
+                del index['pins'][key]
+
+    def _evict(self, index: dict[str, Any], keep: str) -> None:
+        if self.quota is None:
+            return
+        self._reclaim_pins(index)
+        entries = index['entries']
+        total = sum(e['size'] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]['atime']):
+            if total <= self.quota:
+                break
+            if key == keep or key in index['pins']:
+                continue
+            logger.debug('Evicting {f} from cache', f=self.root / key)
+            (self.root / key).unlink(missing_ok=True)
+            size = entries.pop(key)['size']
+            total -= size
+            index['stats']['evictions'] += 1
+            index['stats']['evicted_bytes'] += size
+
+    @property
+    def size(self) -> int:
+        """
+        Total bytes of the files tracked by the cache.
+        """
+        with self._index(write=False) as index:
+            return sum(e['size'] for e in index['entries'].values())
+
+    @property
+    def stats(self) -> CacheStats:
+        with self._index(write=False) as index:
+            return CacheStats(**index['stats'])
@@ -1,9 +1,12 @@
 # Using ptmp to cache full history files
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 from getpass import getuser
 from os import devnull
 from pathlib import Path
 
+from .cache import ScratchCache
+from .inventory import ArchiveInventory
+from .tarindex import TarIndex
 from .utils import run_cmd
 
 
@@ -18,6 +21,24 @@ class ForecastRun:
     vftmp: Path = Path('/vftmp') / getuser()
     ptmp: Path = Path('/ptmp') / getuser()
     outdir: Path = Path(devnull)
+    # Optional limits (in bytes) on the space used by the /vftmp and /ptmp caches
+    vftmp_quota: int | None = None
+    ptmp_quota: int | None = None
+    # Optional listing of the archive, to answer exists without a stat call
+    inventory: ArchiveInventory | None = field(
+        default=None, repr=False, compare=False
+    )
+    # Answer to exists from the inventory, for copies sent to other processes
+    _exists: bool | None = field(default=None, init=False, repr=False, compare=False)
+
+    def __getstate__(self) -> dict:
+        # The inventory lists every history directory, so rather than pickling
+        # it into each worker process, send only the answer that it gives
+        state = self.__dict__.copy()
+        if self.inventory is not None:
+            state['_exists'] = self.exists
+            state['inventory'] = None
+        return state
 
     @property
     def archive_dir(self) -> Path:
@@ -37,6 +58,15 @@ class ForecastRun:
         """
         return f'{self.ystart}{self.mstart:02d}01.nc.tar'
 
+    @property
+    def tar_index(self) -> TarIndex:
+        """
+        Index of member offsets in the tar file, stored alongside the /ptmp cache.
+        """
+        return TarIndex(
+            self.archive_dir / self.tar_file, index_root=self.ptmp / 'tar_index'
+        )
+
     @property
     def ptmp_dir(self) -> Path:
         """
@@ -57,6 +87,14 @@ class ForecastRun:
         """
         return self.vftmp / 'forecast_data' / self.name / f'e{self.ens:02d}'
 
+    @property
+    def vftmp_cache(self) -> ScratchCache:
+        return ScratchCache(self.vftmp, quota=self.vftmp_quota)
+
+    @property
+    def ptmp_cache(self) -> ScratchCache:
+        return ScratchCache(self.ptmp, quota=self.ptmp_quota)
+
     @property
     def file_name(self) -> str:
         """
@@ -73,6 +111,10 @@ class ForecastRun:
 
     @property
     def exists(self) -> bool:
+        if self._exists is not None:
+            return self._exists
+        if self.inventory is not None:
+            return self.inventory.exists(self.archive_dir / self.tar_file)
         return (self.archive_dir / self.tar_file).is_file()
 
     @property
@@ -83,19 +125,34 @@ class ForecastRun:
             and not (self.ptmp_dir / self.file_name).is_file()
         )
 
-    def copy_from_archive(self) -> None:
+    def with_domain(self, domain: str, **kwargs) -> 'ForecastRun':
+        """
+        Copy of this run for a different diagnostic domain
+        (and optionally other changed fields, such as outdir).
+        """
+        return replace(self, domain=domain, **kwargs)
+
+    def copy_from_archive(self, domains: list[str] | None = None) -> None:
         """
         Extract the file for this domain, from the tar file on archive,
         to the path on /ptmp.
+        If a list of domains is given, extract the files for all of them.
+        The tar index is used to seek directly to each file, so only
+        the bytes of the requested files are read.
         """
         if not self.exists:
             raise FileNotFoundError(
                 f'File {(self.archive_dir / self.tar_file)} does not exist.'
             )
-        self.ptmp_dir.mkdir(parents=True, exist_ok=True)
-        cmd = f'tar xf {(self.archive_dir / self.tar_file).as_posix()} -C \
-            {self.ptmp_dir.as_posix()} ./{self.file_name}'
-        run_cmd(cmd)
+        if domains is None:
+            domains = [self.domain]
+        index = self.tar_index
+        cache = self.ptmp_cache
+        for domain in domains:
+            extracted = index.extract(
+                self.with_domain(domain).file_name, self.ptmp_dir
+            )
+            cache.add(extracted)
 
     def copy_from_ptmp(self) -> None:
         """
@@ -105,3 +162,4 @@ class ForecastRun:
         cmd = f'gcp {(self.ptmp_dir / self.file_name).as_posix()} \
             {self.vftmp_dir.as_posix()}'
         run_cmd(cmd)
+        self.vftmp_cache.add(self.vftmp_dir / self.file_name)
@@ -0,0 +1,179 @@
+# Catalog of the daily GLORYS reanalysis and analysis files on archive
+import json
+import os
+import re
+from calendar import monthrange
+from dataclasses import dataclass, field
+from getpass import getuser
+from pathlib import Path
+
+from loguru import logger
+
+# Default location to save the catalog
+CATALOG_FILE = Path('/ptmp') / getuser() / 'glorys_catalog.json'
+
+# Reanalysis files, in <reanalysis_path>/<var>/<year>/, are named like
+# mercatorglorys12v1_gl12_mean_19930101_R19930106.nc
+_REANALYSIS_FILE = re.compile(r'.*_(\d{8})_R(\d{8})\.nc')
+
+# Analysis files, in <analysis_path>/<product>/<year>/<month>/, are named like
+# glo12_rg_1d-m_20240920-20240920_3D-uovo_hcst_R20241002.nc
+# where hcst could also be nwct or fcst
+_ANALYSIS_FILE = re.compile(r'glo12_rg_1d-m_(\d{8})-\1_(.+)_(.{4})_R(.*)\.nc')
+
+# Product directory and the part of the file name naming the content,
+# for each variable in the analysis.
+# Assuming that the 202406 in the product names will never change.
+# u and v are in the same files.
+_ANALYSIS_PRODUCTS = {
+    'zos': ('cmems_mod_glo_phy_anfc_0.083deg_P1D-m_202406', '2D'),
+    'so': ('cmems_mod_glo_phy-so_anfc_0.083deg_P1D-m_202406', '3D-so'),
+    'thetao': ('cmems_mod_glo_phy-thetao_anfc_0.083deg_P1D-m_202406', '3D-thetao'),
+    'uo': ('cmems_mod_glo_phy-cur_anfc_0.083deg_P1D-m_202406', '3D-uovo'),
+    'vo': ('cmems_mod_glo_phy-cur_anfc_0.083deg_P1D-m_202406', '3D-uovo'),
+}
+
+
+def _mtime(directory: Path) -> float | None:
+    try:
+        return directory.stat().st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def _best_by_day(directory: Path, content: str | None) -> dict[str, str]:
+    """
+    Name of the file to use for each day (YYYYMMDD) in a directory.
+    When there are several for a day, the one with the latest run type
+    and then the latest R stamp is used, which is the same as the last one
+    by sorted name. content is the content part of the name of analysis files,
+    or None for reanalysis files.
+    """
+    best: dict[str, tuple[tuple[str, ...], str]] = {}
+    try:
+        with os.scandir(directory) as it:
+            names = [e.name for e in it]
+    except FileNotFoundError:
+        return {}
+    for name in names:
+        if content is None:
+            match = _REANALYSIS_FILE.fullmatch(name)
+            if match is None:
+                continue
+            day, stamp = match.groups()
+            rank = (stamp,)
+        else:
+            match = _ANALYSIS_FILE.fullmatch(name)
+            if match is None or match.group(2) != content:
+                continue
+            day, _, run, stamp = match.groups()
+            rank = (run, stamp)
+        if day not in best or rank > best[day][0]:
+            best[day] = (rank, name)
+    return {day: name for day, (_, name) in best.items()}
+
+
+def _month(
+    days: dict[str, str], directory: Path, year: int, mon: int
+) -> dict[int, Path]:
+    prefix = f'{year}{mon:02d}'
+    return {
+        int(day[6:]): directory / name
+        for day, name in days.items()
+        if day.startswith(prefix)
+    }
+
+
+@dataclass
+class GlorysCatalog:
+    """
+    Best daily file for each variable, using the reanalysis when it is
+    available and the analysis when it is not. Each directory is listed once
+    and the file to use for each day is kept in memory and saved to
+    cache_file. A saved listing is reused as long as the modification time
+    of its directory has not changed; each directory's time is checked
+    once per catalog, after which finding the files for a month only
+    looks up dictionaries.
+    """
+
+    reanalysis_path: Path
+    analysis_path: Path
+    cache_file: Path | None = CATALOG_FILE
+    _dirs: dict[str, dict] | None = field(default=None, init=False, repr=False)
+    _checked: set[str] = field(default_factory=set, init=False, repr=False)
+
+    def _load(self) -> dict[str, dict]:
+        if self.cache_file is None or not self.cache_file.is_file():
+            return {}
+        with open(self.cache_file) as f:
+            return json.load(f)['dirs']
+
+    def _save(self) -> None:
+        if self.cache_file is None:
+            return
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.cache_file.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump({'dirs': self._dirs}, f)
+        os.replace(tmp_file, self.cache_file)
+
+    def _directory(self, directory: Path, content: str | None) -> dict[str, str]:
+        """
+        Best file for each day in a directory, listing it
+        only if it is new or has changed since it was last listed.
+        """
+        if self._dirs is None:
+            self._dirs = self._load()
+        key = directory.as_posix()
+        if key not in self._checked:
+            mtime = _mtime(directory)
+            saved = self._dirs.get(key)
+            if saved is None or saved['mtime'] != mtime:
+                logger.debug(f'Listing {key}')
+                self._dirs[key] = {
+                    'mtime': mtime,
+                    'days': _best_by_day(directory, content),
+                }
+                self._save()
+            self._checked.add(key)
+        return self._dirs[key]['days']
+
+    def reanalysis(self, year: int, mon: int, var: str) -> dict[int, Path]:
+        directory = self.reanalysis_path / var / str(year)
+        days = self._directory(directory, None)
+        return _month(days, directory, year, mon)
+
+    def analysis(self, year: int, mon: int, var: str) -> dict[int, Path]:
+        if var not in _ANALYSIS_PRODUCTS:
+            raise Exception('Unknown variable')
+        product, content = _ANALYSIS_PRODUCTS[var]
+        directory = self.analysis_path / product / str(year) / f'{mon:02d}'
+        days = self._directory(directory, content)
+        return _month(days, directory, year, mon)
+
+    def files(self, year: int, mon: int, var: str) -> list[Path]:
+        """
+        Files to use for each day of a month. For velocity ('uv'),
+        the files for both components, without duplicating the analysis files
+        that contain both. Days without a file are logged as errors and skipped.
+        """
+        if var == 'uv':
+            return sorted({*self.files(year, mon, 'uo'), *self.files(year, mon, 'vo')})
+        reanalysis = self.reanalysis(year, mon, var)
+        analysis = None
+        files = []
+        for day in range(1, monthrange(year, mon)[1] + 1):
+            if day in reanalysis:
+                files.append(reanalysis[day])
+                continue
+            # The analysis directory is only needed when the reanalysis is missing
+            if analysis is None:
+                analysis = self.analysis(year, mon, var)
+            if day in analysis:
+                files.append(analysis[day])
+            else:
+                logger.error(
+                    f'Did not a find a file for {year}-{mon:02d}-{day:02d} {var}'
+                )
+        return files
+
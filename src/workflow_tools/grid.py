@@ -1,9 +1,41 @@
-import os
+import fcntl
+import hashlib
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import dataclass
+from functools import cache
+from getpass import getuser
+from pathlib import Path
+from threading import Lock
 from typing import Any
 
 import numpy as np
 import xarray
 import xesmf
+from loguru import logger
+from numba import jit, prange
+from numpy.typing import NDArray
+from scipy import ndimage, sparse
+from scipy.spatial import KDTree
+
+from .io import atomic_path
+
+# Default location of the shared cache of regridding weights
+WEIGHT_CACHE_DIR = Path('/ptmp') / getuser() / 'regrid_weights'
+
+# Variables of a grid that the weights depend on
+_GRID_VARIABLES = ('lon', 'lat', 'lon_b', 'lat_b', 'mask')
+
+# Options to xesmf.Regridder that the KD-tree nearest neighbour weights
+# can stand in for. periodic makes no difference to the nearest point on the
+# sphere, and unmapped_to_nan is applied when the weights are used.
+_KDTREE_OPTIONS = {
+    'method',
+    'periodic',
+    'locstream_in',
+    'locstream_out',
+    'unmapped_to_nan',
+}
 
 
 def center_to_outer(center: xarray.DataArray, left=None, right=None) -> np.ndarray:
@@ -20,21 +52,551 @@ def center_to_outer(center: xarray.DataArray, left=None, right=None) -> np.ndarr
     return outer
 
 
+# ESMF is not thread safe, so regridders are built one at a time
+_build_lock = Lock()
+
+
+def _hash_grid(h: Any, grid: Any) -> None:
+    found = False
+    for name in _GRID_VARIABLES:
+        if name in grid:
+            values = np.ascontiguousarray(np.asarray(grid[name]))
+            h.update(f'{name} {values.dtype.str} {values.shape}'.encode())
+            h.update(values.tobytes())
+            found = True
+    if not found:
+        raise ValueError('Could not find lon and lat to identify the grid')
+
+
+def weights_key(ds_in: Any, ds_out: Any, *args: Any, **kwargs: Any) -> str:
+    """
+    Name for the weights of a regridder, from a hash of the coordinates
+    (and mask) of both grids and the other arguments to xesmf.Regridder
+    (method, periodic, locstream_in, ...).
+    """
+    h = hashlib.sha256()
+    _hash_grid(h, ds_in)
+    _hash_grid(h, ds_out)
+    h.update(repr(args).encode())
+    h.update(repr(sorted(kwargs.items())).encode())
+    return f'weights_{h.hexdigest()[:40]}'
+
+
+def _horizontal_shape(grid: Any, locstream: bool) -> tuple[int, ...]:
+    """
+    Shape of the horizontal part of a grid, as xesmf flattens it.
+    """
+    lon = np.asarray(grid['lon'])
+    if locstream or lon.ndim == 2:
+        return lon.shape
+    return (np.asarray(grid['lat']).size, lon.size)
+
+
+def _horizontal_dims(grid: Any, locstream: bool) -> tuple[str, ...]:
+    """
+    Names that xesmf gives the horizontal dimensions of the regridded data.
+    """
+    if locstream:
+        return ('locations',)
+    lon = grid['lon']
+    if lon.ndim == 2:
+        return tuple(lon.dims) if hasattr(lon, 'dims') else ('y', 'x')
+    return ('lat', 'lon')
+
+
+def _unit_vectors(grid: Any, locstream: bool) -> NDArray[np.float64]:
+    """
+    Points of a grid, flattened the same way as xesmf flattens it,
+    as unit vectors in 3D.
+    """
+    lon = np.asarray(grid['lon'], dtype=np.float64)
+    lat = np.asarray(grid['lat'], dtype=np.float64)
+    if not locstream and lon.ndim == 1:
+        lon, lat = np.meshgrid(lon, lat)
+    lon = np.deg2rad(lon.ravel())
+    lat = np.deg2rad(lat.ravel())
+    return np.column_stack(
+        (np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat))
+    )
+
+
+def nearest_s2d_indices(
+    ds_in: Any, ds_out: Any, locstream_in: bool = False, locstream_out: bool = False
+) -> NDArray[np.int64]:
+    """
+    Index of the nearest unmasked source point for each output point,
+    in the flattened grids, or -1 for masked output points: the same mapping
+    as xesmf's nearest_s2d, found with a KD-tree instead of ESMF.
+    Distances between unit vectors order points the same way as great-circle
+    distances, and need no special handling for periodic grids.
+    """
+    source = _unit_vectors(ds_in, locstream_in)
+    candidates = np.arange(len(source))
+    if 'mask' in ds_in:
+        valid = np.asarray(ds_in['mask']).ravel() != 0
+        source = source[valid]
+        candidates = candidates[valid]
+    _, nearest = KDTree(source).query(_unit_vectors(ds_out, locstream_out), workers=-1)
+    indices = candidates[nearest]
+    if 'mask' in ds_out:
+        indices[np.asarray(ds_out['mask']).ravel() == 0] = -1
+    return indices
+
+
+def gather_weights(indices: NDArray[np.int64]) -> xarray.Dataset:
+    """
+    Weights in the format that xesmf saves, for taking the source point
+    at each index (or nothing, where the index is -1).
+    """
+    rows = np.flatnonzero(indices >= 0)
+    return xarray.Dataset(
+        {
+            'S': ('n_s', np.ones(len(rows))),
+            'col': ('n_s', indices[rows] + 1),
+            'row': ('n_s', rows + 1),
+        }
+    )
+
+
+@jit(nogil=True, parallel=True)
+def _sparse_matmul(  # noqa: PLR0917
+    indptr: NDArray[np.int64],
+    indices: NDArray[np.int64],
+    weights: NDArray[np.float64],
+    x: NDArray[np.float64],
+    skipna: bool,
+    min_valid: float,
+    unmapped_to_nan: bool,
+) -> NDArray[np.float64]:
+    """
+    Weights (as a CSR matrix) times x, which has one column per field.
+    With skipna, missing source values are left out and the result is
+    divided by the sum of the weights of the valid source points, or is
+    missing if that sum is less than min_valid. Output points without
+    any weights are 0, or missing with unmapped_to_nan.
+    """
+    nout = len(indptr) - 1
+    nfield = x.shape[1]
+    out = np.empty((nout, nfield))
+    for i in prange(nout):
+        total = np.zeros(nfield)
+        valid = np.zeros(nfield)
+        for k in range(indptr[i], indptr[i + 1]):
+            w = weights[k]
+            row = x[indices[k]]
+            for f in range(nfield):
+                v = row[f]
+                if not skipna:
+                    total[f] += w * v
+                elif not np.isnan(v):
+                    total[f] += w * v
+                    valid[f] += w
+        for f in range(nfield):
+            if unmapped_to_nan and indptr[i] == indptr[i + 1]:
+                out[i, f] = np.nan
+            elif not skipna:
+                out[i, f] = total[f]
+            elif valid[f] >= min_valid:
+                out[i, f] = total[f] / valid[f]
+            else:
+                out[i, f] = np.nan
+    return out
+
+
+class SparseRegridder:
+    """
+    Applies xesmf weights as a sparse matrix product compiled with numba,
+    to all of the variables and time steps of a dataset in one pass
+    (or one pass per block for dask arrays), without holding the GIL.
+    Missing source values spread to the output like they do with xesmf,
+    unless skipna is True, in which case the weights of the valid points
+    are renormalized the same way as xesmf's skipna and na_thres.
+    Output points without any weights are 0, as with xesmf,
+    or missing if unmapped_to_nan is True.
+    """
+
+    def __init__(
+        self,
+        weights: sparse.csr_array,
+        shape_in: tuple[int, ...],
+        shape_out: tuple[int, ...],
+        *,
+        dims_out: tuple[str, ...],
+        lon_out: np.ndarray,
+        lat_out: np.ndarray,
+        locstream_in: bool = False,
+        skipna: bool = False,
+        na_thres: float = 1.0,
+        unmapped_to_nan: bool = False,
+    ):
+        self.weights = weights
+        self.shape_in = shape_in
+        self.shape_out = shape_out
+        self.dims_out = dims_out
+        self.lon_out = lon_out
+        self.lat_out = lat_out
+        self.locstream_in = locstream_in
+        self.skipna = skipna
+        self.unmapped_to_nan = unmapped_to_nan
+        # Same tolerance as xesmf
+        self.min_valid = float(np.clip(1 - na_thres, 1e-6, 1 - 1e-6))
+        # Weights that take at most one source point, with weight 1, for each
+        # output point (like nearest_s2d) are applied by indexing instead
+        counts = np.diff(weights.indptr)
+        self.gather: NDArray[np.int64] | None = None
+        if counts.max(initial=0) <= 1 and np.all(weights.data == 1):
+            self.gather = np.full(len(counts), -1, dtype=np.int64)
+            self.gather[counts == 1] = weights.indices
+
+    @classmethod
+    def from_file(
+        cls,
+        weights_file: Path,
+        shape_in: tuple[int, ...],
+        shape_out: tuple[int, ...],
+        **kwargs: Any,
+    ) -> 'SparseRegridder':
+        """
+        Read weights saved by xesmf (1-based row and col indices and weights S).
+        """
+        with xarray.open_dataset(weights_file) as w:
+            matrix = sparse.coo_array(
+                (w['S'].values, (w['row'].values - 1, w['col'].values - 1)),
+                shape=(int(np.prod(shape_out)), int(np.prod(shape_in))),
+            ).tocsr()
+        return cls(matrix, shape_in, shape_out, **kwargs)
+
+    def apply(self, *arrays: np.ndarray) -> list[np.ndarray]:
+        """
+        Regrid arrays whose last dimensions are the horizontal dimensions
+        of the source grid, all in one matrix product.
+        """
+        if self.gather is not None:
+            return [self._take(np.asarray(a)) for a in arrays]
+        nin = len(self.shape_in)
+        flat = [np.asarray(a).reshape(-1, int(np.prod(self.shape_in))) for a in arrays]
+        # One column per field
+        x = np.ascontiguousarray(np.concatenate(flat).T, dtype=np.float64)
+        out = _sparse_matmul(
+            self.weights.indptr.astype(np.int64),
+            self.weights.indices.astype(np.int64),
+            self.weights.data.astype(np.float64),
+            x,
+            self.skipna,
+            self.min_valid,
+            self.unmapped_to_nan,
+        )
+        results = []
+        start = 0
+        for a, f in zip(arrays, flat, strict=True):
+            dtype = a.dtype if np.issubdtype(a.dtype, np.floating) else np.float64
+            part = out[:, start:start + len(f)].T
+            results.append(
+                part.reshape(*a.shape[:a.ndim - nin], *self.shape_out).astype(dtype)
+            )
+            start += len(f)
+        return results
+
+    def _take(self, a: np.ndarray) -> np.ndarray:
+        lead = a.shape[:a.ndim - len(self.shape_in)]
+        dtype = a.dtype if np.issubdtype(a.dtype, np.floating) else np.float64
+        flat = a.reshape(*lead, -1)
+        out = np.take(flat, np.maximum(self.gather, 0), axis=-1).astype(dtype)
+        # With skipna, points without any valid source are missing
+        out[..., self.gather < 0] = (
+            np.nan if self.unmapped_to_nan or self.skipna else 0
+        )
+        return out.reshape(*lead, *self.shape_out)
+
+    @property
+    def sizes_out(self) -> dict[str, int]:
+        return dict(zip(self.dims_out, self.shape_out, strict=True))
+
+    def _source_dims(self, source: xarray.Dataset) -> tuple[str, ...]:
+        lon = source['lon']
+        if self.locstream_in or lon.ndim == 2:
+            return tuple(lon.dims)
+        return (source['lat'].dims[0], lon.dims[0])
+
+    def _coords_out(self) -> dict[str, tuple]:
+        if self.lon_out.ndim == 1 and len(self.dims_out) == 2:
+            return {
+                'lon': (self.dims_out[1:], self.lon_out),
+                'lat': (self.dims_out[:1], self.lat_out),
+            }
+        return {
+            'lon': (self.dims_out, self.lon_out),
+            'lat': (self.dims_out, self.lat_out),
+        }
+
+    def __call__(self, source: Any) -> Any:
+        """
+        Regrid a numpy array (with the horizontal dimensions last),
+        a DataArray, or every variable of a Dataset that has the
+        horizontal dimensions of the source grid.
+        """
+        if isinstance(source, np.ndarray):
+            return self.apply(source)[0]
+        if isinstance(source, xarray.DataArray):
+            name = source.name if source.name is not None else '__data'
+            out = self(source.to_dataset(name=name))[name]
+            out.name = source.name
+            return out
+
+        dims_in = self._source_dims(source)
+        names = [
+            v
+            for v in source.data_vars
+            if v not in {'lon', 'lat'} and set(dims_in) <= set(source[v].dims)
+        ]
+        # Drop the source coordinates, which are replaced by the output ones
+        horizontal = [
+            c for c in source.variables if set(source[c].dims) & set(dims_in)
+        ]
+        arrays = [
+            source[v].drop_vars(horizontal, errors='ignore').transpose(..., *dims_in)
+            for v in names
+        ]
+        nlead = [a.ndim - len(dims_in) for a in arrays]
+        if any(a.chunks is not None for a in arrays):
+            regridded = [
+                xarray.apply_ufunc(
+                    lambda x: self.apply(x)[0],
+                    a,
+                    input_core_dims=[list(dims_in)],
+                    output_core_dims=[list(self.dims_out)],
+                    exclude_dims=set(dims_in),
+                    dask='parallelized',
+                    dask_gufunc_kwargs={'output_sizes': self.sizes_out},
+                    output_dtypes=[a.dtype],
+                    keep_attrs=True,
+                )
+                for a in arrays
+            ]
+        else:
+            values = self.apply(*(a.values for a in arrays))
+            regridded = [
+                xarray.DataArray(
+                    v,
+                    dims=(*a.dims[:n], *self.dims_out),
+                    coords={
+                        c: a.coords[c]
+                        for c in a.coords
+                        if set(a.coords[c].dims) <= set(a.dims[:n])
+                    },
+                    attrs=a.attrs,
+                )
+                for a, v, n in zip(arrays, values, nlead, strict=True)
+            ]
+        out = xarray.Dataset(
+            dict(zip(names, regridded, strict=True)), attrs=source.attrs
+        )
+        return out.assign_coords(self._coords_out())
+
+
+@dataclass
+class WeightCacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+
+class WeightCache:
+    """
+    Regridding weights saved under root with names from weights_key, so that
+    weights are only reused for the same grids and options and never go
+    stale. root can be shared between jobs: a lock file makes sure that only
+    one process builds a given set of weights. The maxsize most recently used
+    regridders are also kept in memory, so that identical regridders
+    (such as for u and v on the same grid) are read or built once per process.
+    With kdtree, nearest_s2d weights are made by nearest_s2d_indices
+    rather than by ESMF, and are saved under a different name, since the two
+    can pick different points where several are equally near.
+    Only sparse skips ESMF entirely when the weights are cached; regridder
+    returns an xesmf.Regridder, which always sets up the ESMF grids.
+    """
+
+    def __init__(
+        self, root: Path = WEIGHT_CACHE_DIR, maxsize: int = 32, kdtree: bool = True
+    ):
+        self.root = root
+        self.maxsize = maxsize
+        self.kdtree = kdtree
+        self.stats = WeightCacheStats()
+        self._regridders: OrderedDict[str, Any] = OrderedDict()
+        self._lock = Lock()
+
+    def _get(
+        self,
+        name: str,
+        weights_file: Path,
+        read: Callable[[Path], Any],
+        build: Callable[[Path], Any],
+    ) -> Any:
+        """
+        Regridder from memory, or else read from weights_file,
+        or else built (which saves weights_file).
+        """
+        with self._lock:
+            if name in self._regridders:
+                self._regridders.move_to_end(name)
+                self.stats.memory_hits += 1
+                return self._regridders[name]
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        # The lock file is taken before the build lock, and released after it,
+        # so that waiting for another process cannot hold up this one's threads
+        with open(weights_file.with_suffix('.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            found = weights_file.is_file()
+            regrid = read(weights_file) if found else build(weights_file)
+
+        with self._lock:
+            if found:
+                self.stats.disk_hits += 1
+            else:
+                self.stats.misses += 1
+            self._regridders[name] = regrid
+            self._regridders.move_to_end(name)
+            while len(self._regridders) > self.maxsize:
+                self._regridders.popitem(last=False)
+        return regrid
+
+    def _uses_kdtree(self, args: tuple, kwargs: dict[str, Any]) -> bool:
+        """
+        Whether the weights for xesmf.Regridder(ds_in, ds_out, *args, **kwargs)
+        are made by nearest_s2d_indices instead of ESMF.
+        """
+        options = dict(kwargs)
+        if len(args) == 1:
+            options['method'] = args[0]
+        return (
+            self.kdtree
+            and len(args) <= 1
+            and options.get('method') == 'nearest_s2d'
+            and set(options) <= _KDTREE_OPTIONS
+        )
+
+    def _key(self, ds_in: Any, ds_out: Any, args: tuple, kwargs: dict) -> str:
+        """
+        Name for the weights, from weights_key and the method used to make them.
+        """
+        key = weights_key(ds_in, ds_out, *args, **kwargs)
+        if self._uses_kdtree(args, kwargs):
+            key += '_kdtree'
+        return key
+
+    def _build(
+        self, weights_file: Path, ds_in: Any, ds_out: Any, *args: Any, **kwargs: Any
+    ) -> xesmf.Regridder | None:
+        """
+        Save the weights for xesmf.Regridder(ds_in, ds_out, *args, **kwargs)
+        to weights_file, and return the regridder if ESMF was used to make them.
+        """
+        if self._uses_kdtree(args, kwargs):
+            logger.debug('Finding nearest points for {f}', f=weights_file)
+            indices = nearest_s2d_indices(
+                ds_in,
+                ds_out,
+                locstream_in=kwargs.get('locstream_in', False),
+                locstream_out=kwargs.get('locstream_out', False),
+            )
+            with atomic_path(weights_file) as tmp:
+                gather_weights(indices).to_netcdf(tmp)
+            return None
+
+        logger.debug('Building weights {f}', f=weights_file)
+        with _build_lock:
+            regrid = xesmf.Regridder(ds_in, ds_out, *args, **kwargs)
+        with atomic_path(weights_file) as tmp:
+            regrid.to_netcdf(tmp.as_posix())
+        return regrid
+
+    def regridder(
+        self, ds_in: Any, ds_out: Any, *args: Any, **kwargs: Any
+    ) -> xesmf.Regridder:
+        """
+        Same as xesmf.Regridder(ds_in, ds_out, *args, **kwargs),
+        with the weights from the cache if they are there.
+        Even with cached weights (including KD-tree ones), xesmf still builds
+        the ESMF grids to make the regridder; use sparse to avoid ESMF.
+        """
+        key = self._key(ds_in, ds_out, args, kwargs)
+
+        def read(weights_file: Path) -> xesmf.Regridder:
+            with _build_lock:
+                return xesmf.Regridder(
+                    ds_in,
+                    ds_out,
+                    *args,
+                    reuse_weights=True,
+                    filename=weights_file.as_posix(),
+                    **kwargs,
+                )
+
+        def build(weights_file: Path) -> xesmf.Regridder:
+            regrid = self._build(weights_file, ds_in, ds_out, *args, **kwargs)
+            return read(weights_file) if regrid is None else regrid
+
+        return self._get(key, self.root / f'{key}.nc', read, build)
+
+    def sparse(
+        self, ds_in: Any, ds_out: Any, *args: Any, **kwargs: Any
+    ) -> 'SparseRegridder':
+        """
+        SparseRegridder with the same weights as
+        xesmf.Regridder(ds_in, ds_out, *args, **kwargs).
+        Weights that are already saved are read without involving ESMF.
+        """
+        key = self._key(ds_in, ds_out, args, kwargs)
+        locstream_in = kwargs.get('locstream_in', False)
+        locstream_out = kwargs.get('locstream_out', False)
+
+        def read(weights_file: Path) -> SparseRegridder:
+            return SparseRegridder.from_file(
+                weights_file,
+                _horizontal_shape(ds_in, locstream_in),
+                _horizontal_shape(ds_out, locstream_out),
+                dims_out=_horizontal_dims(ds_out, locstream_out),
+                lon_out=np.asarray(ds_out['lon']),
+                lat_out=np.asarray(ds_out['lat']),
+                locstream_in=locstream_in,
+                unmapped_to_nan=kwargs.get('unmapped_to_nan', False),
+            )
+
+        def build(weights_file: Path) -> SparseRegridder:
+            self._build(weights_file, ds_in, ds_out, *args, **kwargs)
+            return read(weights_file)
+
+        return self._get(f'{key} sparse', self.root / f'{key}.nc', read, build)
+
+
+@cache
+def default_weight_cache() -> WeightCache:
+    """
+    The shared cache in WEIGHT_CACHE_DIR, created on first use.
+    """
+    return WeightCache()
+
+
 def reuse_regrid(*args: Any, **kwargs: Any) -> xesmf.Regridder:
-    filename = kwargs.pop('filename', None)
+    """
+    Build an xesmf.Regridder. With reuse_weights=True, the weights come from
+    a WeightCache (cache, or the shared default one if not given),
+    which finds them by the content of the grids rather than by a file name.
+    filename is still accepted, for old callers, but is not used.
+    """
+    kwargs.pop('filename', None)
+    cache = kwargs.pop('cache', None)
     reuse_weights = kwargs.pop('reuse_weights', False)
 
     if reuse_weights:
-        if os.path.isfile(filename):
-            return xesmf.Regridder(
-                *args, reuse_weights=True, filename=filename, **kwargs
-            )
-        else:
-            regrid = xesmf.Regridder(*args, **kwargs)
-            regrid.to_netcdf(filename)
-            return regrid
+        if cache is None:
+            cache = default_weight_cache()
+        return cache.regridder(*args, **kwargs)
     else:
-        regrid = xesmf.Regridder(*args, **kwargs)
+        with _build_lock:
+            regrid = xesmf.Regridder(*args, **kwargs)
         return regrid
 
 
@@ -44,3 +606,85 @@ def round_coords(
     ds[lat] = np.round(ds[lat] * to) / to
     ds[lon] = np.round(ds[lon] * to) / to
     return ds
+
+
+def _fill_nearest_2d(a: np.ndarray) -> np.ndarray:
+    missing = np.isnan(a)
+    if not missing.any() or missing.all():
+        return a
+    # Index of the nearest valid point for every point
+    nearest = ndimage.distance_transform_edt(
+        missing, return_distances=False, return_indices=True
+    )
+    return a[tuple(nearest)]
+
+
+def fill_nearest(da: xarray.DataArray, xdim: str, ydim: str) -> xarray.DataArray:
+    """
+    Fill missing values with the value of the nearest valid point on the same
+    horizontal slice, measured in grid points (similar to cdo setmisstonn
+    on a regular grid). Slices that are entirely missing are left alone.
+    """
+    return xarray.apply_ufunc(
+        _fill_nearest_2d,
+        da,
+        input_core_dims=[[ydim, xdim]],
+        output_core_dims=[[ydim, xdim]],
+        vectorize=True,
+        dask='parallelized',
+        output_dtypes=[da.dtype],
+    ).transpose(*da.dims)
+
+
+def fill_nearest_window(
+    da: xarray.DataArray,
+    window: dict[str, slice],
+    xdim: str,
+    ydim: str,
+    pad: int = 8,
+) -> xarray.DataArray:
+    """
+    Same as fill_nearest(da).isel(window), reading and filling only window
+    widened by pad points where that gives the same values: on horizontal
+    slices where every missing point in window is closer to a valid point
+    than to the edge of the widened window. Other slices (such as deep levels
+    with no valid points near the window) are filled from all of da.
+    """
+    window = {d: slice(*w.indices(da.sizes[d])[:2]) for d, w in window.items()}
+    wide = {
+        d: slice(max(w.start - pad, 0), min(w.stop + pad, da.sizes[d]))
+        for d, w in window.items()
+    }
+    part = da.isel(wide).transpose(..., ydim, xdim).load()
+    values = part.values.copy()
+    inner = tuple(
+        slice(window[d].start - wide[d].start, window[d].stop - wide[d].start)
+        for d in (ydim, xdim)
+    )
+    # Edges of the widened window that are also edges of da are not a limit
+    margin = min(
+        [np.inf]
+        + [w.start - wide[d].start for d, w in window.items() if wide[d].start > 0]
+        + [
+            wide[d].stop - w.stop
+            for d, w in window.items()
+            if wide[d].stop < da.sizes[d]
+        ]
+    )
+    lead_dims = part.dims[:-2]
+    for idx in np.ndindex(values.shape[:-2]):
+        missing = np.isnan(values[idx])
+        if not missing.any():
+            continue
+        if not missing.all():
+            distance, nearest = ndimage.distance_transform_edt(
+                missing, return_indices=True
+            )
+            if distance[inner].max() <= margin:
+                values[idx] = values[idx][tuple(nearest)]
+                continue
+        level = da.isel(dict(zip(lead_dims, idx, strict=True)))
+        filled = fill_nearest(level.load(), xdim, ydim).isel(wide)
+        values[idx] = filled.transpose(ydim, xdim).values
+    filled = part.copy(data=values).isel(dict(zip((ydim, xdim), inner, strict=True)))
+    return filled.transpose(*da.dims)
@@ -0,0 +1,120 @@
+# Listing of archive directories, to avoid repeated stat calls on slow filesystems
+import datetime as dt
+import json
+import os
+from collections.abc import Iterable
+from concurrent import futures
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from loguru import logger
+
+# Suffix given to files that are still being transferred by gcp
+PARTIAL_SUFFIX = '.gcp'
+
+
+def _list_dir(directory: Path) -> dict[str, int]:
+    """
+    Names and sizes of the files in one directory,
+    or an empty dict if the directory does not exist.
+    """
+    try:
+        with os.scandir(directory) as it:
+            return {e.name: e.stat().st_size for e in it if e.is_file()}
+    except FileNotFoundError:
+        return {}
+
+
+@dataclass
+class ArchiveInventory:
+    """
+    Names and sizes of the files in a set of directories (such as the history
+    directories of many experiments), listed once and then queried from memory.
+    Queries for paths outside of the listed directories fall back
+    to checking the filesystem.
+    """
+
+    directories: dict[str, dict[str, int]] = field(default_factory=dict)
+    created: dt.datetime = field(default_factory=dt.datetime.now)
+
+    @classmethod
+    def scan(cls, directories: Iterable[Path], threads: int = 8) -> 'ArchiveInventory':
+        """
+        List every directory, several at a time.
+        """
+        directories = sorted(set(directories))
+        logger.info(f'Listing {len(directories)} directories')
+        with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            listings = executor.map(_list_dir, directories)
+            return cls(
+                directories={
+                    d.as_posix(): files
+                    for d, files in zip(directories, listings, strict=True)
+                }
+            )
+
+    def save(self, manifest_dir: Path) -> Path:
+        """
+        Save the inventory as a manifest named with the time it was created.
+        """
+        manifest_dir.mkdir(parents=True, exist_ok=True)
+        manifest = manifest_dir / f'inventory_{self.created:%Y%m%dT%H%M%S}.json'
+        with open(manifest, 'w') as f:
+            json.dump(
+                {'created': self.created.isoformat(), 'directories': self.directories},
+                f,
+            )
+        return manifest
+
+    @classmethod
+    def load(cls, manifest: Path) -> 'ArchiveInventory':
+        with open(manifest) as f:
+            saved = json.load(f)
+        return cls(
+            directories=saved['directories'],
+            created=dt.datetime.fromisoformat(saved['created']),
+        )
+
+    @classmethod
+    def latest(
+        cls, manifest_dir: Path, max_age: dt.timedelta | None = None
+    ) -> 'ArchiveInventory | None':
+        """
+        Load the most recent manifest in manifest_dir,
+        unless there is none or it is older than max_age.
+        """
+        manifests = sorted(manifest_dir.glob('inventory_*.json'))
+        if len(manifests) == 0:
+            return None
+        inventory = cls.load(manifests[-1])
+        if max_age is not None and dt.datetime.now() - inventory.created > max_age:
+            return None
+        return inventory
+
+    def covers(self, directory: Path) -> bool:
+        return directory.as_posix() in self.directories
+
+    def size(self, path: Path) -> int | None:
+        """
+        Size of a file, or None if it does not exist.
+        """
+        if not self.covers(path.parent):
+            return path.stat().st_size if path.is_file() else None
+        return self.directories[path.parent.as_posix()].get(path.name)
+
+    def exists(self, path: Path) -> bool:
+        return self.size(path) is not None
+
+    def is_partial(self, path: Path) -> bool:
+        """
+        Is the file still being transferred (is there a .gcp file for it)?
+        """
+        return self.exists(path.with_name(path.name + PARTIAL_SUFFIX))
+
+    def files(self, directory: Path) -> list[str]:
+        """
+        Names of all of the files in a directory.
+        """
+        if not self.covers(directory):
+            return sorted(_list_dir(directory))
+        return sorted(self.directories[directory.as_posix()])
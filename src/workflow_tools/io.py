@@ -1,15 +1,34 @@
 import errno
-from dataclasses import dataclass
-from functools import singledispatchmethod
+import fnmatch
+import shlex
+import subprocess
+import time
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    InvalidStateError,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import cache, partial, singledispatchmethod
 from getpass import getuser
-from os import environ
+from os import environ, getpid, replace, scandir
 from pathlib import Path
 from shutil import which
+from threading import Lock, Thread
 from typing import Any
 
+import netCDF4
+import numpy as np
 import xarray
 from loguru import logger
+from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK
 
+from .cache import ScratchCache
+from .tarindex import TarIndex
 from .utils import run_cmd
 
 
@@ -21,11 +40,170 @@ def _run_cmd_silently(cmd: str) -> None:
     res = run_cmd(cmd, text=True, capture_output=True)
     logger.debug(res.stdout)
 
+
+# Commands are looked up once per process rather than on every call
+_which = cache(which)
+
+# dmget error message for a file that cannot be recalled (e.g., a bad tape)
+_DMGET_BAD_FILE = 'unable to recall the requested file'
+
+
+@dataclass
+class RecallReport:
+    recalled: list[Path] = field(default_factory=list)
+    failed: list[Path] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return len(self.failed) == 0
+
+
+@dataclass
+class DMGet:
+    """
+    Recall files from tape with dmget, isolating files that cannot be recalled.
+    All files are first requested with one command so that dmget can order
+    the tape reads. If that fails because of a bad file, the batch is split
+    in half and each half is requested again, concurrently, until the bad
+    files are isolated. Single files are retried with a growing delay
+    before giving up on them.
+
+    command: the dmget command. Set the DMGET environment variable to use
+      a stand-in, such as tests/fake_dmget.py (which fails for configured
+      files), when testing away from the archive.
+    max_outstanding: maximum number of dmget commands running at once.
+    retries: number of times to retry a single file, or a batch that
+      failed for a reason other than a bad file.
+    backoff: seconds to wait before the first retry; doubles each time.
+    """
+
+    command: str = environ.get('DMGET', 'dmget')
+    max_outstanding: int = 4
+    retries: int = 2
+    backoff: float = 30.0
+
+    def _run(self, paths: list[Path]) -> subprocess.CompletedProcess:
+        cmd = [*shlex.split(self.command), *(p.as_posix() for p in paths)]
+        logger.debug(f'{self.command} ({len(paths)} files)')
+        return subprocess.run(cmd, capture_output=True, text=True, check=False)
+
+    def _attempt(self, paths: list[Path]) -> bool:
+        """
+        Request a batch of files. Returns False if the batch contains a file
+        that could not be recalled, and raises if dmget failed for any other
+        reason on every try.
+        """
+        tries = self.retries + 1
+        for n in range(tries):
+            res = self._run(paths)
+            if res.returncode == 0:
+                return True
+            bad_file = _DMGET_BAD_FILE in res.stderr
+            # Bad files in batches are isolated by splitting instead of retrying
+            if bad_file and len(paths) > 1:
+                return False
+            if n < tries - 1:
+                delay = self.backoff * 2**n
+                logger.warning(f'{self.command} failed; retrying in {delay:.0f} s')
+                time.sleep(delay)
+        if bad_file:
+            logger.error(f'Could not recall {paths[0]}')
+            return False
+        raise subprocess.CalledProcessError(
+            res.returncode, res.args, output=res.stdout, stderr=res.stderr
+        )
+
+    def __call__(self, paths: list[Path]) -> RecallReport:
+        report = RecallReport()
+        if len(paths) == 0:
+            return report
+        if _which(shlex.split(self.command)[0]) is None:
+            logger.info('Not using dmget')
+            report.recalled.extend(paths)
+            return report
+        with ThreadPoolExecutor(max_workers=self.max_outstanding) as executor:
+            pending: dict[Future, list[Path]] = {
+                executor.submit(self._attempt, paths): paths
+            }
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    batch = pending.pop(fut)
+                    if fut.result():
+                        report.recalled.extend(batch)
+                    elif len(batch) > 1:
+                        half = len(batch) // 2
+                        logger.warning(
+                            f'dmget of {len(batch)} files failed; splitting in two'
+                        )
+                        for part in (batch[:half], batch[half:]):
+                            pending[executor.submit(self._attempt, part)] = part
+                    else:
+                        report.failed.extend(batch)
+        return report
+
+
+def _notify(callback: Callable[[Path], None], fut: Future) -> None:
+    if not fut.cancelled() and fut.exception() is None:
+        callback(fut.result())
+
+
+def _resolve(
+    fut: Future, result: Any = None, error: BaseException | None = None
+) -> None:
+    """
+    Set the result (or error) of a future unless it is already done,
+    since it may have been cancelled or failed by the recall report.
+    """
+    try:
+        if error is None:
+            fut.set_result(result)
+        else:
+            fut.set_exception(error)
+    except InvalidStateError:
+        pass
+
+
+def _recall(dmget: DMGet, paths: list[Path], report: Future[RecallReport]) -> None:
+    try:
+        report.set_result(dmget(paths))
+    except Exception as err:
+        report.set_exception(err)
+
+
 @dataclass
 class HSMGet:
+    """
+    Copy files from archive to tmp with hsmget, skipping files that are
+    already cached in tmp.
+    Lists of files are split into chunks of up to chunk_size files,
+    and up to workers hsmget commands run at once.
+    """
+
     archive: Path = Path('/')  # hopefully this will duplicate paths used by frepp
     ptmp: Path = Path('/ptmp') / getuser()
     tmp: Path = Path(environ.get('TMPDIR', ptmp))
+    # Optional limit (in bytes) on the space used by files copied to tmp
+    quota: int | None = None
+    workers: int = 4
+    chunk_size: int = 4
+    _executor: ThreadPoolExecutor | None = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _lock: Lock = field(default_factory=Lock, init=False, repr=False, compare=False)
+
+    @property
+    def cache(self) -> ScratchCache:
+        return ScratchCache(self.tmp, quota=self.quota)
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='hsmget'
+                )
+            return self._executor
 
     @singledispatchmethod
     def __call__(self, path_or_paths: Any) -> Any:
@@ -40,34 +218,155 @@ class HSMGet:
 
     @__call__.register
     def _call_path(self, path: Path) -> Path:
-        if which('hsmget') is None:
+        if _which('hsmget') is None:
             logger.info('Not using hsmget')
             return path
         relative = path.relative_to(self.archive)
+        if self.cache.lookup(self.tmp / relative):
+            logger.debug(f'Using cached {self.tmp / relative}')
+            return self.tmp / relative
         # hsmget will do the dmget first and this is fine since it's one file
         cmd = f'hsmget -q -a {self.archive} -w {self.tmp} -p {self.ptmp} {relative}'
         _run_cmd_silently(cmd)
+        self.cache.add(self.tmp / relative)
         return self.tmp / relative
 
     @__call__.register
     def _call_paths(self, paths: list) -> list[Path]:
-        if which('hsmget') is None:
+        return [f.result() for f in self.submit(paths)]
+
+    def submit(
+        self, paths: list[Path], callback: Callable[[Path], None] | None = None
+    ) -> list[Future[Path]]:
+        """
+        Start copying files without waiting for them.
+        Returns a future for each path, in the same order, that gives the
+        copied file once the chunk holding it is done. Chunks are started
+        in order, so the first files are usually ready first; use
+        concurrent.futures.as_completed to handle each file as it arrives.
+        callback, if given, is called with each copied file as soon as
+        it is ready (from a worker thread).
+        """
+        file_futures: list[Future[Path]] = [Future() for _ in paths]
+        if callback is not None:
+            for fut in file_futures:
+                fut.add_done_callback(partial(_notify, callback))
+        if _which('hsmget') is None:
             logger.info('Not using hsmget')
-            return paths
-        p_str = ' '.join([p.as_posix() for p in paths])
-        _run_cmd_silently(f'dmget {p_str}')
-        relative = [p.relative_to(self.archive) for p in paths]
-        rel_str = ' '.join([r.as_posix() for r in relative])
+            for fut, path in zip(file_futures, paths, strict=True):
+                fut.set_result(path)
+            return file_futures
+        relatives = [path.relative_to(self.archive) for path in paths]
+        cached = self.cache.lookup_many([self.tmp / r for r in relatives])
+        missing = []
+        for fut, relative, found in zip(file_futures, relatives, cached, strict=True):
+            if found:
+                fut.set_result(self.tmp / relative)
+            else:
+                missing.append((relative, fut))
+        if len(missing) > 0:
+            # Request all of the files from tape at once, in the background,
+            # so that dmget can order the reads. Each hsmget then only waits
+            # for the files in its own chunk.
+            recall: Future[RecallReport] = Future()
+            Thread(
+                target=_recall,
+                args=(DMGet(), [self.archive / r for r, _ in missing], recall),
+                name='hsmget-dmget',
+                daemon=True,
+            ).start()
+            recall.add_done_callback(partial(self._fail_unrecalled, missing))
+            for i in range(0, len(missing), self.chunk_size):
+                self.executor.submit(
+                    self._get_chunk, missing[i : i + self.chunk_size], recall
+                )
+        return file_futures
+
+    def _fail_unrecalled(
+        self, missing: list[tuple[Path, Future[Path]]], recall: Future[RecallReport]
+    ) -> None:
+        """
+        Fail the futures for files that dmget could not recall,
+        so that hsmget does not go to tape for them again.
+        """
+        if recall.exception() is not None:
+            logger.warning(f'dmget failed: {recall.exception()}')
+            return
+        failed = set(recall.result().failed)
+        for r, fut in missing:
+            if self.archive / r in failed:
+                _resolve(
+                    fut,
+                    error=OSError(
+                        errno.EIO,
+                        'Could not recall file from tape',
+                        (self.archive / r).as_posix(),
+                    ),
+                )
+
+    def _get_chunk(
+        self, chunk: list[tuple[Path, Future[Path]]], recall: Future[RecallReport]
+    ) -> None:
+        try:
+            self._copy_chunk(chunk, recall)
+        except Exception as err:
+            # Every future has to be resolved, or callers would wait forever
+            for _, fut in chunk:
+                _resolve(fut, error=err)
+
+    def _copy_chunk(
+        self, chunk: list[tuple[Path, Future[Path]]], recall: Future[RecallReport]
+    ) -> None:
+        # Files that are cancelled or known to be unrecallable are skipped
+        chunk = [(r, fut) for r, fut in chunk if not fut.done()]
+        if len(chunk) == 0:
+            return
+        rel_str = ' '.join(r.as_posix() for r, _ in chunk)
         cmd = f'hsmget -q -a {self.archive} -w {self.tmp} -p {self.ptmp} {rel_str}'
-        _run_cmd_silently(cmd)
-        return [self.tmp / r for r in relative]
+        try:
+            _run_cmd_silently(cmd)
+        except Exception:
+            # If the failure was from files that dmget could not recall,
+            # those have been failed by now, and the rest can be tried again
+            if recall.exception() is not None:
+                raise
+            failed = set(recall.result().failed)
+            if not any(self.archive / r in failed for r, _ in chunk):
+                raise
+            self._fail_unrecalled(chunk, recall)
+            self._copy_chunk(
+                [(r, fut) for r, fut in chunk if self.archive / r not in failed],
+                recall,
+            )
+            return
+        cache = self.cache
+        for r, fut in chunk:
+            try:
+                cache.add(self.tmp / r)
+            except Exception as err:
+                _resolve(fut, error=err)
+            else:
+                _resolve(fut, self.tmp / r)
 
 
-def open_var(
-    pp_root: Path, kind: str, var: str, hsmget: HSMGet | None = None
-) -> xarray.DataArray:
-    if hsmget is None:
-        hsmget = HSMGet()
+@cache
+def _list_pp_dir(pp_dir: Path) -> dict[str, list[str]]:
+    """
+    Names of the files in each chunk subdirectory (e.g. 5yr) of a
+    post-processed directory. Cached so that each directory is only
+    listed once per process, however many variables are opened from it.
+    """
+    listing = {}
+    for chunk in pp_dir.glob('*yr'):
+        with scandir(chunk) as it:
+            listing[chunk.name] = sorted(e.name for e in it if e.is_file())
+    return listing
+
+
+def find_pp_files(pp_root: Path, kind: str, var: str) -> list[Path]:
+    """
+    Post-processed files for one variable, from the largest chunk that has any.
+    """
     freq = 'daily' if 'daily' in kind else 'monthly'
     pp_dir = pp_root / 'pp' / kind / 'ts' / freq
     if not pp_dir.is_dir():
@@ -76,46 +375,283 @@ def open_var(
         )
     # Get all of the available post-processing chunk directories
     # (assuming chunks in units of years)
-    available_chunks = list(pp_dir.glob('*yr'))
-    if len(available_chunks) == 0:
+    listing = _list_pp_dir(pp_dir)
+    if len(listing) == 0:
         raise FileNotFoundError(
             errno.ENOENT, 'Could not find post-processed chunk subdirectory'
         )
     # Sort from longest to shortest chunk
-    sorted_chunks = sorted(
-        available_chunks, key=lambda x: int(x.name[0:-2]), reverse=True
-    )
+    sorted_chunks = sorted(listing, key=lambda x: int(x[0:-2]), reverse=True)
     for chunk in sorted_chunks:
         # Look through the available chunks and return for the
         # largest chunk that has file(s).
-        matching_files = list(chunk.glob(f'{kind}.*.{var}.nc'))
-        # Treat 1 and > 1 files separately,
-        # though the > 1 case could probably handle both.
-        if len(matching_files) > 1:
-            tmpfiles = hsmget(sorted(matching_files))
-            return xarray.open_mfdataset(tmpfiles, decode_timedelta=True)[
-                var
-            ]  # Avoid FutureWarning about decode_timedelta
-        elif len(matching_files) == 1:
-            tmpfile = hsmget(matching_files[0])
-            return xarray.open_dataset(tmpfile, decode_timedelta=True)[
-                var
-            ]  # Avoid FutureWarning about decode_timedelta
+        matching_files = fnmatch.filter(listing[chunk], f'{kind}.*.{var}.nc')
+        if len(matching_files) > 0:
+            return [pp_dir / chunk / f for f in matching_files]
     raise FileNotFoundError(
         errno.ENOENT,
         'Could not find any post-processed files. Check if frepp failed.',
     )
 
 
-def write_ds(ds: xarray.Dataset, fout: str | Path) -> None:
+def open_var(
+    pp_roots: Path | list[Path],
+    kind: str,
+    var: str,
+    hsmget: HSMGet | None = None,
+) -> xarray.DataArray:
+    """
+    Open a post-processed variable from one or more experiments
+    (e.g. an analysis and the experiments that extended it),
+    concatenated in time in the order the experiments are given.
+    The files are combined in order without comparing their coordinates,
+    which assumes that they are all on the same grid.
+    """
+    if hsmget is None:
+        hsmget = HSMGet()
+    if isinstance(pp_roots, Path):
+        pp_roots = [pp_roots]
+    files = [f for root in pp_roots for f in find_pp_files(root, kind, var)]
+    tmpfiles = hsmget(files)
+    # Monthly files hold whole years, so chunks of 12 line up with the files.
+    # Daily files are kept in one chunk each since years differ in length.
+    time_chunk = -1 if 'daily' in kind else 12
+    ds = xarray.open_mfdataset(
+        tmpfiles,
+        combine='nested',
+        concat_dim='time',
+        data_vars='minimal',
+        coords='minimal',
+        compat='override',
+        parallel=True,
+        chunks={'time': time_chunk},
+        decode_timedelta=True,  # Avoid FutureWarning about decode_timedelta
+    )
+    return ds[var]
+
+
+@contextmanager
+def atomic_path(path: Path) -> Iterator[Path]:
+    """
+    Temporary path, hidden in the same directory as path, to write to
+    instead of path. It is renamed to path only if the block completes,
+    so readers never see a half-written file and a crash leaves
+    no partial file under the final name.
+    """
+    tmp = path.with_name(f'.{path.name}.{getpid()}.tmp')
+    try:
+        yield tmp
+        replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+@contextmanager
+def open_tar_member(
+    index: TarIndex, name: str, **kwargs: Any
+) -> Iterator[xarray.Dataset]:
+    """
+    Open a netCDF file stored in an uncompressed tar file without
+    extracting it, by handing netCDF4 a memory-mapped view of the member.
+    The dataset is only valid inside the context.
+    """
+    with index.view(name) as view, open_netcdf4(name, memory=view) as nc:
+        # The store reads under NETCDF4_PYTHON_LOCK by default
+        store = xarray.backends.NetCDF4DataStore(nc)
+        with xarray.open_dataset(store, **kwargs) as ds:
+            yield ds
+
+
+@contextmanager
+def open_netcdf4(
+    path: str | Path, mode: str = 'r', **kwargs: Any
+) -> Iterator[netCDF4.Dataset]:
+    """
+    netCDF4.Dataset opened and closed under xarray's NETCDF4_PYTHON_LOCK.
+    netCDF-C is not thread safe, and netCDF4 releases the GIL, so any other call
+    on the Dataset has to hold the lock too, like the reads and writes done
+    through xarray in other threads do. The lock is not reentrant: do not hold
+    it while computing dask arrays that read files through xarray.
+    The Dataset is closed even if the block fails, which also releases
+    a buffer passed as memory.
+    """
+    with NETCDF4_PYTHON_LOCK:
+        nc = netCDF4.Dataset(path, mode, **kwargs)
+    try:
+        yield nc
+    finally:
+        with NETCDF4_PYTHON_LOCK:
+            if nc.isopen():
+                nc.close()
+
+
+# Attributes of a variable in a file that determine how its values are encoded
+_ENCODING_ATTRS = (
+    'units',
+    'calendar',
+    '_FillValue',
+    'missing_value',
+    'scale_factor',
+    'add_offset',
+)
+
+
+def _repeats(data: Any) -> bool:
+    """
+    Whether data is a numpy view that repeats its values along some dimension
+    (as made by np.broadcast_to or expand_dims), and so takes much less
+    memory than a copy of it would.
+    """
+    return isinstance(data, np.ndarray) and any(
+        stride == 0 and n > 1
+        for stride, n in zip(data.strides, data.shape, strict=True)
+    )
+
+
+def _stream_repeats(ds: xarray.Dataset, dim: str) -> xarray.Dataset:
+    """
+    ds with the repeating views along dim in dask arrays of one record
+    per chunk, so that to_netcdf encodes and writes them a record at a time
+    instead of copying them whole.
+    """
+    chunked = {
+        name: da.chunk({d: 1 if d == dim else -1 for d in da.dims})
+        for name, da in ds.data_vars.items()
+        if dim in da.dims and _repeats(da.data)
+    }
+    return ds.assign(chunked) if chunked else ds
+
+
+def write_records(
+    nc: netCDF4.Dataset,
+    ds: xarray.Dataset,
+    dim: str = 'time',
+    start: int | None = None,
+) -> int:
+    """
+    Write the records in ds to an open netCDF file, along its unlimited
+    dimension dim, starting at record start (by default, after the last
+    record, to append). Existing records from start on are overwritten.
+    Values are encoded the same way as the ones already in the file
+    (units, calendar, fill value, and dtype are read from the file).
+    Variables that are repeating views (such as thicknesses broadcast over
+    time) are encoded and written one record at a time.
+    Variables without dim are assumed to be in the file already and are skipped.
+    Calls on nc are made under NETCDF4_PYTHON_LOCK (see open_netcdf4),
+    while the values are computed and encoded outside of it.
+    Returns the number of records in the file afterwards.
+    """
+    with NETCDF4_PYTHON_LOCK:
+        if start is None:
+            start = len(nc.dimensions[dim])
+        nc.set_auto_maskandscale(False)
+    for name, da in ds.variables.items():
+        if dim not in da.dims:
+            continue
+        with NETCDF4_PYTHON_LOCK:
+            ncvar = nc.variables[name]
+            encoding = {
+                k: ncvar.getncattr(k) for k in _ENCODING_ATTRS if k in ncvar.ncattrs()
+            }
+            encoding['dtype'] = ncvar.dtype
+            ncdims = ncvar.dimensions
+        var = xarray.Variable(da.dims, da.data, encoding=encoding)
+        n = var.sizes[dim]
+        step = 1 if _repeats(var.data) else max(n, 1)
+        for i in range(0, n, step):
+            part = var.isel({dim: slice(i, i + step)})
+            encoded = xarray.conventions.encode_cf_variable(part, name=name)
+            values = encoded.transpose(*ncdims).values
+            with NETCDF4_PYTHON_LOCK:
+                ncvar[start + i:start + i + part.sizes[dim]] = values
+    with NETCDF4_PYTHON_LOCK:
+        return len(nc.dimensions[dim])
+
+
+# Size of the blocks of records that data not chunked with dask is written in
+_BLOCK_BYTES = 256 * 2**20
+
+
+def _default_block(ds: xarray.Dataset, dim: str) -> int:
+    """
+    Number of records along dim that take about _BLOCK_BYTES.
+    """
+    n = max(ds.sizes[dim], 1)
+    record = sum(v.nbytes // n for v in ds.variables.values() if dim in v.dims)
+    return max(1, _BLOCK_BYTES // max(record, 1))
+
+
+def _blocks(
+    ds: xarray.Dataset, dim: str, block: int | None
+) -> Iterator[xarray.Dataset]:
+    """
+    Split ds along dim into blocks of the given size, or if block is None,
+    matching its dask chunks or of about _BLOCK_BYTES if it is not chunked.
+    """
+    n = ds.sizes[dim]
+    if block is None:
+        try:
+            chunks = ds.chunksizes.get(dim)
+        except ValueError:
+            # Variables are chunked differently
+            chunks = [n]
+        if chunks is not None:
+            sizes = list(chunks)
+        else:
+            block = _default_block(ds, dim)
+    if block is not None:
+        sizes = [block] * -(-n // block)
+    start = 0
+    for size in sizes or [0]:
+        yield ds.isel({dim: slice(start, start + size)})
+        start += size
+
+
+def write_netcdf3(
+    source: xarray.Dataset | Iterable[xarray.Dataset],
+    fout: str | Path,
+    encoding: dict | None = None,
+    time_block: int | None = None,
+    dim: str = 'time',
+) -> None:
+    """
+    Write a NETCDF3_64BIT file with an unlimited dim, one block of records
+    at a time, so that only one block needs to be in memory.
+    source: a dataset, which is written in blocks of time_block records
+      (or if time_block is None, following its dask chunks, or in blocks
+      of about 256 MB if it is not chunked),
+      or an iterable of datasets that are written one after another.
+    encoding: passed to to_netcdf when the first block creates the file;
+      later blocks are encoded to match what is in the file.
+    Variables that are repeating views along dim (such as thicknesses
+    broadcast over time) are written a record at a time without being copied.
+    """
+    if isinstance(source, xarray.Dataset):
+        blocks = _blocks(source, dim, time_block)
+    else:
+        blocks = iter(source)
+    with atomic_path(Path(fout)) as tmp:
+        _stream_repeats(next(blocks), dim).to_netcdf(
+            tmp,
+            format='NETCDF3_64BIT',
+            engine='netcdf4',
+            encoding=encoding,
+            unlimited_dims=[dim],
+        )
+        with open_netcdf4(tmp, 'a') as nc:
+            for block in blocks:
+                write_records(nc, block, dim=dim)
+
+
+def write_ds(
+    ds: xarray.Dataset, fout: str | Path, time_block: int | None = None
+) -> None:
     for v in ds:
         if ds[v].dtype == 'float64':
             ds[v].encoding['_FillValue'] = 1.0e20
-    ds.to_netcdf(
+    write_netcdf3(
+        ds,
         fout,
-        format='NETCDF3_64BIT',
-        engine='netcdf4',
         encoding={'time': {'dtype': 'float64', 'calendar': 'gregorian'}},
-        unlimited_dims=['time'],
+        time_block=time_block,
     )
-
@@ -0,0 +1,379 @@
+# Reading and rewriting the headers of classic and 64-bit offset netCDF files,
+# to concatenate files along the record dimension without decoding the data
+import struct
+from collections.abc import Sequence
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import BinaryIO
+
+import netCDF4
+
+from .io import atomic_path
+
+# Tags in the header
+_ABSENT = 0
+_NC_DIMENSION = 10
+_NC_VARIABLE = 11
+_NC_ATTRIBUTE = 12
+
+# Format characters (big endian) and sizes for each netCDF type
+NC_CHAR = 2
+_TYPES = {
+    1: ('b', 1),  # byte
+    NC_CHAR: ('c', 1),
+    3: ('h', 2),  # short
+    4: ('i', 4),  # int
+    5: ('f', 4),  # float
+    6: ('d', 8),  # double
+}
+
+# Size of the blocks to copy between files
+_BLOCK_SIZE = 16 * 1024 * 1024
+
+# Number of time units in a day, by the first word of the units attribute
+_PER_DAY = {'days': 1, 'hours': 24, 'minutes': 24 * 60, 'seconds': 24 * 60 * 60}
+
+
+def _pad4(n: int) -> int:
+    return -n % 4
+
+
+@dataclass
+class Attribute:
+    nc_type: int
+    # Raw big-endian values, without padding
+    data: bytes
+
+    @property
+    def nelems(self) -> int:
+        return len(self.data) // _TYPES[self.nc_type][1]
+
+    @classmethod
+    def text(cls, value: str) -> 'Attribute':
+        return cls(NC_CHAR, value.encode())
+
+    def __str__(self) -> str:
+        if self.nc_type == NC_CHAR:
+            return self.data.decode()
+        fmt = _TYPES[self.nc_type][0]
+        return str(struct.unpack(f'>{self.nelems}{fmt}', self.data))
+
+
+@dataclass
+class Variable:
+    name: str
+    dimids: list[int]
+    attrs: dict[str, Attribute]
+    nc_type: int
+    vsize: int
+    begin: int
+
+
+@dataclass
+class Header:
+    """
+    Header of a classic (version 1) or 64-bit offset (version 2) netCDF file.
+    Dimensions are (name, length) pairs, with length 0 for the record dimension.
+    """
+
+    version: int
+    numrecs: int
+    dims: list[tuple[str, int]]
+    attrs: dict[str, Attribute]
+    variables: list[Variable]
+
+    @classmethod
+    def read(cls, f: BinaryIO) -> 'Header':
+        f.seek(0)
+        reader = _Reader(f)
+        magic = f.read(4)
+        if magic[:3] != b'CDF' or magic[3] not in {1, 2}:
+            raise ValueError(f'{f.name} is not a classic or 64-bit offset file')
+        version = magic[3]
+        numrecs = reader.int32()
+        dims = [(reader.name(), reader.int32()) for _ in reader.list(_NC_DIMENSION)]
+        attrs = reader.attrs()
+        variables = []
+        for _ in reader.list(_NC_VARIABLE):
+            name = reader.name()
+            dimids = [reader.int32() for _ in range(reader.int32())]
+            vattrs = reader.attrs()
+            nc_type = reader.int32()
+            vsize = reader.int32()
+            begin = reader.int64() if version == 2 else reader.int32()
+            variables.append(Variable(name, dimids, vattrs, nc_type, vsize, begin))
+        return cls(version, numrecs, dims, attrs, variables)
+
+    def to_bytes(self) -> bytes:
+        out = bytearray(b'CDF' + bytes([self.version]))
+        out += struct.pack('>i', self.numrecs)
+        out += _list(_NC_DIMENSION, len(self.dims))
+        for name, length in self.dims:
+            out += _name(name) + struct.pack('>i', length)
+        out += _attrs(self.attrs)
+        out += _list(_NC_VARIABLE, len(self.variables))
+        for v in self.variables:
+            out += _name(v.name) + struct.pack('>i', len(v.dimids))
+            out += struct.pack(f'>{len(v.dimids)}i', *v.dimids)
+            out += _attrs(v.attrs)
+            out += struct.pack('>ii', v.nc_type, v.vsize)
+            out += struct.pack('>q' if self.version == 2 else '>i', v.begin)
+        return bytes(out)
+
+    @property
+    def record_dim(self) -> int | None:
+        return next((i for i, (_, n) in enumerate(self.dims) if n == 0), None)
+
+    def is_record(self, var: Variable) -> bool:
+        return len(var.dimids) > 0 and var.dimids[0] == self.record_dim
+
+    @property
+    def record_vars(self) -> list[Variable]:
+        return [v for v in self.variables if self.is_record(v)]
+
+    @property
+    def record_begin(self) -> int:
+        return min(v.begin for v in self.record_vars)
+
+    @property
+    def record_size(self) -> int:
+        """
+        Bytes in one record. Each variable's part of the record is padded
+        to 4 bytes, except when there is only one record variable.
+        """
+        record_vars = self.record_vars
+        if len(record_vars) == 1:
+            v = record_vars[0]
+            n = _TYPES[v.nc_type][1]
+            for d in v.dimids[1:]:
+                n *= self.dims[d][1]
+            return n
+        return sum(v.vsize for v in record_vars)
+
+    def variable(self, name: str) -> Variable:
+        return next(v for v in self.variables if v.name == name)
+
+    def with_layout(self, numrecs: int) -> 'Header':
+        """
+        Copy of the header for a file with numrecs records, with the data
+        of each variable placed straight after the header.
+        """
+        header = replace(
+            self, numrecs=numrecs, variables=[replace(v) for v in self.variables]
+        )
+        # Begins have a fixed width, so the size of the header
+        # does not depend on their values
+        offset = len(header.to_bytes())
+        for v in sorted(header.variables, key=header.is_record):
+            v.begin = offset
+            offset += v.vsize
+        return header
+
+    def differences(self, other: 'Header', ignore: Sequence[str] = ()) -> list[str]:
+        """
+        Ways in which the other header describes data laid out differently,
+        apart from the number of records. Global attributes are not compared,
+        nor are the attributes of variables named in ignore.
+        """
+        diffs = []
+        if self.version != other.version:
+            diffs.append('format version')
+        if self.dims != other.dims:
+            diffs.append('dimensions')
+        names = [v.name for v in self.variables]
+        if names != [v.name for v in other.variables]:
+            diffs.append('variables')
+            return diffs
+        for a, b in zip(self.variables, other.variables, strict=True):
+            if (a.dimids, a.nc_type, a.vsize) != (b.dimids, b.nc_type, b.vsize):
+                diffs.append(f'shape or type of {a.name}')
+            elif a.name not in ignore and a.attrs != b.attrs:
+                diffs.append(f'attributes of {a.name}')
+        return diffs
+
+
+class _Reader:
+    def __init__(self, f: BinaryIO):
+        self.f = f
+
+    def int32(self) -> int:
+        return struct.unpack('>i', self.f.read(4))[0]
+
+    def int64(self) -> int:
+        return struct.unpack('>q', self.f.read(8))[0]
+
+    def padded(self, n: int) -> bytes:
+        data = self.f.read(n)
+        self.f.read(_pad4(n))
+        return data
+
+    def name(self) -> str:
+        return self.padded(self.int32()).decode()
+
+    def list(self, tag: int) -> range:
+        found, n = self.int32(), self.int32()
+        if found not in {tag, _ABSENT}:
+            raise ValueError(f'Unexpected tag {found} in netCDF header')
+        return range(n)
+
+    def attrs(self) -> dict[str, Attribute]:
+        attrs = {}
+        for _ in self.list(_NC_ATTRIBUTE):
+            name = self.name()
+            nc_type = self.int32()
+            nelems = self.int32()
+            attrs[name] = Attribute(nc_type, self.padded(nelems * _TYPES[nc_type][1]))
+        return attrs
+
+
+def _list(tag: int, n: int) -> bytes:
+    return struct.pack('>ii', tag if n > 0 else _ABSENT, n)
+
+
+def _name(name: str) -> bytes:
+    data = name.encode()
+    return struct.pack('>i', len(data)) + data + bytes(_pad4(len(data)))
+
+
+def _attrs(attrs: dict[str, Attribute]) -> bytes:
+    out = _list(_NC_ATTRIBUTE, len(attrs))
+    for name, att in attrs.items():
+        out += _name(name) + struct.pack('>ii', att.nc_type, att.nelems)
+        out += att.data + bytes(_pad4(len(att.data)))
+    return out
+
+
+def _copy(src: BinaryIO, dst: BinaryIO, offset: int, nbytes: int) -> None:
+    src.seek(offset)
+    while nbytes > 0:
+        block = src.read(min(_BLOCK_SIZE, nbytes))
+        if len(block) == 0:
+            raise EOFError(f'{src.name} ended early')
+        dst.write(block)
+        nbytes -= len(block)
+
+
+@dataclass
+class RecordRange:
+    """
+    Records to take from a file: count records starting at start
+    (which may be negative to count from the end), or all of the records
+    from start on if count is None. shift_days is added to the time
+    of each record, for example to make a padding record from a copy
+    of the first or last one.
+    """
+
+    path: Path
+    start: int = 0
+    count: int | None = None
+    shift_days: float = 0
+
+
+def _read_times(f: BinaryIO, header: Header, time: str, start: int, count: int):
+    var = header.variable(time)
+    fmt, size = _TYPES[var.nc_type]
+    values = []
+    for i in range(start, start + count):
+        f.seek(var.begin + i * header.record_size)
+        values.append(struct.unpack(f'>{fmt}', f.read(size))[0])
+    return values
+
+
+def _write_times(
+    f: BinaryIO, header: Header, time: str, start: int, values: list
+) -> None:
+    var = header.variable(time)
+    fmt = _TYPES[var.nc_type][0]
+    for i, value in enumerate(values, start=start):
+        f.seek(var.begin + i * header.record_size)
+        f.write(struct.pack(f'>{fmt}', round(value) if fmt in 'bhi' else value))
+
+
+def _convert_times(
+    values: list, src: Variable, dst: Variable, shift_days: float
+) -> list:
+    """
+    Convert time values from the units and calendar of src to those of dst,
+    and add shift_days.
+    """
+    units = str(dst.attrs['units'])
+    src_units = str(src.attrs['units'])
+    if src_units != units:
+        calendar = str(dst.attrs.get('calendar', 'standard'))
+        src_calendar = str(src.attrs.get('calendar', 'standard'))
+        dates = netCDF4.num2date(values, src_units, src_calendar)
+        values = list(netCDF4.date2num(dates, units, calendar))
+    shift = shift_days * _PER_DAY[units.split(maxsplit=1)[0]]
+    return [v + shift for v in values]
+
+
+def _select(r: RecordRange, header: Header) -> tuple[int, int]:
+    """
+    First record and number of records to take from a file.
+    """
+    start = header.numrecs + r.start if r.start < 0 else r.start
+    count = header.numrecs - start if r.count is None else r.count
+    if start < 0 or start + count > header.numrecs:
+        raise IndexError(f'{r.path} has only {header.numrecs} records')
+    return start, count
+
+
+def concat_records(
+    ranges: list[RecordRange],
+    fout: Path,
+    time: str = 'time',
+    calendar: str | None = None,
+) -> None:
+    """
+    Concatenate records from several classic or 64-bit offset files with the
+    same layout (such as the monthly files for one boundary segment)
+    by copying the bytes of each record. The header and the data of the
+    variables without a record dimension come from the first file.
+    The time variable is the only one that is decoded: its values are
+    converted to the units of the first file if the units differ,
+    and shifted by shift_days. calendar, if given, replaces the calendar
+    attribute of the time variable.
+    """
+    with open(ranges[0].path, 'rb') as f:
+        template = Header.read(f)
+    if calendar is not None:
+        template.variable(time).attrs['calendar'] = Attribute.text(calendar)
+
+    # Check every file before writing anything
+    sources = []
+    for r in ranges:
+        with open(r.path, 'rb') as f:
+            header = Header.read(f)
+        diffs = template.differences(header, ignore=[time])
+        if diffs:
+            raise ValueError(
+                f'Cannot concatenate {r.path} with {ranges[0].path}: '
+                f'different {", ".join(diffs)}'
+            )
+        sources.append((r, header, *_select(r, header)))
+
+    out_header = template.with_layout(sum(count for *_, count in sources))
+    out_time = out_header.variable(time)
+    with atomic_path(fout) as tmp, open(tmp, 'wb') as out:
+        out.write(out_header.to_bytes())
+        # Data for the variables without a record dimension, in header order
+        with open(ranges[0].path, 'rb') as src:
+            for v in template.variables:
+                if not template.is_record(v):
+                    _copy(src, out, v.begin, v.vsize)
+        record = 0
+        for r, header, start, count in sources:
+            recsize = header.record_size
+            with open(r.path, 'rb') as src:
+                _copy(src, out, header.record_begin + start * recsize, count * recsize)
+                src_time = header.variable(time)
+                if (
+                    r.shift_days != 0
+                    or src_time.attrs['units'] != out_time.attrs['units']
+                ):
+                    end = out.tell()
+                    values = _read_times(src, header, time, start, count)
+                    values = _convert_times(values, src_time, out_time, r.shift_days)
+                    _write_times(out, out_header, time, record, values)
+                    out.seek(end)
+            record += count
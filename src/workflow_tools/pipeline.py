@@ -0,0 +1,177 @@
+# Bounded producer/consumer pipelines for overlapping staging and processing
+import multiprocessing
+from collections.abc import Callable, Iterable
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass
+from queue import Queue
+from threading import Condition, Lock, Thread
+from typing import Any
+
+from loguru import logger
+
+# Marks the end of the items in a queue
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    """
+    One step of a pipeline.
+    name: used for logging
+    func: called with each item from the previous stage. The return value is
+      passed to the next stage, unless it is None, which drops the item.
+    workers: number of threads running func concurrently.
+    queue_depth: maximum number of items waiting for this stage. When the
+      queue is full the previous stage blocks, so a fast stage cannot
+      run too far ahead of a slow one.
+    expand: if True, func returns an iterable of items that are
+      passed to the next stage one at a time.
+    processes: if True, func runs in a pool of worker processes instead of
+      threads, for CPU-bound work. func and the items must be picklable.
+    on_done: called in the parent process with each input item after func
+      has finished with it, whether or not func succeeded.
+    """
+
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+    queue_depth: int = 2
+    expand: bool = False
+    processes: bool = False
+    on_done: Callable[[Any], None] | None = None
+
+
+class DiskBudget:
+    """
+    Limit on the number of bytes staged to scratch at once.
+    acquire blocks until the bytes fit in the budget, which
+    holds back the staging stages until processing catches up.
+    A single request larger than the whole budget is let through
+    when nothing else is staged so that it cannot block forever.
+    """
+
+    def __init__(self, limit: int | None = None):
+        self.limit = limit
+        self.used = 0
+        self._cond = Condition()
+
+    def acquire(self, nbytes: int) -> None:
+        if self.limit is None:
+            return
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self.used == 0 or self.used + nbytes <= self.limit
+            )
+            self.used += nbytes
+
+    def release(self, nbytes: int) -> None:
+        if self.limit is None:
+            return
+        with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+
+class PipelineError(Exception):
+    def __init__(self, failures: list[tuple[str, Any, Exception]]):
+        self.failures = failures
+        super().__init__(
+            f'{len(failures)} item(s) failed: '
+            + ', '.join(f'{name}({item})' for name, item, _ in failures)
+        )
+
+
+def _call(stage: Stage, executor: Executor | None, item: Any) -> Any:
+    if executor is None:
+        return stage.func(item)
+    return executor.submit(stage.func, item).result()
+
+
+def run_pipeline(items: Iterable[Any], stages: list[Stage]) -> list[Any]:
+    """
+    Pass items through the stages, with every stage running concurrently
+    in its own pool of threads and connected to the next by a bounded queue.
+    The pipeline runs at about the speed of its slowest stage.
+    An item that raises an exception is logged and dropped so that the
+    others can finish; a PipelineError listing the failures is raised at the end.
+    Returns the outputs of the last stage, in order of completion.
+    """
+    queues: list[Queue] = [Queue(maxsize=max(s.queue_depth, 1)) for s in stages]
+    results: list[Any] = []
+    failures: list[tuple[str, Any, Exception]] = []
+    lock = Lock()
+
+    def forward(i: int, out: Any) -> None:
+        if i + 1 < len(stages):
+            queues[i + 1].put(out)
+        else:
+            with lock:
+                results.append(out)
+
+    def worker(i: int, stage: Stage, executor: Executor | None) -> None:
+        while True:
+            item = queues[i].get()
+            if item is _DONE:
+                # Put it back for the other workers of this stage
+                queues[i].put(_DONE)
+                return
+            try:
+                out = _call(stage, executor, item)
+                if out is None:
+                    continue
+                if stage.expand:
+                    for o in out:
+                        forward(i, o)
+                else:
+                    forward(i, out)
+            except Exception as err:
+                logger.exception('Stage {s} failed for {i}', s=stage.name, i=item)
+                with lock:
+                    failures.append((stage.name, item, err))
+            finally:
+                if stage.on_done is not None:
+                    stage.on_done(item)
+
+    def feed() -> None:
+        for item in items:
+            queues[0].put(item)
+        queues[0].put(_DONE)
+
+    # Worker processes are spawned rather than forked,
+    # since forking a process that is running threads is unsafe.
+    executors = [
+        ProcessPoolExecutor(
+            max_workers=max(stage.workers, 1),
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+        if stage.processes
+        else None
+        for stage in stages
+    ]
+    threads = [
+        [
+            Thread(
+                target=worker, args=(i, stage, executors[i]), name=f'{stage.name}-{n}'
+            )
+            for n in range(max(stage.workers, 1))
+        ]
+        for i, stage in enumerate(stages)
+    ]
+    for pool in threads:
+        for t in pool:
+            t.start()
+    feeder = Thread(target=feed, name='feed')
+    feeder.start()
+    feeder.join()
+    # Each stage is finished once all of its workers have seen
+    # the end of its queue; then the next stage can be told the same.
+    for i, pool in enumerate(threads):
+        for t in pool:
+            t.join()
+        if executors[i] is not None:
+            executors[i].shutdown()
+        if i + 1 < len(stages):
+            queues[i + 1].put(_DONE)
+    if failures:
+        raise PipelineError(failures)
+    return results
@@ -1,8 +1,16 @@
 import errno
+import json
+import os
+import re
 from calendar import isleap, monthrange
+from concurrent import futures
+from dataclasses import dataclass, field
 from functools import partial
+from getpass import getuser
 from pathlib import Path, PurePath
 
+from loguru import logger
+
 # Top level path to all SPEAR medium reforecast data on archive
 SPEAR_ROOT = (
     Path('/archive')
@@ -13,6 +21,17 @@ SPEAR_ROOT = (
     / 's_j11_OTA_IceAtmRes_L33'
 )
 
+# Default location to save the catalog of SPEAR_ROOT
+CATALOG_FILE = Path('/ptmp') / getuser() / 'spear_catalog.json'
+
+# Name of the directory for each forecast initialization,
+# with an optional suffix for re-runs
+_INIT_DIR = re.compile(r'i(\d{4})(\d{2})01_OTA_IceAtmRes_L33(.*)')
+
+# Directory suffixes to try, in order, when a file is not in the directory
+# chosen by spear_subdir (later re-runs are assumed to supersede earlier ones)
+_SUFFIX_PREFERENCE = ('_rerun', '_update', '_MED', '')
+
 
 def get_spear_file(
     ystart: int, mstart: int, domain: str, freq: str, var: str
@@ -80,11 +99,23 @@ def get_spear_path(
     if ens != 'pp_ensemble':
         ens = f'pp_ens_{int(ens):02d}'
 
-    subdir = f'i{ystart}{mstart:02d}01_OTA_IceAtmRes_L33'
     fname = get_spear_file(ystart, mstart, domain, freq, var)
     subpath = PurePath(str(ens)) / domain / 'ts' / freq / '1yr' / fname
+    final_path = root / spear_subdir(ystart, mstart) / subpath
+    if not final_path.is_file():
+        raise FileNotFoundError(
+            errno.ENOENT,
+            'Could not find right plain directory, _update, or _rerun.',
+            final_path.as_posix(),
+        )
+    return final_path
 
+
+def spear_subdir(ystart: int, mstart: int) -> str:
     """
+    Name of the directory under SPEAR_ROOT that normally holds the
+    forecast initialized in ystart and mstart:
+
     For year 1991-2014
     iyyyymm01__OTA_IceAtmRes_L33
 
@@ -100,7 +131,7 @@ def get_spear_path(
     For 2022 onward
     iyyyymm01__OTA_IceAtmRes_L33
     """
-
+    subdir = f'i{ystart}{mstart:02d}01_OTA_IceAtmRes_L33'
     if ystart == 2020:
         subdir += '_rerun'
     elif ystart in range(2015, 2020) or ystart == 2021:
@@ -108,14 +139,194 @@ def get_spear_path(
     elif ystart == 2025 and mstart == 10:
         # This is likely a special case; an early start
         subdir += '_MED'
-    final_path = root / subdir / subpath
-    if not final_path.is_file():
-        raise FileNotFoundError(
-            errno.ENOENT,
-            'Could not find right plain directory, _update, or _rerun.',
-            final_path.as_posix(),
-        )
-    return final_path
+    return subdir
+
+
+def _spear_key(
+    ystart: int | str, mstart: int | str, ens: int | str, *names: str
+) -> tuple:
+    """
+    Catalog key (ystart, mstart, ens, domain, freq, var).
+    """
+    if ens != 'pp_ensemble':
+        ens = int(ens)
+    return (int(ystart), int(mstart), ens, *names)
+
+
+def _list_init_dir(init_dir: Path) -> list[list]:
+    """
+    Ensemble member, domain, frequency, variable, and relative path
+    of every post-processed file in one initialization directory.
+    """
+    files = []
+    for path in init_dir.glob('pp_ens*/*/ts/*/1yr/*.nc'):
+        relative = path.relative_to(init_dir)
+        ens_dir, domain, _, freq, _, fname = relative.parts
+        if ens_dir == 'pp_ensemble':
+            ens = ens_dir
+        elif match := re.fullmatch(r'pp_ens_(\d+)', ens_dir):
+            ens = int(match.group(1))
+        else:
+            continue
+        # Files are named domain.dates.var.nc
+        var = fname.removesuffix('.nc').split('.', 2)[-1]
+        files.append([ens, domain, freq, var, relative.as_posix()])
+    return files
+
+
+@dataclass
+class SpearCatalog:
+    """
+    Index of the post-processed SPEAR files under root, keyed by
+    (ystart, mstart, ens, domain, freq, var). It is built by listing each
+    initialization directory once, several at a time, instead of checking
+    every path on archive. Since the plain, _update, _rerun, and _MED
+    directories are all listed, it finds whichever of them actually holds
+    a file, preferring the one chosen by spear_subdir.
+    The listing is saved to cache_file, and later only the initialization
+    directories that are new or have been modified are listed again.
+    Files added deep inside a directory do not change its modification time,
+    so a file that is not in the catalog makes path list the directories for
+    that initialization again before giving up, once per process.
+    """
+
+    root: Path = SPEAR_ROOT
+    cache_file: Path | None = CATALOG_FILE
+    threads: int = 8
+    _dirs: dict[str, dict] = field(default_factory=dict, init=False, repr=False)
+    _index: dict[tuple, list[str]] | None = field(default=None, init=False, repr=False)
+    # Initializations (ystart, mstart) listed again since the catalog was refreshed
+    _rescanned: set[tuple[int, int]] = field(
+        default_factory=set, init=False, repr=False
+    )
+
+    def _load(self) -> dict[str, dict]:
+        if self.cache_file is None or not self.cache_file.is_file():
+            return {}
+        with open(self.cache_file) as f:
+            saved = json.load(f)
+        if saved['root'] != self.root.as_posix():
+            return {}
+        return saved['dirs']
+
+    def _save(self) -> None:
+        if self.cache_file is None:
+            return
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.cache_file.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump({'root': self.root.as_posix(), 'dirs': self._dirs}, f)
+        os.replace(tmp_file, self.cache_file)
+
+    def refresh(self, rescan: bool = False) -> None:
+        """
+        Update the catalog, listing the initialization directories that
+        are not in the saved catalog or have changed since it was saved
+        (or all of them, if rescan is True).
+        """
+        saved = {} if rescan else self._load()
+        with os.scandir(self.root) as it:
+            current = {
+                e.name: e.stat().st_mtime
+                for e in it
+                if e.is_dir() and _INIT_DIR.fullmatch(e.name)
+            }
+        stale = [
+            d for d in current if d not in saved or saved[d]['mtime'] != current[d]
+        ]
+        self._dirs = {d: saved[d] for d in current if d not in stale}
+        self._rescanned.clear()
+        if len(stale) > 0:
+            logger.info(f'Listing {len(stale)} SPEAR directories')
+            with futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+                listings = executor.map(_list_init_dir, (self.root / d for d in stale))
+                for d, files in zip(stale, listings, strict=True):
+                    self._dirs[d] = {'mtime': current[d], 'files': files}
+        if len(stale) > 0 or saved.keys() != current.keys():
+            self._save()
+        self._build_index()
+
+    def _build_index(self) -> None:
+        index: dict[tuple, list[str]] = {}
+        for d, listing in self._dirs.items():
+            ystart, mstart, _ = _INIT_DIR.fullmatch(d).groups()
+            for ens, domain, freq, var, relative in listing['files']:
+                key = _spear_key(ystart, mstart, ens, domain, freq, var)
+                index.setdefault(key, []).append(f'{d}/{relative}')
+        self._index = index
+
+    def rescan_init(self, ystart: int, mstart: int) -> None:
+        """
+        List the directories for one initialization (plain and re-runs) again,
+        for files that were added after they were last listed.
+        """
+        if self._index is None:
+            self.refresh()
+        self._rescanned.add((int(ystart), int(mstart)))
+        plain = f'i{ystart}{mstart:02d}01_OTA_IceAtmRes_L33'
+        subdirs = {plain + suffix for suffix in _SUFFIX_PREFERENCE}
+        subdirs.add(spear_subdir(ystart, mstart))
+        changed = False
+        for d in sorted(subdirs):
+            init_dir = self.root / d
+            if not init_dir.is_dir():
+                continue
+            mtime = init_dir.stat().st_mtime
+            files = _list_init_dir(init_dir)
+            if d not in self._dirs or self._dirs[d]['files'] != files:
+                logger.info(f'Found new files in {d}')
+                changed = True
+            self._dirs[d] = {'mtime': mtime, 'files': files}
+        if changed:
+            self._save()
+            self._build_index()
+
+    @property
+    def index(self) -> dict[tuple, list[str]]:
+        if self._index is None:
+            self.refresh()
+        return self._index
+
+    def path(
+        self,
+        ystart: int,
+        mstart: int,
+        domain: str,
+        freq: str,
+        var: str,
+        *,
+        ens: int | str = 'pp_ensemble',
+    ) -> Path:
+        """
+        Same as get_spear_path, but answered from the catalog.
+        """
+        key = _spear_key(ystart, mstart, ens, domain, freq, var)
+        found = self.index.get(key)
+        if not found and (int(ystart), int(mstart)) not in self._rescanned:
+            # The file may have been added since the directory was listed.
+            # Only look once, since other files for the same initialization
+            # are often missing too.
+            self.rescan_init(ystart, mstart)
+            found = self.index.get(key)
+        if not found:
+            raise FileNotFoundError(
+                errno.ENOENT,
+                'Could not find file in the SPEAR catalog',
+                f'{ystart}-{mstart:02d} {ens} {domain} {freq} {var}',
+            )
+        by_dir = {f.split('/', 1)[0]: f for f in found}
+        plain = f'i{ystart}{mstart:02d}01_OTA_IceAtmRes_L33'
+        preferred = spear_subdir(ystart, mstart)
+        for subdir in (preferred, *(plain + s for s in _SUFFIX_PREFERENCE)):
+            if subdir in by_dir:
+                if subdir != preferred:
+                    logger.debug(f'Using {subdir} instead of {preferred} for {var}')
+                return self.root / by_dir[subdir]
+        return self.root / found[0]
+
+    def paths(self, variables: list[str], *args, **kwargs) -> list[Path]:
+        fun = partial(self.path, *args, **kwargs)
+        return [fun(v) for v in variables]
 
 
 def get_spear_files(variables: list[str], *args, **kwargs) -> list[PurePath]:
@@ -123,7 +334,15 @@ def get_spear_files(variables: list[str], *args, **kwargs) -> list[PurePath]:
     return [fun(v) for v in variables]
 
 
-def get_spear_paths(variables: list[str], *args, **kwargs) -> list[Path]:
+def get_spear_paths(
+    variables: list[str], *args, catalog: SpearCatalog | None = None, **kwargs
+) -> list[Path]:
+    """
+    Paths to several variables, found using the catalog if one is given
+    or by checking each path on archive otherwise.
+    """
+    if catalog is not None:
+        return catalog.paths(variables, *args, **kwargs)
     fun = partial(get_spear_path, *args, **kwargs)
     return [fun(v) for v in variables]
 
@@ -139,8 +358,16 @@ if __name__ == '__main__':
     parser.add_argument('-v', '--var')
     parser.add_argument('-e', '--ensemble')
     parser.add_argument('-c', '--config')
+    parser.add_argument(
+        '--rescan',
+        action='store_true',
+        help='List all of the SPEAR directories again instead of updating '
+        'the saved catalog',
+    )
     args = parser.parse_args()
     config = load_config(args.config)
+    catalog = SpearCatalog()
+    catalog.refresh(rescan=args.rescan)
 
     fnames = []
     # If called from command line, this will return all files
@@ -150,7 +377,7 @@ if __name__ == '__main__':
         config.retrospective_forecasts.last_year + 1,
     ):
         for mstart in config.retrospective_forecasts.months:
-            fname = get_spear_path(
+            fname = catalog.path(
                 ystart, mstart, args.domain, args.freq, args.var, ens=args.ensemble
             ).as_posix()
             fnames.append(fname)
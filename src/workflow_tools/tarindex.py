@@ -0,0 +1,160 @@
+# Index of member locations within uncompressed history tar files
+import errno
+import json
+import mmap
+import tarfile
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from getpass import getuser
+from os import replace
+from pathlib import Path
+
+from loguru import logger
+
+# Default location to store the index files
+INDEX_ROOT = Path('/ptmp') / getuser() / 'tar_index'
+
+# Size of the blocks to copy when extracting a member
+_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def _member_key(name: str) -> str:
+    """
+    Normalize a member name so that ./file and file are the same.
+    """
+    return name.removeprefix('./')
+
+
+@dataclass(frozen=True)
+class TarMember:
+    offset: int
+    size: int
+
+
+@dataclass
+class TarIndex:
+    """
+    Byte offsets and sizes of the members of an uncompressed tar file.
+    The index is built once by reading only the tar headers and is
+    saved as a json sidecar under index_root, so that members can later be
+    read by seeking straight to their data instead of scanning the tar file.
+    """
+
+    tar_path: Path
+    index_root: Path = INDEX_ROOT
+    _members: dict[str, TarMember] | None = field(
+        default=None, init=False, repr=False
+    )
+
+    @property
+    def index_file(self) -> Path:
+        """
+        Location of the sidecar file holding the index for this tar file.
+        """
+        relative = self.tar_path.relative_to(self.tar_path.anchor)
+        return self.index_root / relative.with_name(relative.name + '.index.json')
+
+    @property
+    def members(self) -> dict[str, TarMember]:
+        if self._members is None:
+            self._members = self._load() or self._build()
+        return self._members
+
+    def _load(self) -> dict[str, TarMember] | None:
+        """
+        Read the index from the sidecar file, if it exists and
+        still matches the size and modification time of the tar file.
+        """
+        if not self.index_file.is_file():
+            return None
+        stat = self.tar_path.stat()
+        with open(self.index_file) as f:
+            saved = json.load(f)
+        if saved['size'] != stat.st_size or saved['mtime'] != stat.st_mtime:
+            logger.debug('Index {f} is out of date', f=self.index_file)
+            return None
+        return {k: TarMember(*v) for k, v in saved['members'].items()}
+
+    def _build(self) -> dict[str, TarMember]:
+        """
+        Read the headers of the tar file and save the index.
+        tarfile seeks over the member data of uncompressed files,
+        so this only reads the headers.
+        """
+        logger.debug('Indexing {f}', f=self.tar_path)
+        stat = self.tar_path.stat()
+        members = {}
+        with tarfile.open(self.tar_path, mode='r:') as tar:
+            for info in tar:
+                if info.isfile():
+                    members[_member_key(info.name)] = TarMember(
+                        info.offset_data, info.size
+                    )
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.index_file.with_suffix('.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(
+                {
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime,
+                    'members': {k: [v.offset, v.size] for k, v in members.items()},
+                },
+                f,
+            )
+        replace(tmp_file, self.index_file)
+        return members
+
+    def __contains__(self, name: str) -> bool:
+        return _member_key(name) in self.members
+
+    def member(self, name: str) -> TarMember:
+        try:
+            return self.members[_member_key(name)]
+        except KeyError:
+            raise FileNotFoundError(
+                errno.ENOENT,
+                f'Member {name} not found in tar file',
+                self.tar_path.as_posix(),
+            ) from None
+
+    def extract(self, name: str, dest_dir: Path) -> Path:
+        """
+        Copy a single member to dest_dir by seeking directly to its data.
+        Returns the path to the extracted file.
+        """
+        member = self.member(name)
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        dest = dest_dir / Path(_member_key(name)).name
+        tmp_dest = dest.with_name(dest.name + '.part')
+        with open(self.tar_path, 'rb') as src, open(tmp_dest, 'wb') as dst:
+            src.seek(member.offset)
+            remaining = member.size
+            while remaining > 0:
+                block = src.read(min(_BLOCK_SIZE, remaining))
+                if not block:
+                    raise EOFError(f'Unexpected end of {self.tar_path} reading {name}')
+                dst.write(block)
+                remaining -= len(block)
+        replace(tmp_dest, dest)
+        return dest
+
+    @contextmanager
+    def view(self, name: str) -> Iterator[memoryview]:
+        """
+        Read-only memory-mapped view of the bytes of a single member.
+        Nothing is read until the view is accessed, and the view
+        is only valid inside the context.
+        """
+        member = self.member(name)
+        with (
+            open(self.tar_path, 'rb') as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+        ):
+            whole = memoryview(mapped)
+            view = whole[member.offset : member.offset + member.size]
+            try:
+                yield view
+            finally:
+                view.release()
+                whole.release()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Stand-in for dmget, for testing workflow_tools.io.DMGet away from the archive.
+Use it with DMGet(command=f'{sys.executable} tests/fake_dmget.py')
+or by pointing the DMGET environment variable at it.
+
+It is configured by environment variables:
+FAKE_DMGET_BAD: paths, separated by ':', that cannot be recalled. A request
+  that includes any of them fails with dmget's "unable to recall" message.
+FAKE_DMGET_FAILURES: number of times to fail with some other error
+  before succeeding (counted in FAKE_DMGET_LOG, which it then requires).
+FAKE_DMGET_DELAY: seconds that each request takes.
+FAKE_DMGET_LOG: file that each request is appended to, as one json line
+  with the paths requested and the start and end times.
+"""
+
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+BAD_FILE = 'dmget: unable to recall the requested file'
+
+
+def main(paths: list[str]) -> int:
+    start = time.time()
+    bad = set(filter(None, os.environ.get('FAKE_DMGET_BAD', '').split(':')))
+    failures = int(os.environ.get('FAKE_DMGET_FAILURES', '0'))
+    log = os.environ.get('FAKE_DMGET_LOG')
+    previous = 0
+    if log is not None and Path(log).is_file():
+        previous = len(Path(log).read_text().splitlines())
+    time.sleep(float(os.environ.get('FAKE_DMGET_DELAY', '0')))
+    if previous < failures:
+        status, message = 1, 'dmget: lost connection to the tape server'
+    elif bad.intersection(paths):
+        status, message = 1, BAD_FILE
+    else:
+        status, message = 0, ''
+    if log is not None:
+        with open(log, 'a') as f:
+            entry = {'paths': paths, 'start': start, 'end': time.time()}
+            f.write(json.dumps(entry) + '\n')
+    if message:
+        print(message, file=sys.stderr)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
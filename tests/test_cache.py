@@ -0,0 +1,130 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from workflow_tools.cache import CacheStats, ScratchCache
+
+
+def write(cache: ScratchCache, name: str, size: int = 100) -> Path:
+    path = cache.root / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'x' * size)
+    cache.add(path)
+    # Make sure that the access times differ
+    time.sleep(0.01)
+    return path
+
+
+def test_quota_evicts_least_recently_used(tmp_path):
+    cache = ScratchCache(tmp_path, quota=300)
+    a, b, c = (write(cache, name) for name in ('a', 'b', 'c'))
+    # Using a makes b the least recently used
+    assert cache.lookup(a)
+    time.sleep(0.01)
+    d = write(cache, 'd')
+    assert [p.is_file() for p in (a, b, c, d)] == [True, False, True, True]
+    assert cache.size == 300
+    assert cache.stats.evictions == 1
+    assert cache.stats.evicted_bytes == 100
+
+
+def test_new_file_is_kept_even_if_over_quota(tmp_path):
+    cache = ScratchCache(tmp_path, quota=100)
+    a = write(cache, 'a')
+    big = write(cache, 'big', size=500)
+    assert not a.is_file()
+    assert big.is_file()
+
+
+def test_hits_and_misses(tmp_path):
+    cache = ScratchCache(tmp_path)
+    a = write(cache, 'sub/a')
+    assert cache.lookup_many([a, tmp_path / 'b', a]) == [True, False, True]
+    assert not cache.lookup(tmp_path / 'c')
+    assert cache.stats == CacheStats(hits=2, misses=2)
+
+
+def test_lookup_adopts_and_forgets_files(tmp_path):
+    cache = ScratchCache(tmp_path)
+    a = tmp_path / 'a'
+    a.write_bytes(b'x' * 10)
+    assert cache.lookup(a)
+    assert cache.size == 10
+    a.unlink()
+    assert not cache.lookup(a)
+    assert cache.size == 0
+
+
+def test_getters_do_not_rewrite_index(tmp_path):
+    cache = ScratchCache(tmp_path)
+    write(cache, 'a')
+    before = cache.index_file.stat().st_mtime_ns
+    time.sleep(0.01)
+    assert cache.size == 100
+    assert cache.stats.hits == 0
+    assert cache.index_file.stat().st_mtime_ns == before
+
+
+def test_pinned_files_are_not_evicted(tmp_path):
+    cache = ScratchCache(tmp_path, quota=200)
+    a = tmp_path / 'a'
+    cache.pin([a, a])
+    a.write_bytes(b'x' * 100)
+    cache.add(a)
+    time.sleep(0.01)
+    b = write(cache, 'b')
+    c = write(cache, 'c')
+    assert a.is_file()
+    assert not b.is_file()
+    # Pinned twice, so still pinned after the first unpin
+    cache.unpin([a])
+    d = write(cache, 'd')
+    assert a.is_file()
+    assert not c.is_file()
+    cache.unpin([a])
+    write(cache, 'e')
+    assert not a.is_file()
+    assert d.is_file()
+
+
+def test_stale_pins_are_reclaimed(tmp_path):
+    cache = ScratchCache(tmp_path, quota=100, pin_timeout=60)
+    # Pins left behind by a process that has exited on this host,
+    # and by an old process on another host
+    finished = subprocess.run(
+        [sys.executable, '-c', 'import os; print(os.getpid())'],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    dead = f'{socket.gethostname()}:{int(finished.stdout)}'
+    old = time.time() - 120
+    index = {
+        'entries': {},
+        'stats': {'hits': 0, 'misses': 0, 'evictions': 0, 'evicted_bytes': 0},
+        'pins': {'a': {dead: [1, time.time()]}, 'b': {'elsewhere:1': [1, old]}},
+    }
+    cache.index_file.write_text(json.dumps(index))
+    a = write(cache, 'a')
+    b = write(cache, 'b')
+    write(cache, 'c')
+    assert not a.is_file()
+    assert not b.is_file()
+    saved = json.loads(cache.index_file.read_text())
+    assert saved['pins'] == {}
+
+
+def test_pins_of_live_processes_are_kept(tmp_path):
+    cache = ScratchCache(tmp_path, quota=100, pin_timeout=0)
+    a = tmp_path / 'a'
+    cache.pin([a])
+    a.write_bytes(b'x' * 100)
+    cache.add(a)
+    write(cache, 'b')
+    assert a.is_file()
+    saved = json.loads(cache.index_file.read_text())
+    assert list(saved['pins']['a']) == [f'{socket.gethostname()}:{os.getpid()}']
@@ -0,0 +1,99 @@
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from workflow_tools.io import DMGet
+
+FAKE_DMGET = Path(__file__).parent / 'fake_dmget.py'
+
+
+@pytest.fixture
+def log(tmp_path, monkeypatch):
+    log = tmp_path / 'dmget.log'
+    monkeypatch.setenv('FAKE_DMGET_LOG', log.as_posix())
+    return log
+
+
+def requests(log: Path) -> list[dict]:
+    return [json.loads(line) for line in log.read_text().splitlines()]
+
+
+def make_dmget(**kwargs) -> DMGet:
+    kwargs.setdefault('backoff', 0)
+    return DMGet(command=f'{sys.executable} {FAKE_DMGET}', **kwargs)
+
+
+def paths(n: int) -> list[Path]:
+    return [Path(f'/archive/history/{i:02d}.nc.tar') for i in range(n)]
+
+
+def test_recalls_everything_in_one_request(log):
+    files = paths(8)
+    report = make_dmget()(files)
+    assert report.ok
+    assert report.recalled == files
+    assert len(requests(log)) == 1
+
+
+def test_isolates_bad_files(log, monkeypatch):
+    files = paths(8)
+    bad = [files[2], files[5]]
+    monkeypatch.setenv('FAKE_DMGET_BAD', ':'.join(p.as_posix() for p in bad))
+    report = make_dmget(retries=0)(files)
+    assert not report.ok
+    assert sorted(report.failed) == bad
+    assert sorted(report.recalled) == [p for p in files if p not in bad]
+    # Parts without a bad file succeed and are not split any further,
+    # so each good file is in exactly one request that succeeded
+    succeeded = [
+        Path(p)
+        for r in requests(log)
+        if not set(r['paths']) & {b.as_posix() for b in bad}
+        for p in r['paths']
+    ]
+    assert sorted(succeeded) == sorted(report.recalled)
+
+
+def test_retries_bad_file_before_giving_up(log, monkeypatch):
+    files = paths(1)
+    monkeypatch.setenv('FAKE_DMGET_BAD', files[0].as_posix())
+    report = make_dmget(retries=2)(files)
+    assert report.failed == files
+    assert len(requests(log)) == 3
+
+
+def test_retries_other_failures_with_backoff(log, monkeypatch):
+    monkeypatch.setenv('FAKE_DMGET_FAILURES', '2')
+    start = time.monotonic()
+    report = make_dmget(retries=2, backoff=0.2)(paths(4))
+    assert report.ok
+    assert len(requests(log)) == 3
+    # Waits of 0.2 and then 0.4 seconds
+    assert time.monotonic() - start >= 0.6
+
+
+def test_raises_when_retries_run_out(log, monkeypatch):
+    monkeypatch.setenv('FAKE_DMGET_FAILURES', '5')
+    with pytest.raises(subprocess.CalledProcessError):
+        make_dmget(retries=1)(paths(4))
+    assert len(requests(log)) == 2
+
+
+def test_limits_outstanding_requests(log, monkeypatch):
+    files = paths(8)
+    monkeypatch.setenv('FAKE_DMGET_BAD', ':'.join(p.as_posix() for p in files))
+    monkeypatch.setenv('FAKE_DMGET_DELAY', '0.2')
+    report = make_dmget(retries=0, max_outstanding=2)(files)
+    assert sorted(report.failed) == files
+    entries = requests(log)
+    # 1 + 2 + 4 + 8 requests as the batch is split down to single files
+    assert len(entries) == 15
+    most = max(
+        sum(1 for o in entries if o['start'] < e['end'] and e['start'] < o['end'])
+        for e in entries
+    )
+    assert most <= 2
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import xarray
+
+grid = pytest.importorskip('workflow_tools.grid', exc_type=ImportError)
+
+
+def ocean(nz: int = 4, ny: int = 60, nx: int = 80, seed: int = 0) -> xarray.DataArray:
+    """
+    Random field with land that covers more of the grid on deeper levels,
+    and a bottom level with no valid points at all near the east.
+    """
+    rng = np.random.default_rng(seed)
+    values = rng.normal(size=(2, nz, ny, nx))
+    depth = np.linspace(0, 1, nz)[:, None, None]
+    land = rng.uniform(size=(nz, ny, nx)) < 0.2 + 0.6 * depth
+    land[-1, :, nx // 2 :] = True
+    values[:, land] = np.nan
+    return xarray.DataArray(
+        values,
+        dims=('time', 'depth', 'latitude', 'longitude'),
+        coords={'latitude': np.arange(ny), 'longitude': np.arange(nx)},
+    )
+
+
+@pytest.mark.parametrize(
+    'window',
+    [
+        # Strip along the eastern edge, in the all-land part of the bottom level
+        {'longitude': slice(70, 76), 'latitude': slice(5, 55)},
+        # Strip against the edges of the box
+        {'longitude': slice(0, 80), 'latitude': slice(50, 60)},
+        {'longitude': slice(0, 6), 'latitude': slice(0, 60)},
+    ],
+)
+def test_fill_nearest_window_matches_full_box(window):
+    da = ocean()
+    expected = grid.fill_nearest(da, 'longitude', 'latitude').isel(window)
+    filled = grid.fill_nearest_window(da, window, 'longitude', 'latitude', pad=2)
+    assert filled.dims == da.dims
+    assert not np.isnan(filled).any()
+    xarray.testing.assert_identical(filled, expected)
+
+
+def test_fill_nearest_window_leaves_empty_level():
+    da = ocean()
+    da[:, 0] = np.nan
+    window = {'longitude': slice(10, 20), 'latitude': slice(10, 20)}
+    filled = grid.fill_nearest_window(da, window, 'longitude', 'latitude')
+    xarray.testing.assert_identical(
+        filled, grid.fill_nearest(da, 'longitude', 'latitude').isel(window)
+    )
+    assert np.isnan(filled[:, 0]).all()